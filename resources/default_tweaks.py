@@ -578,6 +578,52 @@
 # takes a glob pattern allowing a single entry to match multiple URL types.
 openers_by_scheme = {}
 
+#: Size of the cache of search results
+# calibre caches the results of searches, such as the searches that define
+# Virtual libraries, so that repeating them is fast. search_cache_size is the
+# maximum number of searches whose results are cached and
+# search_cache_max_memory is the approximate maximum amount of memory (in MB)
+# the cache can use. Set search_cache_max_memory to zero for no memory limit.
+# Increasing these can speed up switching between many Virtual libraries in
+# very large libraries.
+search_cache_size = 50
+search_cache_max_memory = 64
+
+#: Store book metadata in memory compactly
+# When set to True, calibre stores numbers, dates, yes/no values and the links
+# between books and tags, authors, series, etc. in compact arrays instead of
+# ordinary Python objects. This greatly reduces the memory used for very
+# large libraries (hundreds of thousands of books), at the cost of slightly
+# slower access to individual values. Needs a restart of calibre to take
+# effect.
+compact_in_memory_tables = False
+
+#: Store book metadata on disk for faster opening of libraries
+# When set to True, after reading the metadata of all books from a library,
+# calibre saves a copy of it in its cache folder. The next time the library is
+# opened, if it has not been changed in between, the metadata is loaded from
+# this copy, which is much faster than reading it from the database for very
+# large libraries (hundreds of thousands of books). Uses extra disk space
+# about as large as the metadata.db file of the library.
+cache_tables_on_disk = False
+
+#: Use write-ahead logging for the library database
+# When set to True, the metadata.db file of libraries is put into the SQLite
+# write-ahead logging (WAL) mode, in which reading from the database, for
+# example by the Content server, can happen at the same time as writing to it,
+# for example, when syncing annotations from the E-book viewer. Do not use this
+# for libraries on network drives, as WAL mode does not work with them. Setting
+# it back to False changes libraries back to the normal mode the next time they
+# are opened. Needs a restart of calibre to take effect.
+use_wal_for_library_database = False
+
+#: Size of memory mapped I/O for the library database
+# The number of megabytes of the metadata.db file of libraries that SQLite
+# should access via memory mapping, which can speed up reading from large
+# databases. A value of zero disables memory mapping. For example:
+#   library_database_mmap_size = 256
+library_database_mmap_size = 0
+
 #: Set the first day of the week for calendar popups
 # It must be one of the values Default, Sunday, Monday, Tuesday, Wednesday,
 # Thursday, Friday, or Saturday, all in English, spelled exactly as shown.
@@ -15,8 +15,9 @@
 import sys
 import time
 import uuid
-from contextlib import closing, suppress
+from contextlib import closing, contextmanager, suppress
 from functools import partial
+from threading import Lock, get_ident
 
 import apsw
 
@@ -365,16 +366,23 @@ class Connection(apsw.Connection):  # {{{
 
     BUSY_TIMEOUT = 10000  # milliseconds
 
-    def __init__(self, path):
+    def __init__(self, path, read_only=False, mmap_size=0):
         from calibre.utils.localization import get_lang
         from calibre_extensions.sqlite_extension import set_ui_language
         set_ui_language(get_lang())
-        super().__init__(path)
+        if read_only:
+            super().__init__(path, flags=apsw.SQLITE_OPEN_READONLY)
+        else:
+            super().__init__(path)
         plugins.load_apsw_extension(self, 'sqlite_extension')
         self.fts_dbpath = self.notes_dbpath = None
+        # Threads that are currently in a transaction started with "with conn:"
+        self.transaction_threads = {}
 
         self.setbusytimeout(self.BUSY_TIMEOUT)
         self.execute('PRAGMA cache_size=-5000; PRAGMA temp_store=2; PRAGMA foreign_keys=ON;')
+        if mmap_size > 0:
+            self.execute(f'PRAGMA mmap_size={int(mmap_size)}')
 
         encoding = next(self.execute('PRAGMA encoding'))[0]
         self.createcollation('PYNOCASE', partial(pynocase,
@@ -402,6 +410,23 @@ def __init__(self, path):
         self.createaggregatefunction('aum_sortconcat',
                 AumSortedConcatenate, 4)
 
+    def __enter__(self):
+        ans = super().__enter__()
+        t = get_ident()
+        self.transaction_threads[t] = self.transaction_threads.get(t, 0) + 1
+        return ans
+
+    def __exit__(self, *args):
+        t = get_ident()
+        n = self.transaction_threads.pop(t, 1) - 1
+        if n > 0:
+            self.transaction_threads[t] = n
+        return super().__exit__(*args)
+
+    def in_transaction(self):
+        ' True if the current thread is inside a "with conn:" block and so could have uncommitted changes '
+        return get_ident() in self.transaction_threads
+
     def create_dynamic_filter(self, name):
         f = DynamicFilter(name)
         self.createscalarfunction(name, f, 1)
@@ -439,6 +464,44 @@ def executemany(self, sql, sequence_of_bindings):
 # }}}
 
 
+class ReadConnectionPool:  # {{{
+
+    '''
+    Read only connections to a database in WAL mode, so that SQL reads do not
+    have to wait for, or see the uncommitted changes of, writes on the main
+    connection. Connections are created as needed and at most max_idle of them
+    are kept open once they are no longer in use.
+    '''
+
+    def __init__(self, path, mmap_size=0, max_idle=4):
+        self.path, self.mmap_size, self.max_idle = path, mmap_size, max_idle
+        self.lock = Lock()
+        self.idle = []
+        self.closed = False
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return Connection(self.path, read_only=True, mmap_size=self.mmap_size)
+
+    def put(self, conn):
+        with self.lock:
+            if not self.closed and len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+# }}}
+
+
 def set_global_state(backend):
     load_user_template_functions(
         backend.library_id, (), precompiled_user_functions=backend.get_user_template_functions())
@@ -487,6 +550,15 @@ def __init__(self, library_path, default_prefs=None, read_only=False,
                     'Path to library too long. It must be less than'
                     ' %d characters.')%self.WINDOWS_LIBRARY_PATH_LIMIT)
 
+        # Where the in-memory tables are stored on disk, see tables_cache.py
+        self.tables_cache_path = None
+        if tweaks['cache_tables_on_disk'] and temp_db_path is None and not read_only:
+            from calibre.db.tables_cache import tables_cache_path
+            self.tables_cache_path = tables_cache_path(self.dbpath)
+        self.use_wal = bool(tweaks['use_wal_for_library_database'])
+        self.mmap_size = max(0, int(tweaks['library_database_mmap_size'])) * 1024 * 1024
+        self.read_pool = None
+
         if temp_db_path is not None:
             if not os.path.exists(temp_db_path):
                 raise FileNotFoundError(f"temp_db_path '{temp_db_path} doesn't refer to a file")
@@ -1158,14 +1230,63 @@ def get_connection(self):
     @property
     def conn(self):
         if self._conn is None:
-            self._conn = Connection(self.dbpath)
+            self._conn = Connection(self.dbpath, mmap_size=self.mmap_size)
             self.is_closed = False
             if self._exists and self.user_version == 0:
                 self._conn.close()
                 os.remove(self.dbpath)
-                self._conn = Connection(self.dbpath)
+                self._conn = Connection(self.dbpath, mmap_size=self.mmap_size)
+            self.set_journal_mode()
         return self._conn
 
+    def set_journal_mode(self):
+        conn = self._conn
+        current = conn.get('PRAGMA main.journal_mode', all=False)
+        want = 'wal' if self.use_wal else 'delete'
+        if current != want and 'wal' in (current, want):
+            # Changing to or from WAL mode fails if some other process has the
+            # database open, in which case it is tried again on the next open
+            with suppress(apsw.BusyError):
+                current = conn.get(f'PRAGMA main.journal_mode={want}', all=False)
+        self.close_read_pool()
+        if current == 'wal':
+            self.read_pool = ReadConnectionPool(self.dbpath, self.mmap_size)
+
+    def close_read_pool(self):
+        if self.read_pool is not None:
+            self.read_pool.close()
+            self.read_pool = None
+
+    @contextmanager
+    def read_connection(self):
+        '''
+        A connection for SQL reads. In WAL mode, this is a read only connection
+        that can be used concurrently with writes on the main connection, unless
+        the current thread is in a transaction on the main connection, in which
+        case the main connection is used so that its changes are visible.
+        '''
+        conn = self.conn
+        pool = self.read_pool
+        if pool is None or conn.in_transaction():
+            yield conn
+            return
+        rconn = pool.get()
+        try:
+            yield rconn
+        finally:
+            pool.put(rconn)
+
+    def execute_read(self, sql, bindings=None):
+        ' Run an SQL query using :meth:`read_connection`, returning all the result rows as a list '
+        with self.read_connection() as conn:
+            return conn.cursor().execute(sql, bindings).fetchall()
+
+    def checkpoint(self, mode='TRUNCATE'):
+        ' Copy the contents of the WAL file into the database, if it is in WAL mode '
+        if self.read_pool is not None and self._conn is not None:
+            with suppress(apsw.BusyError, apsw.LockedError):
+                self._conn.execute(f'PRAGMA main.wal_checkpoint({mode})')
+
     def execute(self, sql, bindings=None):
         try:
             return self.conn.cursor().execute(sql, bindings)
@@ -1402,6 +1523,8 @@ def close(self, force=True, unload_formatter_functions=True):
                     unload_user_template_functions(self.library_id)
                 except Exception:
                     pass
+            self.checkpoint()
+            self.close_read_pool()
             self._conn.close(force)
             del self._conn
             self.is_closed = True
@@ -1580,12 +1703,25 @@ def library_id(self, val):
 
     def last_modified(self):
         ''' Return last modified time as a UTC datetime object '''
-        return utcfromtimestamp(os.stat(self.dbpath).st_mtime)
+        mtime = os.stat(self.dbpath).st_mtime
+        # In WAL mode commits change only the WAL file
+        with suppress(FileNotFoundError):
+            mtime = max(mtime, os.stat(self.dbpath + '-wal').st_mtime)
+        return utcfromtimestamp(mtime)
 
     def read_tables(self):
         '''
         Read all data from the db into the python in-memory tables
         '''
+        key = None
+        if self.tables_cache_path:
+            from calibre.db.tables_cache import database_key, load_tables
+            key = database_key(self.dbpath)
+            if load_tables(self.tables_cache_path, key, self.tables):
+                for table in itervalues(self.tables):
+                    if not table.data_maps:
+                        table.read(self)
+                return
 
         with self.conn:  # Use a single transaction, to ensure nothing modifies the db while we are reading
             for table in itervalues(self.tables):
@@ -1597,6 +1733,16 @@ def read_tables(self):
                     pprint.pprint(table.metadata)
                     raise
 
+        if key is not None:
+            from calibre.db.tables_cache import database_key, save_tables
+            # Only save the tables if nothing changed the database while they were being read
+            if key == database_key(self.dbpath):
+                try:
+                    save_tables(self.tables_cache_path, key, self.tables)
+                except Exception:
+                    import traceback
+                    traceback.print_exc()
+
     def find_path_for_book(self, book_id):
         q = BOOK_ID_PATH_TEMPLATE.format(book_id)
         for author_dir in os.scandir(self.library_path):
@@ -2386,11 +2532,11 @@ def safe_load(val):
         if len(book_ids) == 1:
             bid = next(iter(book_ids))
             ans = {book_id:safe_load(val) for book_id, val in
-                   self.execute('SELECT book, val FROM books_plugin_data WHERE book=? AND name=?', (bid, name))}
+                   self.execute_read('SELECT book, val FROM books_plugin_data WHERE book=? AND name=?', (bid, name))}
             return ans or {bid:default}
 
         ans = {}
-        for book_id, val in self.execute(
+        for book_id, val in self.execute_read(
             'SELECT book, val FROM books_plugin_data WHERE name=?', (name,)):
             if not book_ids or book_id in book_ids:
                 val = safe_load(val)
@@ -2415,10 +2561,11 @@ def mark_book_as_clean(self, book_id):
         self.execute('DELETE FROM metadata_dirtied WHERE book=?', (book_id,))
 
     def get_ids_for_custom_book_data(self, name):
-        return frozenset(r[0] for r in self.execute('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
+        return frozenset(r[0] for r in self.execute_read('SELECT book FROM books_plugin_data WHERE name=?', (name,)))
 
     def annotations_for_book(self, book_id, fmt, user_type, user):
-        yield from annotations_for_book(self.conn, book_id, fmt, user_type, user)
+        with self.read_connection() as conn:
+            yield from annotations_for_book(conn, book_id, fmt, user_type, user)
 
     def save_annotations_list(self, book_id, book_fmt, sync_annots_user, alist):
         conn = self.conn
@@ -2454,7 +2601,9 @@ def search_annotations(self,
         query += f' ORDER BY {fts_table}.rank '
         ls = json.loads
         try:
-            for (rowid, book_id, fmt, user_type, user, annot_data, text) in self.execute(query, tuple(data)):
+            with self.read_connection() as conn:
+                rows = conn.execute(query, tuple(data)).fetchall()
+            for (rowid, book_id, fmt, user_type, user, annot_data, text) in rows:
                 if restrict_to_book_ids is not None and book_id not in restrict_to_book_ids:
                     continue
                 try:
@@ -2476,7 +2625,7 @@ def search_annotations(self,
             raise FTSQueryError(fts_engine_query, query, e)
 
     def all_annotations_for_book(self, book_id, ignore_removed=False):
-        for (fmt, user_type, user, data) in self.execute(
+        for (fmt, user_type, user, data) in self.execute_read(
             'SELECT format, user_type, user, annot_data FROM annotations WHERE book=?', (book_id,)
         ):
             try:
@@ -2540,39 +2689,40 @@ def all_annotations(self, restrict_to_user=None, limit=None, annotation_type=Non
             q += ' WHERE ' + ' AND '.join(restrict_clauses)
         q += ' ORDER BY timestamp DESC '
         count = 0
-        for (rowid, book_id, fmt, user_type, user, annot_data) in self.execute(q, tuple(data)):
-            if restrict_to_book_ids is not None and book_id not in restrict_to_book_ids:
-                continue
-            try:
-                annot = ls(annot_data)
-                atype = annot['type']
-            except Exception:
-                continue
-            if ignore_removed and annot.get('removed'):
-                continue
-            text = ''
-            if atype == 'bookmark':
-                text = annot['title']
-            elif atype == 'highlight':
-                text = annot.get('highlighted_text') or ''
-            yield {
-                'id': rowid,
-                'book_id': book_id,
-                'format': fmt,
-                'user_type': user_type,
-                'user': user,
-                'text': text,
-                'annotation': annot,
-            }
-            count += 1
-            if limit is not None and count >= limit:
-                break
+        with self.read_connection() as conn:
+            for (rowid, book_id, fmt, user_type, user, annot_data) in conn.execute(q, tuple(data)):
+                if restrict_to_book_ids is not None and book_id not in restrict_to_book_ids:
+                    continue
+                try:
+                    annot = ls(annot_data)
+                    atype = annot['type']
+                except Exception:
+                    continue
+                if ignore_removed and annot.get('removed'):
+                    continue
+                text = ''
+                if atype == 'bookmark':
+                    text = annot['title']
+                elif atype == 'highlight':
+                    text = annot.get('highlighted_text') or ''
+                yield {
+                    'id': rowid,
+                    'book_id': book_id,
+                    'format': fmt,
+                    'user_type': user_type,
+                    'user': user,
+                    'text': text,
+                    'annotation': annot,
+                }
+                count += 1
+                if limit is not None and count >= limit:
+                    break
 
     def all_annotation_users(self):
-        return self.execute('SELECT DISTINCT user_type, user FROM annotations')
+        return self.execute_read('SELECT DISTINCT user_type, user FROM annotations')
 
     def all_annotation_types(self):
-        for x in self.execute('SELECT DISTINCT annot_type FROM annotations'):
+        for x in self.execute_read('SELECT DISTINCT annot_type FROM annotations'):
             yield x[0]
 
     def set_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
@@ -2597,7 +2747,7 @@ def dirty_books_with_dirtied_annotations(self):
         return changed
 
     def annotation_count_for_book(self, book_id):
-        for (count,) in self.execute('''
+        for (count,) in self.execute_read('''
                  SELECT count(id) FROM annotations
                  WHERE book=? AND json_extract(annot_data, '$.removed') IS NULL
                  ''', (book_id,)):
@@ -2611,7 +2761,7 @@ def reindex_annotations(self):
         '''.format('annotations_fts', 'annotations_fts_stemmed'))
 
     def conversion_options(self, book_id, fmt):
-        for (data,) in self.conn.get('SELECT data FROM conversion_options WHERE book=? AND format=?', (book_id, fmt.upper())):
+        for (data,) in self.execute_read('SELECT data FROM conversion_options WHERE book=? AND format=?', (book_id, fmt.upper())):
             if data:
                 try:
                     return unpickle_binary_string(bytes(data))
@@ -2658,6 +2808,8 @@ def get_top_level_move_items(self, all_paths):
     def move_library_to(self, all_paths, newloc, progress=(lambda item_name, item_count, total: None), abort=None):
         if not os.path.exists(newloc):
             os.makedirs(newloc)
+        # Only metadata.db is moved, so the WAL file, if any, must be empty
+        self.checkpoint()
         old_dirs, old_files = set(), set()
         items, path_map = self.get_top_level_move_items(all_paths)
         total = len(items) + 1
@@ -2683,6 +2835,7 @@ def move_library_to(self, all_paths, newloc, progress=(lambda item_name, item_co
 
         dbpath = os.path.join(newloc, os.path.basename(self.dbpath))
         odir = self.library_path
+        self.close_read_pool()
         self.conn.close()
         self.library_path, self.dbpath = newloc, dbpath
         if self._conn is not None:
@@ -2708,11 +2861,16 @@ def move_library_to(self, all_paths, newloc, progress=(lambda item_name, item_co
         progress(_('Completed'), total, total)
 
     def _backup_database(self, path, name, extra_sql=''):
+        if name == 'main':
+            self.checkpoint('PASSIVE')
         with closing(apsw.Connection(path)) as dest_db:
             with dest_db.backup('main', self.conn, name) as b:
                 while not b.done:
                     with suppress(apsw.BusyError):
                         b.step(128)
+            # The copy inherits WAL mode from the source, a backup should be a
+            # single self contained file
+            dest_db.execute('PRAGMA journal_mode=DELETE')
             if extra_sql:
                 dest_db.cursor().execute(extra_sql)
 
@@ -20,24 +20,27 @@
 from queue import Queue
 from threading import Lock
 from time import mktime, monotonic, sleep, time
+from types import GeneratorType, MethodType
 from typing import NamedTuple
 
+import apsw
+
 from calibre import as_unicode, detect_ncpus, isbytestring
 from calibre.constants import iswindows, preferred_encoding
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postadd, run_plugins_on_postdelete, run_plugins_on_postimport
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.annotations import merge_annotations
-from calibre.db.categories import get_categories
+from calibre.db.categories import CategoryCache, get_categories
 from calibre.db.constants import COVER_FILE_NAME, DATA_DIR_NAME, NOTES_DIR_NAME
-from calibre.db.errors import NoSuchBook, NoSuchFormat
-from calibre.db.fields import IDENTITY, InvalidLinkTable, create_field
+from calibre.db.errors import NoSuchBook, NoSuchFormat, SnapshotIsReadOnly
+from calibre.db.fields import IDENTITY, InvalidLinkTable, OneToOneField, create_field
 from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
 from calibre.db.listeners import EventDispatcher, EventType
-from calibre.db.locking import DowngradeLockError, LockingError, SafeReadLock, create_locks, try_lock
+from calibre.db.locking import DowngradeLockError, LockingError, LockProfile, NullLock, SafeReadLock, create_locks, try_lock
 from calibre.db.notes.connect import copy_marked_up_text
 from calibre.db.search import Search
+from calibre.db.sorting import SortRanks, multisort_by_ranks
 from calibre.db.tables import VirtualTable
-from calibre.db.utils import type_safe_sort_key_function
 from calibre.db.write import get_series_values, uniq
 from calibre.ebooks import check_ebook_format
 from calibre.ebooks.metadata import author_to_author_sort, string_to_authors, title_sort
@@ -51,7 +54,7 @@
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import sort_key
 from calibre.utils.localization import canonicalize_lang
-from polyglot.builtins import cmp, iteritems, itervalues, string_or_bytes
+from polyglot.builtins import iteritems, itervalues, string_or_bytes
 
 
 class ExtraFile(NamedTuple):
@@ -77,6 +80,63 @@ def write_api(f):
     return f
 
 
+def yielding_write_api(f):
+    ''' A write API that does its work in chunks and can give up the write
+    lock between chunks, see Cache.set_write_chunk_size() '''
+    f = write_api(f)
+    f.yields_write_lock = True
+    return f
+
+
+def leaves_tables_unchanged(f):
+    ''' Marks a write API that changes only the database file or other state,
+    never the in-memory tables, so that calling it does not make the snapshot
+    returned by Cache.snapshot() stale. Used for the writes made by background
+    jobs such as metadata backup and full text indexing. '''
+    f.leaves_tables_unchanged = True
+    return f
+
+
+def reports_changed_fields(f):
+    ''' Marks a write API whose changes to the in-memory tables are all
+    reported to clear_search_caches() together with the fields they changed,
+    so that Cache.snapshot() only has to copy the tables of those fields. '''
+    f.reports_changed_fields = True
+    return f
+
+
+def snapshot_is_read_only(name):
+    def write_to_snapshot(*args, **kwargs):
+        raise SnapshotIsReadOnly(f'Cannot call {name}() on a read only snapshot of the library')
+    return write_to_snapshot
+
+
+class LockedBackend:
+
+    ''' The backend used by snapshots. Its methods are called with the read
+    lock of the library held, so that readers using the snapshot never use the
+    database connection while a writer is in the middle of a transaction on it.
+    Results that would be read from the database lazily are read before the
+    lock is released. '''
+
+    def __init__(self, backend, read_lock):
+        self._backend, self._read_lock = backend, read_lock
+
+    def __getattr__(self, name):
+        ans = getattr(self._backend, name)
+        if not isinstance(ans, MethodType):
+            return ans
+
+        @wraps(ans)
+        def call_with_lock(*args, **kwargs):
+            with SafeReadLock(self._read_lock):
+                ret = ans(*args, **kwargs)
+                if isinstance(ret, (GeneratorType, apsw.Cursor)):
+                    ret = iter(tuple(ret))
+                return ret
+        return call_with_lock
+
+
 def wrap_simple(lock, func):
     @wraps(func)
     def call_func_with_lock(*args, **kwargs):
@@ -91,6 +151,63 @@ def call_func_with_lock(*args, **kwargs):
     return call_func_with_lock
 
 
+def wrap_outermost(lock, func):
+    # For write APIs that yield the lock, leave the tables unchanged or report
+    # the fields they change, which they tell the lock by setting flags on it
+    shlock = lock._shlock
+    yields = getattr(func, 'yields_write_lock', False)
+    tables_unchanged = getattr(func, 'leaves_tables_unchanged', False)
+    changes_reported = getattr(func, 'reports_changed_fields', False)
+
+    @wraps(func)
+    def call_func_with_lock(*args, **kwargs):
+        with lock:
+            # Only the outermost holder of the lock may set the flags, callers
+            # that already hold it expect it to be held throughout and may
+            # have changed the tables
+            if shlock.is_exclusive != 1:
+                return func(*args, **kwargs)
+            shlock.tables_unchanged = tables_unchanged
+            shlock.changes_reported = changes_reported
+            shlock.yieldable = yields
+            try:
+                return func(*args, **kwargs)
+            finally:
+                shlock.yieldable = False
+    return call_func_with_lock
+
+
+def wrap_profiled(lock, func, profile):
+    # Note that for APIs that yield the write lock, the hold time includes
+    # the time spent waiting to get it back
+    shlock, is_shared, name = lock._shlock, lock._is_shared, func.__name__
+    yields = getattr(func, 'yields_write_lock', False)
+    tables_unchanged = getattr(func, 'leaves_tables_unchanged', False)
+    changes_reported = getattr(func, 'reports_changed_fields', False)
+
+    @wraps(func)
+    def call_func_with_lock(*args, **kwargs):
+        st = monotonic()
+        try:
+            lock.acquire()
+        except DowngradeLockError:
+            return func(*args, **kwargs)
+        acquired = monotonic()
+        outermost = not is_shared and shlock.is_exclusive == 1
+        if outermost:
+            shlock.tables_unchanged = tables_unchanged
+            shlock.changes_reported = changes_reported
+            shlock.yieldable = yields
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if outermost:
+                shlock.yieldable = False
+            lock.release()
+            profile.record(name, is_shared, acquired - st, monotonic() - acquired)
+    return call_func_with_lock
+
+
 def run_import_plugins(path_or_stream, fmt):
     fmt = fmt.lower()
     if hasattr(path_or_stream, 'seek'):
@@ -146,6 +263,9 @@ class Cache:
     '''
     EventType = EventType
     fts_indexing_sleep_time = 4  # seconds
+    is_snapshot = False
+    snapshot_generation = -1
+    snapshot_of = None
 
     def __init__(self, backend, library_database_instance=None):
         self.shutting_down = False
@@ -170,25 +290,184 @@ def __init__(self, backend, library_database_instance=None):
         self.dirtied_sequence = 0
         self.cover_caches = set()
         self.clear_search_cache_count = 0
+        self.sort_ranks = SortRanks()
+        self.category_cache = CategoryCache()
+
+        self.write_chunk_size = 0
+        self.lock_profile = LockProfile() if os.environ.get('CALIBRE_PROFILE_DB_LOCKS') == '1' else None
+        self.current_snapshot = None
+        self.snapshot_lock = Lock()
+        # The fields changed since the current snapshot was taken, None if
+        # unknown
+        self.snapshot_changes = None
 
         # Implement locking for all simple read/write API methods
         # An unlocked version of the method is stored with the name starting
         # with a leading underscore. Use the unlocked versions when the lock
         # has already been acquired.
+        self.api_names = []
         for name in dir(self):
             func = getattr(self, name)
-            ira = getattr(func, 'is_read_api', None)
-            if ira is not None:
+            if getattr(func, 'is_read_api', None) is not None:
                 # Save original function
                 setattr(self, '_'+name, func)
-                # Wrap it in a lock
-                lock = self.read_lock if ira else self.write_lock
-                setattr(self, name, wrap_simple(lock, func))
+                self.api_names.append(name)
+        self.wrap_api_methods()
 
         self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
         self.initialize_dynamic()
         self.initialize_fts()
 
+    def wrap_api_methods(self):
+        for name in self.api_names:
+            func = getattr(self, '_' + name)
+            lock = self.read_lock if func.is_read_api else self.write_lock
+            if self.lock_profile is not None:
+                wrapped = wrap_profiled(lock, func, self.lock_profile)
+            elif any(getattr(func, x, False) for x in ('yields_write_lock', 'leaves_tables_unchanged', 'reports_changed_fields')):
+                wrapped = wrap_outermost(lock, func)
+            else:
+                wrapped = wrap_simple(lock, func)
+            setattr(self, name, wrapped)
+
+    def set_lock_profiling(self, enabled=True):
+        '''
+        Record how long every API method waits for and holds the database
+        lock, see :meth:`lock_profile_stats`. This slows down every API call
+        a little, so it is off by default. It can also be turned on by setting
+        the environment variable CALIBRE_PROFILE_DB_LOCKS=1.
+        '''
+        if enabled != (self.lock_profile is not None):
+            self.lock_profile = LockProfile() if enabled else None
+            self.wrap_api_methods()
+
+    def lock_profile_stats(self):
+        ' Return the data collected when lock profiling is enabled, keyed by API name, or None '
+        lp = self.lock_profile
+        return None if lp is None else lp.stats()
+
+    def set_write_chunk_size(self, chunk_size=0):
+        '''
+        When non-zero, long running write operations on many books, such as
+        setting a field or removing books, work on at most chunk_size books at
+        a time and let waiting readers and writers have the database lock
+        between chunks. This stops them stalling all other database access
+        for their full duration, at the cost of other threads being able to
+        see the operation partially applied.
+        '''
+        self.write_chunk_size = max(0, int(chunk_size))
+
+    def _should_chunk(self, items):
+        # True if an operation on the books in items should be done in
+        # chunks, must be called with the write lock held
+        return self.write_chunk_size > 0 and self.write_lock._shlock.yieldable and len(items) > self.write_chunk_size
+
+    def _yield_write_lock(self):
+        ' Let other threads waiting for the database lock have it, must be called between chunks of work by a yielding_write_api '
+        shlock = self.write_lock._shlock
+        if shlock.yieldable:
+            shlock.yieldable = False
+            try:
+                shlock.yield_exclusive()
+            finally:
+                shlock.yieldable = True
+
+    def snapshot(self):
+        '''
+        Return a read only snapshot of the in-memory tables of this library. It
+        has the same read API as this object, but needs no locking to read the
+        tables, so readers using it do not hold up writers, and reading the
+        tables from it never waits for writers. Calling a write API on it
+        raises SnapshotIsReadOnly.
+
+        The snapshot is shared by all callers and replaced with a new one on
+        the first call after a change to the tables. That call waits for any
+        writer that is currently changing the library, so that the snapshot
+        always includes changes made before it was called. When the changed
+        fields are known, only their tables are copied, the new snapshot
+        shares the other tables and the cached search results, sort orders and
+        categories that do not depend on the changed fields with the previous
+        one.
+
+        Only the tables are copied. Data read from the database file, such as
+        notes, annotations and preferences, and from the book files is
+        current, not from the time the snapshot was taken. Reading it waits
+        for writers, as for the library itself.
+        '''
+        if self.is_snapshot:
+            return self
+        shlock = self.read_lock._shlock
+        ans = self.current_snapshot
+        if ans is not None and ans.snapshot_generation == shlock.write_generation:
+            return ans
+        try:
+            shlock.acquire(shared=True)
+        except DowngradeLockError:
+            # This thread is changing the tables, use the previous snapshot
+            # if there is one, a new one must not be used by anyone else
+            return self._create_snapshot(-1) if ans is None else ans
+        try:
+            # Replaced while the lock is held so that a snapshot can never
+            # be replaced by an older one
+            with self.snapshot_lock:
+                ans, generation = self.current_snapshot, shlock.write_generation
+                if ans is None or ans.snapshot_generation != generation:
+                    previous, changed_fields = ans, self.snapshot_changes
+                    if previous is None or changed_fields is None or shlock.unreported_generation > previous.snapshot_generation:
+                        previous = changed_fields = None
+                    self.current_snapshot = ans = self._create_snapshot(generation, previous, changed_fields)
+                    self.snapshot_changes = set()
+        finally:
+            shlock.release()
+        return ans
+
+    def _create_snapshot(self, generation, previous=None, changed_fields=None):
+        cls = self.__class__
+        ans = cls.__new__(cls)
+        ans.__dict__.update(self.__dict__)
+        ans.is_snapshot, ans.snapshot_generation, ans.current_snapshot = True, generation, None
+        # Keeps this library open while the snapshot is in use, as the
+        # snapshot reads from its database and book files
+        ans.snapshot_of = self
+        ans.snapshot_database_key = self.database_key()
+        ans.snapshot_lock = ans.snapshot_changes = None
+        ans.read_lock = ans.write_lock = NullLock()
+        ans.backend = LockedBackend(self.backend, self.read_lock)
+        ans.lock_profile, ans.write_chunk_size = None, 0
+        ans.database_instance = ref = weakref.ref(ans)
+        ans.fields = {}
+        for name, field in iteritems(self.fields):
+            table = None
+            if previous is not None and name not in changed_fields and name in previous.fields:
+                # Unchanged, share the already copied table
+                table = previous.fields[name].table
+            ans.fields[name] = field.snapshot(ref, table)
+        for field in itervalues(ans.fields):
+            if getattr(field, 'series_field', None) is not None:
+                field.series_field = ans.fields[field.series_field.name]
+        ans.composites = {name: ans.fields[name] for name in self.composites}
+        ans.dirtied_cache = self.dirtied_cache.copy()
+        ans.format_metadata_cache = defaultdict(dict)
+        ans.formatter_template_cache, ans.link_maps_cache, ans.extra_files_cache = {}, {}, {}
+        ans.vls_for_books_cache = ans.vls_for_books_lib_in_process = None
+        ans.vls_cache_lock = Lock()
+        # The read APIs need no lock, as nothing changes the snapshot
+        for name in self.api_names:
+            func = getattr(cls, name)
+            func = func.__get__(ans, cls) if func.is_read_api else snapshot_is_read_only(name)
+            setattr(ans, name, func)
+            setattr(ans, '_' + name, func)
+        ans.close = snapshot_is_read_only('close')
+        if previous is None:
+            ans.sort_ranks, ans.category_cache = SortRanks(), CategoryCache()
+            ans._search_api = self._search_api.snapshot(ans)
+        else:
+            ans.sort_ranks, ans.category_cache = previous.sort_ranks.copy(), previous.category_cache.copy()
+            ans.sort_ranks.invalidate(changed_fields)
+            ans.category_cache.invalidate(changed_fields)
+            ans._search_api = self._search_api.snapshot(ans, previous._search_api, changed_fields)
+        return ans
+
     @property
     def new_api(self):
         return self
@@ -277,9 +556,17 @@ def clear_composite_caches(self, book_ids=None):
             field.clear_caches(book_ids=book_ids)
 
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, changed_fields=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        if self.snapshot_changes is not None:
+            if book_ids and changed_fields is not None:
+                self.snapshot_changes.update(changed_fields, ('last_modified',))
+            else:
+                self.snapshot_changes = None
+        self._search_api.update_or_clear(self, book_ids, changed_fields)
+        # Updating books also changes their last_modified field
+        self.sort_ranks.invalidate(None if changed_fields is None or not book_ids else set(changed_fields) | {'last_modified'})
+        self.category_cache.invalidate(None if not book_ids else changed_fields)
         self.vls_for_books_cache = None
         self.vls_for_books_lib_in_process = None
 
@@ -294,6 +581,40 @@ def clear_extra_files_cache(self, book_id=None):
     def last_modified(self):
         return self.backend.last_modified()
 
+    def tables_generation(self):
+        '''
+        A number that changes whenever the in-memory tables are changed, for a
+        snapshot, the number when it was taken. Unlike last_modified() it
+        changes only once the change is complete and can be used together with
+        it to identify data generated from the tables.
+        '''
+        return self.snapshot_generation if self.is_snapshot else self.read_lock._shlock.write_generation
+
+    def database_key(self):
+        '''
+        A string that changes whenever the database of this library is
+        changed. Unlike tables_generation() it is the same in every process
+        using the library, so it can be used to identify data generated from
+        the library, for example in ETags. For a snapshot, it also includes the
+        value from when the snapshot was taken, as its tables are from then.
+        '''
+        from calibre.db.tables_cache import database_key
+        try:
+            key = database_key(self.backend.dbpath)
+        except OSError:
+            key = None
+        ans = hashlib.sha1(repr(key).encode()).hexdigest()
+        return f'{self.snapshot_database_key}:{ans}' if self.is_snapshot else ans
+
+    def lock_wait_stats(self):
+        ' Return how often and for how long threads have had to wait for the read and write locks '
+        return self.read_lock._shlock.wait_stats()
+
+    @read_api
+    def search_cache_stats(self):
+        ' Return the number of entries, memory used and the hit/miss counts for the cache of search results '
+        return self._search_api.cache_stats()
+
     @write_api
     def clear_caches(self, book_ids=None, template_cache=True, search_cache=True):
         if template_cache:
@@ -325,6 +646,7 @@ def reload_from_db(self, clear_caches=True):
         with self.backend.conn:  # Prevent other processes, such as calibredb from interrupting the reload by locking the db
             self.backend.prefs.load_from_db()
             self._search_api.saved_searches.load_from_db()
+            self.sort_ranks.clear()
             for field in itervalues(self.fields):
                 if hasattr(field, 'table'):
                     field.table.read(self.backend)  # Reread data from metadata.db
@@ -583,6 +905,7 @@ def loop_while_more_available():
                 break
             loop_while_more_available()
 
+    @leaves_tables_unchanged
     @write_api
     def queue_next_fts_job(self):
         if not self.backend.fts_enabled:
@@ -590,6 +913,7 @@ def queue_next_fts_job(self):
         self.fts_job_queue.put(True)
         self._update_fts_indexing_numbers()
 
+    @leaves_tables_unchanged
     @write_api
     def commit_fts_result(self, book_id, fmt, fmt_size, fmt_hash, text, err_msg, start_time):
         ans = self.backend.commit_fts_result(book_id, fmt, fmt_size, fmt_hash, text, err_msg)
@@ -643,6 +967,7 @@ def set_fts_speed(self, slow=True):
             self._fts_start_measuring_rate()
         return changed
 
+    @leaves_tables_unchanged
     @write_api  # we need to use write locking as SQLITE gives a locked table error if multiple FTS queries are made at the same time
     def fts_search(
         self,
@@ -709,6 +1034,7 @@ def items_with_notes_in_book(self, book_id: int) -> dict[str, dict[int, str]]:
                 ans[k] = v
         return ans
 
+    @leaves_tables_unchanged
     @write_api
     def set_notes_for(self, field, item_id, doc: str, searchable_text: str = copy_marked_up_text, resource_hashes=(), remove_unused_resources=False) -> int:
         '''
@@ -720,6 +1046,7 @@ def set_notes_for(self, field, item_id, doc: str, searchable_text: str = copy_ma
         self.event_dispatcher(EventType.notes_changed, field, frozenset({item_id}))
         return ans
 
+    @leaves_tables_unchanged
     @write_api
     def add_notes_resource(self, path_or_stream_or_data, name: str, mtime: float = None) -> int:
         ' Add the specified resource so it can be referenced by notes and return its content hash '
@@ -735,6 +1062,7 @@ def notes_resources_used_by(self, field, item_id):
         ' Return the set of resource hashes of all resources used by the note for the specified item '
         return frozenset(self.backend.notes_resources_used_by(field, item_id))
 
+    @leaves_tables_unchanged
     @write_api
     def unretire_note_for(self, field, item_id) -> int:
         ' Unretire a previously retired note for the specified item. Notes are retired when an item is removed from the database '
@@ -747,6 +1075,7 @@ def export_note(self, field, item_id) -> str:
         ' Export the note as a single HTML document with embedded images as data: URLs '
         return self.backend.export_note(field, item_id)
 
+    @leaves_tables_unchanged
     @write_api
     def import_note(self, field, item_id, path_to_html_file, path_is_data=False):
         ' Import a previously exported note or an arbitrary HTML file as the note for the specified item '
@@ -764,6 +1093,7 @@ def import_note(self, field, item_id, path_to_html_file, path_is_data=False):
         self.event_dispatcher(EventType.notes_changed, field, frozenset({item_id}))
         return ans
 
+    @leaves_tables_unchanged
     @write_api  # we need to use write locking as SQLITE gives a locked table error if multiple FTS queries are made at the same time
     def search_notes(
         self,
@@ -861,6 +1191,30 @@ def all_field_for(self, field, book_ids, default_value=None):
         field_obj = self.fields[field]
         return {book_id:self._fast_field_for(field_obj, book_id, default_value=default_value) for book_id in book_ids}
 
+    @read_api
+    def fields_for_books(self, fields, book_ids, default_value=None):
+        '''
+        Return the values of all the specified fields for all the specified
+        books, with the lock acquired only once. The result is a mapping of
+        field name to a list of values, in the same order as ``book_ids``. The
+        values are the same as those returned by :meth:`field_for`. Use this
+        instead of :meth:`field_for` or :meth:`get_metadata` when reading a
+        few fields for many books.
+        '''
+        book_ids = tuple(book_ids)
+        ans = {}
+        for name in fields:
+            field_obj = self.fields.get(name)
+            if field_obj is None:
+                ans[name] = [default_value] * len(book_ids)
+            elif type(field_obj) is OneToOneField:
+                m = field_obj.table.book_col_map
+                ans[name] = [m.get(book_id, default_value) for book_id in book_ids]
+            else:
+                ff = self._fast_field_for
+                ans[name] = [ff(field_obj, book_id, default_value) for book_id in book_ids]
+        return ans
+
     @read_api
     def composite_for(self, name, book_id, mi=None, default_value=''):
         try:
@@ -1066,6 +1420,8 @@ def set_pref(self, name, val, namespace=None):
             self.backend.prefs.set_namespaced(namespace, name, val)
             return
         self.backend.prefs.set(name, val)
+        # Some sort keys depend on preferences, such as bools_are_tristate
+        self.sort_ranks.clear()
         if name in ('grouped_search_terms', 'virtual_libraries'):
             self._clear_search_caches()
         if name in dynamic_category_preferences:
@@ -1432,6 +1788,8 @@ def multisort(self, fields, ids_to_sort=None, virtual_fields=None):
         virtual_fields = virtual_fields or {}
 
         fm = {'title':'sort', 'authors':'author_sort'}
+        # Setting title or authors also sets sort or author_sort
+        linked_sort_fields = {'sort':'title', 'author_sort':'authors'}
 
         def sort_key_func(field):
             'Handle series type fields, virtual fields and the id field'
@@ -1452,64 +1810,37 @@ def skf(book_id):
                 return skf
             return func
 
+        def sort_key_deps(field):
+            'The fields whose values the sort keys for field depend on, None if they cannot be cached'
+            f = self.fields.get(field)
+            if f is None or f.is_composite or field == 'ondevice':
+                return None
+            ans = {field, fm.get(field, field), linked_sort_fields.get(field, field)}
+            if field + '_index' in self.fields:
+                ans.add(field + '_index')
+            return ans
+
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
+        ids_to_sort = ids_to_sort if isinstance(ids_to_sort, (tuple, list, frozenset, set)) else tuple(ids_to_sort)
+        all_book_ids = None
+        rank_maps_and_orders = []
+        for field, ascending in fields:
+            keyfunc = sort_key_func(field)
+            if keyfunc is IDENTITY:
+                ranks = None
+            else:
+                deps = sort_key_deps(field)
+                if deps is not None and all_book_ids is None:
+                    all_book_ids = self._all_book_ids()
+                ranks = self.sort_ranks.get(field, deps, keyfunc, ids_to_sort, all_book_ids)
+            rank_maps_and_orders.append((ranks, ascending))
+        return multisort_by_ranks(ids_to_sort, rank_maps_and_orders)
 
-        if len(fields) == 1:
-            keyfunc = sort_key_func(fields[0][0])
-            reverse = not fields[0][1]
-            try:
-                return sorted(ids_to_sort, key=keyfunc, reverse=reverse)
-            except Exception as err:
-                print('Failed to sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
-                try:
-                    return sorted(ids_to_sort, key=type_safe_sort_key_function(keyfunc), reverse=reverse)
-                except Exception as err:
-                    print('Failed to type-safe sort database on field:', fields[0][0], 'with error:', err, file=sys.stderr)
-                    return sorted(ids_to_sort, reverse=reverse)
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
-        orders = tuple(1 if order else -1 for _, order in fields)
-        Lazy = object()  # Lazy load the sort keys for sub-sort fields
-
-        class SortKey:
-
-            __slots__ = 'book_id', 'sort_key'
-
-            def __init__(self, book_id):
-                self.book_id = book_id
-                # Calculate only the first sub-sort key since that will always be used
-                self.sort_key = [key(book_id) if i == 0 else Lazy for i, key in enumerate(sort_key_funcs)]
-
-            def compare_to_other(self, other):
-                for i, (order, self_key, other_key) in enumerate(zip(orders, self.sort_key, other.sort_key)):
-                    if self_key is Lazy:
-                        self_key = self.sort_key[i] = sort_key_funcs[i](self.book_id)
-                    if other_key is Lazy:
-                        other_key = other.sort_key[i] = sort_key_funcs[i](other.book_id)
-                    ans = cmp(self_key, other_key)
-                    if ans != 0:
-                        return ans * order
-                return 0
-
-            def __eq__(self, other):
-                return self.compare_to_other(other) == 0
-
-            def __ne__(self, other):
-                return self.compare_to_other(other) != 0
-
-            def __lt__(self, other):
-                return self.compare_to_other(other) < 0
-
-            def __le__(self, other):
-                return self.compare_to_other(other) <= 0
-
-            def __gt__(self, other):
-                return self.compare_to_other(other) > 0
-
-            def __ge__(self, other):
-                return self.compare_to_other(other) >= 0
-
-        return sorted(ids_to_sort, key=SortKey)
+    @read_api
+    def sort_cache_stats(self):
+        ' Return the number of fields whose sort ranks are cached and the hit/miss counts for the cache '
+        return {'size': len(self.sort_ranks.cache), 'hits': self.sort_ranks.hits, 'misses': self.sort_ranks.misses}
 
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None):
@@ -1526,6 +1857,22 @@ def search(self, query, restriction='', virtual_fields=None, book_ids=None):
         '''
         return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
 
+    @read_api
+    def search_is_stable(self, query):
+        '''
+        Return True if the results of the search query can change only when
+        the library is changed. The results of searches on relative dates,
+        templates, marked books or virtual libraries, for example, can change
+        at any time.
+        '''
+        if not query or not query.strip():
+            return True
+        sqp = self._search_api.create_parser(self)
+        try:
+            return self._search_api.query_is_stable(sqp, self, query.strip())
+        finally:
+            sqp.dbcache = sqp.lookup_saved_search = None
+
     @read_api
     def books_in_virtual_library(self, vl, search_restriction=None, virtual_fields=None):
         ' Return the set of books in the specified virtual library '
@@ -1561,10 +1908,11 @@ def get_categories(self, sort='name', book_ids=None, already_fixed=None,
                 raise
             with self.write_lock:
                 self.fields[bad_field].table.fix_link_table(self.backend)
+                self.category_cache.clear()
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, changed_fields=None):
         if book_ids:
             if now is None:
                 now = nowf()
@@ -1572,11 +1920,11 @@ def update_last_modified(self, book_ids, now=None):
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
             if self.composites:
                 self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+            self._clear_search_caches(book_ids, changed_fields)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, changed_fields=None):
+        self._update_last_modified(book_ids, changed_fields=changed_fields)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1589,6 +1937,7 @@ def mark_as_dirty(self, book_ids):
             self.dirtied_sequence = max(itervalues(new_dirtied)) + 1
             self.dirtied_cache.update(new_dirtied)
 
+    @leaves_tables_unchanged
     @write_api
     def commit_dirty_cache(self):
         if self.dirtied_cache:
@@ -1605,7 +1954,8 @@ def check_dirtied_annotations(self):
             self.dirtied_sequence = max(itervalues(new_dirtied)) + 1
             self.dirtied_cache.update(new_dirtied)
 
-    @write_api
+    @reports_changed_fields
+    @yielding_write_api
     def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_update=True):
         '''
         Set the values of the field specified by ``name``. Returns the set of all book ids that were affected by the change.
@@ -1617,6 +1967,13 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
             both have the tag ``tag1``.
         :param do_path_update: Used internally, you should never change it.
         '''
+        if self._should_chunk(book_id_to_val_map):
+            dirtied, items, n = set(), tuple(iteritems(book_id_to_val_map)), self.write_chunk_size
+            for i in range(0, len(items), n):
+                if i:
+                    self._yield_write_lock()
+                dirtied |= self._set_field(name, dict(items[i:i+n]), allow_case_change=allow_case_change, do_path_update=do_path_update)
+            return dirtied
         f = self.fields[name]
         is_series = f.metadata['datatype'] == 'series'
         update_path = name in {'title', 'authors'}
@@ -1643,14 +2000,22 @@ def set_field(self, name, book_id_to_val_map, allow_case_change=True, do_path_up
         dirtied = f.writer.set_books(
             book_id_to_val_map, self.backend, allow_case_change=allow_case_change)
 
+        changed_fields = {name}
+        # The title and authors writers also update the linked sort fields
+        linked_sort_field = {'title': 'sort', 'authors': 'author_sort'}.get(name)
+        if linked_sort_field is not None:
+            changed_fields.add(linked_sort_field)
         if is_series and simap:
             sf = self.fields[f.name+'_index']
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
+            changed_fields.add(sf.name)
 
         if dirtied:
             if update_path and do_path_update:
                 self._update_path(dirtied, mark_as_dirtied=False)
-            self._mark_as_dirty(dirtied)
+                # The names of the format files depend on the path
+                changed_fields |= {'path', 'formats'}
+            self._mark_as_dirty(dirtied, changed_fields=changed_fields)
             self._clear_link_map_cache(dirtied)
             self.event_dispatcher(EventType.metadata_changed, name, dirtied)
         return dirtied
@@ -1703,6 +2068,7 @@ def get_metadata_for_dump(self, book_id):
                 traceback.print_exc()
         return mi, sequence
 
+    @leaves_tables_unchanged
     @write_api
     def clear_dirtied(self, book_id, sequence):
         # Clear the dirtied indicator for the books. This is used when fetching
@@ -1713,6 +2079,7 @@ def clear_dirtied(self, book_id, sequence):
             self.backend.mark_book_as_clean(book_id)
             self.dirtied_cache.pop(book_id, None)
 
+    @leaves_tables_unchanged
     @write_api
     def write_backup(self, book_id, raw):
         try:
@@ -1740,7 +2107,8 @@ def read_backup(self, book_id):
         except OSError:
             return None
 
-    @write_api
+    @leaves_tables_unchanged
+    @yielding_write_api
     def dump_metadata(self, book_ids=None, remove_from_dirtied=True,
             callback=None):
         # Write metadata for each record to an individual OPF file. If callback
@@ -1753,7 +2121,10 @@ def dump_metadata(self, book_ids=None, remove_from_dirtied=True,
         if callback is not None:
             callback(len(book_ids), True, False)
 
-        for book_id in book_ids:
+        chunk_size = self.write_chunk_size if self._should_chunk(book_ids) else 0
+        for i, book_id in enumerate(book_ids):
+            if chunk_size and i and i % chunk_size == 0:
+                self._yield_write_lock()
             if self._field_for('path', book_id) is None:
                 if callback is not None:
                     callback(book_id, None, False)
@@ -2157,6 +2528,9 @@ def create_book_entry(self, mi, cover=None, add_duplicates=True, force_id=None,
                          (force_id, mi.title, series_index, aus))
         book_id = self.backend.last_insert_rowid()
         self.event_dispatcher(EventType.book_created, book_id)
+        # The id of a deleted book can be re-used, so cached sort ranks for it
+        # would be wrong
+        self.sort_ranks.clear()
 
         mi.timestamp = utcnow() if (mi.timestamp is None or is_date_undefined(mi.timestamp)) else mi.timestamp
         mi.pubdate = UNDEFINED_DATE if mi.pubdate is None else mi.pubdate
@@ -2208,11 +2582,18 @@ def add_books(self, books, add_duplicates=True, apply_import_tags=True, preserve
                 run_plugins_on_postadd(dbapi or self, book_id, fmt_map)
         return ids, duplicates
 
-    @write_api
+    @yielding_write_api
     def remove_books(self, book_ids, permanent=False):
         ''' Remove the books specified by the book_ids from the database and delete
         their format files. If ``permanent`` is False, then the format files
         are placed in the per-library trash directory. '''
+        if self._should_chunk(book_ids):
+            book_ids, n = tuple(book_ids), self.write_chunk_size
+            for i in range(0, len(book_ids), n):
+                if i:
+                    self._yield_write_lock()
+                self._remove_books(book_ids[i:i+n], permanent=permanent)
+            return
         path_map = {}
         for book_id in book_ids:
             try:
@@ -2373,6 +2754,7 @@ def remove_items(self, field, item_ids, restrict_to_book_ids=None):
         self.event_dispatcher(EventType.items_removed, field, affected_books, item_ids)
         return affected_books
 
+    @leaves_tables_unchanged
     @write_api
     def add_custom_book_data(self, name, val_map, delete_first=False):
         ''' Add data for name where val_map is a map of book_ids to values. If
@@ -2391,6 +2773,7 @@ def get_custom_book_data(self, name, book_ids=(), default=None):
         default for it. '''
         return self.backend.get_custom_book_data(name, book_ids, default)
 
+    @leaves_tables_unchanged
     @write_api
     def delete_custom_book_data(self, name, book_ids=()):
         ''' Delete data for name. By default deletes all data, if you only want
@@ -2410,10 +2793,12 @@ def conversion_options(self, book_id, fmt='PIPE'):
     def has_conversion_options(self, ids, fmt='PIPE'):
         return self.backend.has_conversion_options(ids, fmt)
 
+    @leaves_tables_unchanged
     @write_api
     def delete_conversion_options(self, book_ids, fmt='PIPE'):
         return self.backend.delete_conversion_options(book_ids, fmt)
 
+    @leaves_tables_unchanged
     @write_api
     def set_conversion_options(self, options, fmt='PIPE'):
         ''' options must be a map of the form {book_id:conversion_options} '''
@@ -2847,6 +3232,7 @@ def close(self):
         self._shutdown_fts(stage=2)
         with self.write_lock:
             self.backend.close()
+            self.current_snapshot = None
 
     @property
     def is_closed(self):
@@ -2891,6 +3277,7 @@ def move_format_from_trash(self, book_id, fmt):
         self.format_metadata_cache.pop(book_id, None)
         max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
         self.fields['size'].table.update_sizes({book_id: max_size})
+        self.category_cache.invalidate({'formats'})
         self.event_dispatcher(EventType.format_added, book_id, fmt)
         self.backend.remove_trash_formats_dir_if_empty(book_id)
 
@@ -2915,6 +3302,7 @@ def move_book_from_trash(self, book_id):
         for (fmt, size, fname) in formats:
             max_size = max(max_size, f.update_fmt(book_id, fmt, fname, size, self.backend))
         self.fields['size'].table.update_sizes({book_id: max_size})
+        self.category_cache.invalidate({'formats'})
         cover = self.backend.cover_abspath(book_id, path)
         if cover and os.path.exists(cover):
             self._set_field('cover', {book_id:1})
@@ -3026,7 +3414,7 @@ def user_categories_for_books(self, book_ids, proxy_metadata_map=None):
                         res.append([name, cat])
         return ans
 
-    @write_api
+    @yielding_write_api
     def embed_metadata(self, book_ids, only_fmts=None, report_error=None, report_progress=None):
         ''' Update metadata in all formats of the specified book_ids to current metadata in the database. '''
         field = self.fields['formats']
@@ -3042,7 +3430,10 @@ def doit(fmt, mi, stream):
             stream.seek(0, os.SEEK_END)
             return stream.tell()
 
+        chunk_size = self.write_chunk_size if self._should_chunk(book_ids) else 0
         for i, book_id in enumerate(book_ids):
+            if chunk_size and i and i % chunk_size == 0:
+                self._yield_write_lock()
             fmts = field.table.book_col_map.get(book_id, ())
             if not fmts:
                 continue
@@ -3096,12 +3487,13 @@ def doit(fmt, mi, stream):
     def get_last_read_positions(self, book_id, fmt, user):
         fmt = fmt.upper()
         ans = []
-        for device, cfi, epoch, pos_frac in self.backend.execute(
+        for device, cfi, epoch, pos_frac in self.backend.execute_read(
                 'SELECT device,cfi,epoch,pos_frac FROM last_read_positions WHERE book=? AND format=? AND user=?',
                 (book_id, fmt, user)):
             ans.append({'device':device, 'cfi': cfi, 'epoch':epoch, 'pos_frac':pos_frac})
         return ans
 
+    @leaves_tables_unchanged
     @write_api
     def set_last_read_position(self, book_id, fmt, user='_', device='_', cfi=None, epoch=None, pos_frac=0):
         fmt = fmt.upper()
@@ -3265,6 +3657,7 @@ def search_annotations(
             ignore_removed
         ))
 
+    @leaves_tables_unchanged
     @write_api
     def delete_annotations(self, annot_ids):
         '''
@@ -3272,6 +3665,7 @@ def delete_annotations(self, annot_ids):
         '''
         self.backend.delete_annotations(annot_ids)
 
+    @leaves_tables_unchanged
     @write_api
     def update_annotations(self, annot_id_map):
         '''
@@ -3279,6 +3673,7 @@ def update_annotations(self, annot_id_map):
         '''
         self.backend.update_annotations(annot_id_map)
 
+    @leaves_tables_unchanged
     @write_api
     def restore_annotations(self, book_id, annotations):
         from calibre.utils.date import EPOCH
@@ -3292,6 +3687,7 @@ def restore_annotations(self, book_id, annotations):
         for (user_type, user, fmt), annots_list in iteritems(umap):
             self._set_annotations_for_book(book_id, fmt, annots_list, user_type=user_type, user=user)
 
+    @leaves_tables_unchanged
     @write_api
     def set_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
         '''
@@ -3299,6 +3695,7 @@ def set_annotations_for_book(self, book_id, fmt, annots_list, user_type='local',
         '''
         self.backend.set_annotations_for_book(book_id, fmt, annots_list, user_type, user)
 
+    @leaves_tables_unchanged
     @write_api
     def merge_annotations_for_book(self, book_id, fmt, annots_list, user_type='local', user='viewer'):
         '''
@@ -3315,10 +3712,12 @@ def merge_annotations_for_book(self, book_id, fmt, annots_list, user_type='local
                 alist.append((annot, ts))
         self._set_annotations_for_book(book_id, fmt, alist, user_type=user_type, user=user)
 
+    @leaves_tables_unchanged
     @write_api
     def save_annotations_list(self, book_id: int, book_fmt: str, sync_annots_user: str, alist: list[dict]) -> None:
         self.backend.save_annotations_list(book_id, book_fmt, sync_annots_user, alist)
 
+    @leaves_tables_unchanged
     @write_api
     def reindex_annotations(self):
         self.backend.reindex_annotations()
@@ -8,6 +8,7 @@
 import copy
 from collections import OrderedDict
 from functools import partial
+from threading import Lock
 
 from calibre.ebooks.metadata import author_to_author_sort
 from calibre.utils.config_base import prefs, tweaks
@@ -73,6 +74,13 @@ def __repr__(self):
     def as_dict(self):
         return {k: getattr(self, k) for k in self.__slots__}
 
+    def copy(self):
+        ' A shallow copy, the id_set is shared '
+        ans = type(self).__new__(type(self))
+        for k in self.__slots__:
+            setattr(ans, k, getattr(self, k))
+        return ans
+
     @classmethod
     def from_dict(cls, d):
         ans = cls('')
@@ -81,6 +89,63 @@ def from_dict(cls, d):
         return ans
 
 
+class CategoryCache:
+
+    ''' A cache of the items in each category, so that after a change only the
+    categories that depend on the changed fields have to be recomputed. Items
+    are cached for a few different sets of books per category, for
+    restrictions and virtual libraries. '''
+
+    BOOK_SETS_PER_CATEGORY = 8
+
+    def __init__(self):
+        self.lock = Lock()
+        self.cache = {}
+        self.hits = self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def copy(self):
+        ans = CategoryCache()
+        with self.lock:
+            ans.cache = {category: c.copy() for category, c in iteritems(self.cache)}
+        return ans
+
+    def invalidate(self, changed_fields=None):
+        with self.lock:
+            # Ratings are used for the average rating of items in every
+            # category and languages for the sort value of series
+            if changed_fields is None or 'rating' in changed_fields or 'languages' in changed_fields:
+                self.cache.clear()
+                return
+            for category in tuple(self.cache):
+                if (category == 'news' and 'tags' in changed_fields) or category in changed_fields:
+                    del self.cache[category]
+
+    def get(self, category, book_ids):
+        ' Return copies of the cached items, as callers modify them, or None '
+        with self.lock:
+            items = self.cache.get(category, {}).get(book_ids)
+            if items is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.cache[category].move_to_end(book_ids)
+        return [t.copy() for t in items]
+
+    def set(self, category, book_ids, items):
+        ' Cache items, which must not be modified after this call '
+        with self.lock:
+            c = self.cache.get(category)
+            if c is None:
+                c = self.cache[category] = OrderedDict()
+            c[book_ids] = items
+            if len(c) > self.BOOK_SETS_PER_CATEGORY:
+                c.popitem(last=False)
+
+
 def find_categories(field_metadata):
     for category, cat in field_metadata.iter_items():
         if (cat['is_category'] and cat['kind'] not in {'user', 'search'}):
@@ -217,7 +282,7 @@ def get_categories(dbcache, sort='name', book_ids=None, first_letter_sort=False,
     lang_map = dbcache.fields['languages'].book_value_map
 
     categories = OrderedDict()
-    book_ids = frozenset(book_ids) if book_ids else book_ids
+    book_ids = frozenset(book_ids) if book_ids is not None else None
     pm_cache = {}
 
     def get_metadata(book_id):
@@ -228,6 +293,7 @@ def get_metadata(book_id):
 
     bids = None
     uncollapsed_categories = () if uncollapsed_categories is None else uncollapsed_categories
+    category_cache = dbcache.category_cache
 
     for category, is_multiple, is_composite in find_categories(fm):
         fl_sort = False if category in uncollapsed_categories else bool(first_letter_sort)
@@ -239,7 +305,11 @@ def get_metadata(book_id):
             cats = dbcache.fields[category].get_composite_categories(
                 tag_class, book_rating_map, bids, is_multiple, get_metadata)
         elif category == 'news':
-            cats = dbcache.fields['tags'].get_news_category(tag_class, book_ids)
+            cats = category_cache.get(category, book_ids)
+            if cats is None:
+                cats = dbcache.fields['tags'].get_news_category(tag_class, book_ids)
+                category_cache.set(category, book_ids, cats)
+                cats = [t.copy() for t in cats]
         else:
             cat = fm[category]
             brm = book_rating_map
@@ -249,8 +319,14 @@ def get_metadata(book_id):
                     brm = dbcache.fields[category].book_value_map
                 if sort_on == 'name':
                     sort_on, reverse = 'rating', True
-            cats = dbcache.fields[category].get_categories(
-                tag_class, brm, lang_map, book_ids)
+            cats = category_cache.get(category, book_ids)
+            if cats is None:
+                # Only the categories for fields that have changed since they
+                # were last computed need to be recomputed
+                cats = dbcache.fields[category].get_categories(
+                    tag_class, brm, lang_map, book_ids)
+                category_cache.set(category, book_ids, cats)
+                cats = [t.copy() for t in cats]
             if (category != 'authors' and dt == 'text' and
                 cat['is_multiple'] and cat['display'].get('is_names', False)):
                 for item in cats:
@@ -265,7 +341,8 @@ def get_metadata(book_id):
     for r in categories['rating']:
         for x in tuple(categories['rating']):
             if r.name == x.name and r.id != x.id:
-                r.id_set |= x.id_set
+                # Not an in place union as the id_set is shared with the cache
+                r.id_set = r.id_set | x.id_set
                 r.count = len(r.id_set)
                 categories['rating'].remove(x)
                 break
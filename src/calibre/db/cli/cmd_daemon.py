@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+
+from calibre import prints
+from calibre.constants import iswindows
+
+readonly = False
+version = 0  # change this if you change signature of implementation()
+no_remote = True
+
+
+def implementation(db, notify_changes, *args):
+    raise NotImplementedError()
+
+
+def option_parser(get_parser, args):
+    parser = get_parser(
+        _(
+            '''\
+%prog daemon [options]
+
+Keep the library open and run the calibredb commands for it, until stopped.
+While the daemon is running, all calibredb commands for the library are
+automatically run by it, which makes them much faster, as the library does
+not have to be opened for every command. Useful for scripts that run
+calibredb many times. Commands that cannot be used with libraries on a
+calibre Content server cannot be used while the daemon is running.
+'''
+        )
+    )
+    parser.add_option(
+        '--stop',
+        default=False,
+        action='store_true',
+        help=_('Stop the daemon that is running for the library')
+    )
+    parser.add_option(
+        '--idle-timeout',
+        default=0,
+        type=float,
+        help=_('Stop the daemon if no commands are run for the specified number of seconds.'
+               ' The default is to never stop.')
+    )
+    return parser
+
+
+def main(opts, args, dbctx):
+    if iswindows:
+        raise SystemExit(_('The calibredb daemon is not supported on Windows'))
+    if opts.stop:
+        if dbctx.daemon is None:
+            raise SystemExit(_('No calibredb daemon is running for the library at: {}').format(dbctx.library_path))
+        dbctx.daemon.shutdown()
+        return 0
+    if dbctx.daemon is not None:
+        raise SystemExit(_('A calibredb daemon is already running for the library at: {}').format(dbctx.library_path))
+    from calibre.db.cli.daemon import Daemon, daemon_address
+    daemon = Daemon(dbctx.db.new_api, daemon_address(dbctx.library_path), idle_timeout=max(0, opts.idle_timeout))
+    prints(_('Running commands for the library at: {}, press Ctrl-C to stop').format(dbctx.library_path))
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dbctx.db.close()
+    return 0
@@ -66,6 +66,7 @@ def implementation(
             book_ids = book_ids[:limit]
         data = {}
         metadata = {}
+        plain_fields = []
         for field in fields:
             if field in 'id':
                 continue
@@ -96,7 +97,12 @@ def implementation(
                 if field == 'cover':
                     data[field] = {k: cover(db, k) for k in book_ids}
                     continue
-            data[field] = db.all_field_for(field, book_ids)
+            data[field] = None  # filled in below, to preserve the order of fields
+            plain_fields.append(field)
+        if plain_fields:
+            # Read all simple fields for all books in one pass
+            for field, values in iteritems(db.fields_for_books(plain_fields, book_ids)):
+                data[field] = dict(zip(book_ids, values))
     return {'book_ids': book_ids, 'data': data, 'metadata': metadata, 'fields':fields}
 
 
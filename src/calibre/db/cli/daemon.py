@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# A daemon that keeps a library open and runs calibredb commands sent to it
+# over a local socket, so that scripts that run calibredb many times do not
+# pay the cost of opening the library for every command. Commands are run
+# exactly as for a library on a Content server, see srv/cdb.py, with the same
+# msgpack encoded arguments and results. Each message is prefixed by its
+# length.
+
+import hashlib
+import os
+import socket
+import struct
+import traceback
+from contextlib import suppress
+
+from calibre import as_unicode
+from calibre.constants import islinux, iswindows
+from calibre.db.cli import module_for_cmd
+from calibre.utils.ipc import socket_address
+from calibre.utils.serialize import msgpack_dumps, msgpack_loads
+
+HEADER = struct.Struct('!I')
+
+
+def daemon_address(library_path):
+    q = hashlib.sha1(os.path.normcase(os.path.abspath(library_path)).encode('utf-8')).hexdigest()[:16]
+    return socket_address('calibredb-' + q)
+
+
+def send_raw(sock, raw):
+    sock.sendall(HEADER.pack(len(raw)) + raw)
+
+
+def recv_exactly(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(min(n - len(buf), 1024 * 1024))
+        if not chunk:
+            raise EOFError('The connection was closed')
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_msg(sock):
+    n = HEADER.unpack(recv_exactly(sock, HEADER.size))[0]
+    return msgpack_loads(recv_exactly(sock, n))
+
+
+def peer_is_same_user(conn):
+    if islinux:
+        # Sockets in the abstract namespace have no permissions
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1] == os.getuid()
+    return True  # The socket file is readable only by the current user
+
+
+def notify_changes(changes):
+    pass  # There is nobody to notify, as no other program can have the library open
+
+
+class Daemon:
+
+    def __init__(self, db, address, idle_timeout=0):
+        self.db, self.address, self.idle_timeout = db, address, idle_timeout
+        self.keep_going = True
+
+    def serve(self):
+        ' Run commands until told to shutdown or no command is received for idle_timeout seconds '
+        is_file = not self.address.startswith('\0')
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            if is_file:
+                with suppress(FileNotFoundError):
+                    os.remove(self.address)  # left over from a daemon that crashed
+            s.bind(self.address)
+            try:
+                if is_file:
+                    os.chmod(self.address, 0o600)
+                s.listen(16)
+                s.settimeout(self.idle_timeout or None)
+                while self.keep_going:
+                    try:
+                        conn = s.accept()[0]
+                    except TimeoutError:
+                        break
+                    with conn:
+                        conn.settimeout(None)
+                        if peer_is_same_user(conn):
+                            self.handle_connection(conn)
+            finally:
+                if is_file:
+                    with suppress(OSError):
+                        os.remove(self.address)
+
+    def handle_connection(self, conn):
+        # Connections are handled one at a time, so commands run one after
+        # the other, as they would if calibredb was run repeatedly
+        while True:
+            try:
+                req = recv_msg(conn)
+            except (EOFError, OSError):
+                return
+            if req.get('shutdown'):
+                self.keep_going = False
+                ans = {'result': None}
+            else:
+                ans = self.run(req['cmd'], req['version'], req['args'])
+            try:
+                raw = msgpack_dumps(ans)
+            except Exception as err:
+                raw = msgpack_dumps({'err': as_unicode(err), 'tb': traceback.format_exc()})
+            try:
+                send_raw(conn, raw)
+            except OSError:
+                return
+
+    def run(self, name, version, args):
+        try:
+            m = module_for_cmd(name)
+            if getattr(m, 'no_remote', False):
+                raise ValueError(f'The {name} command cannot be run by the calibredb daemon')
+            if getattr(m, 'version', 0) != version:
+                raise ValueError(f'The command {name} is not available in version: {version}.'
+                                 ' Make sure the version of calibre used for the daemon and calibredb match')
+            return {'result': m.implementation(self.db, notify_changes, *args)}
+        except Exception as err:
+            tb = ''
+            if not getattr(err, 'suppress_traceback', False):
+                tb = traceback.format_exc()
+            return {'err': as_unicode(err), 'tb': tb}
+
+
+class DaemonClient:
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def request(self, data):
+        try:
+            send_raw(self.sock, msgpack_dumps(data))
+            return recv_msg(self.sock)
+        except (EOFError, OSError) as err:
+            raise SystemExit(f'Lost connection to the calibredb daemon with error: {as_unicode(err)}')
+
+    def run(self, name, m, *args):
+        return self.request({'cmd': name, 'version': getattr(m, 'version', 0), 'args': args})
+
+    def shutdown(self):
+        self.request({'shutdown': True})
+
+    def close(self):
+        self.sock.close()
+
+
+def connect_to_daemon(library_path):
+    ' Return a DaemonClient for the daemon running for library_path or None if there is no such daemon '
+    if iswindows:
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(daemon_address(library_path))
+    except OSError:
+        s.close()
+        return None
+    return DaemonClient(s)
@@ -8,7 +8,6 @@
 from calibre import browser, prints
 from calibre.constants import __appname__, __version__, iswindows
 from calibre.db.cli import module_for_cmd
-from calibre.db.legacy import LibraryDatabase
 from calibre.utils.config import OptionParser, prefs
 from calibre.utils.localization import localize_user_manual_link
 from calibre.utils.lock import singleinstance
@@ -21,7 +20,7 @@
     'set_metadata', 'export', 'catalog', 'saved_searches', 'add_custom_column',
     'custom_columns', 'remove_custom_column', 'set_custom', 'restore_database',
     'check_library', 'list_categories', 'backup_metadata', 'clone', 'embed_metadata',
-    'search', 'fts_index', 'fts_search',
+    'search', 'fts_index', 'fts_search', 'daemon',
 )
 
 
@@ -36,7 +35,11 @@ def cmd_option_parser():
 def run_cmd(cmd, opts, args, dbctx):
     m = module_for_cmd(cmd)
     if dbctx.is_remote and getattr(m, 'no_remote', False):
-        raise SystemExit(_('The {} command is not supported with remote (server based) libraries').format(cmd))
+        if dbctx.daemon is None:
+            raise SystemExit(_('The {} command is not supported with remote (server based) libraries').format(cmd))
+        if cmd != 'daemon':
+            raise SystemExit(_('The {} command cannot be used while the calibredb daemon is running for the library.'
+                               ' Stop it with: calibredb daemon --stop').format(cmd))
     ret = m.main(opts, args, dbctx)
     return ret
 
@@ -130,7 +133,7 @@ def __init__(self, opts, option_parser):
         self.option_parser = option_parser
         self.library_path = opts.library_path or prefs['library_path']
         self.timeout = opts.timeout
-        self.url = None
+        self.url = self.daemon = None
         if self.library_path is None:
             raise SystemExit(
                 'No saved library path, either run the GUI or use the'
@@ -152,7 +155,14 @@ def __init__(self, opts, option_parser):
                 raise SystemExit()
         else:
             self.library_path = os.path.expanduser(self.library_path)
-            if not singleinstance('db'):
+            self._db = None
+            self.is_remote = False
+            from calibre.db.cli.daemon import connect_to_daemon
+            self.daemon = connect_to_daemon(self.library_path)
+            if self.daemon is not None:
+                # The daemon runs commands the same way as a Content server does
+                self.is_remote = True
+            elif not singleinstance('db'):
                 ext = '.exe' if iswindows else ''
                 raise SystemExit(_(
                     'Another calibre program such as {} or the main calibre program is running.'
@@ -162,12 +172,11 @@ def __init__(self, opts, option_parser):
                     ' See the documentation of the {} option for details.'
                 ).format('calibre-server' + ext, '--with-library')
                 )
-            self._db = None
-            self.is_remote = False
 
     @property
     def db(self):
         if self._db is None:
+            from calibre.db.legacy import LibraryDatabase
             self._db = LibraryDatabase(self.library_path)
         return self._db
 
@@ -179,6 +188,8 @@ def path(self, path):
 
     def run(self, name, *args):
         m = module_for_cmd(name)
+        if self.daemon is not None:
+            return self.daemon_run(name, m, *args)
         if self.is_remote:
             return self.remote_run(name, m, *args)
         return m.implementation(self.db.new_api, None, *args)
@@ -214,6 +225,14 @@ def remote_run(self, name, m, *args):
             raise SystemExit(ans['err'])
         return ans['result']
 
+    def daemon_run(self, name, m, *args):
+        ans = self.daemon.run(name, m, *args)
+        if 'err' in ans:
+            if ans['tb']:
+                prints(ans['tb'])
+            raise SystemExit(ans['err'])
+        return ans['result']
+
     def list_libraries(self):
         from mechanize import HTTPError
         url = self.url + '/ajax/library-info'
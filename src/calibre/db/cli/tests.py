@@ -10,6 +10,7 @@
 import csv
 import unittest
 
+from calibre.constants import iswindows
 from calibre.db.cli.cmd_check_library import _print_check_library_results
 from polyglot.builtins import iteritems
 from polyglot.io import PolyglotBytesIO
@@ -90,5 +91,51 @@ def test_escaped_csv_output(self):
         self.assertEqual(parsed_result, [[self.check[1], data[0][0], data[0][1]]])
 
 
+class DaemonTest(unittest.TestCase):
+
+    @unittest.skipIf(iswindows, 'The calibredb daemon is not supported on Windows')
+    def test_daemon(self):
+        '''
+        Run commands in the calibredb daemon
+        '''
+        import tempfile
+        import time
+        from threading import Thread
+
+        from calibre.db.cli import module_for_cmd
+        from calibre.db.cli.daemon import Daemon, connect_to_daemon, daemon_address
+        from calibre.db.legacy import LibraryDatabase
+        from calibre.ebooks.metadata.book.base import Metadata
+        with tempfile.TemporaryDirectory() as tdir:
+            db = LibraryDatabase(tdir)
+            book_id = db.new_api.create_book_entry(Metadata('Daemon test', ['Some author']))
+            self.assertIsNone(connect_to_daemon(tdir))
+            t = Thread(target=Daemon(db.new_api, daemon_address(tdir)).serve, daemon=True)
+            t.start()
+            for i in range(500):
+                client = connect_to_daemon(tdir)
+                if client is not None:
+                    break
+                time.sleep(0.01)
+            self.assertIsNotNone(client)
+
+            def run(cmd, *args):
+                return client.run(cmd, module_for_cmd(cmd), *args)
+
+            self.assertEqual(run('search', 'title:"=Daemon test"'), {'result': {book_id}})
+            mi = run('set_metadata', 'fields', book_id, [('title', 'Changed'), ('tags', ['one', 'two'])])['result']
+            self.assertEqual(mi.title, 'Changed')
+            self.assertEqual(db.new_api.field_for('tags', book_id), ('one', 'two'))
+            self.assertIn('err', run('search', 'title:"unterminated'))
+            self.assertIn('err', run('backup_metadata'))
+            client.shutdown()
+            client.close()
+            t.join()
+            self.assertIsNone(connect_to_daemon(tdir))
+            db.close()
+
+
 def find_tests():
-    return unittest.defaultTestLoader.loadTestsFromTestCase(PrintCheckLibraryResultsTest)
+    ans = unittest.defaultTestLoader.loadTestsFromTestCase(PrintCheckLibraryResultsTest)
+    ans.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(DaemonTest))
+    return ans
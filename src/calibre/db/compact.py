@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# Compact, array backed replacements for the book_id -> value dicts used by the
+# in-memory tables. They behave like dicts, so the fields and writers need no
+# changes, but store values in dense arrays indexed by book id instead of as
+# Python objects in a hash table, which uses much less memory for large
+# libraries. Enabled via the compact_in_memory_tables tweak.
+
+from array import array
+from collections.abc import MutableMapping
+from datetime import datetime, timedelta
+
+from calibre.utils.date import utc_tz
+
+ABSENT, PRESENT, NONE, EXTRA = range(4)
+EPOCH = datetime(1970, 1, 1, tzinfo=utc_tz)
+ONE_MICROSECOND = timedelta(microseconds=1)
+null = object()
+
+
+def encode_int(val):
+    if type(val) is not int:
+        raise TypeError('Not an int')
+    return val
+
+
+def encode_float(val):
+    if type(val) is not float:
+        raise TypeError('Not a float')
+    return val
+
+
+def encode_bool(val):
+    if type(val) is not bool:
+        raise TypeError('Not a bool')
+    return int(val)
+
+
+def encode_datetime(val):
+    if type(val) is not datetime or val.tzinfo is not utc_tz:
+        raise TypeError('Not a UTC datetime')
+    return (val - EPOCH) // ONE_MICROSECOND
+
+
+def decode_datetime(val):
+    return EPOCH + timedelta(microseconds=val)
+
+
+codecs = {
+    # datatype: (typecode, encode, decode)
+    'int': ('q', encode_int, None),
+    'float': ('d', encode_float, None),
+    'bool': ('b', encode_bool, bool),
+    'datetime': ('q', encode_datetime, decode_datetime),
+}
+
+
+class CompactColumn(MutableMapping):
+
+    ''' A mapping of book id to a single scalar value. Values that cannot be
+    stored in the array, such as integers too large for 64 bits, are kept in
+    a small overflow dict. '''
+
+    __slots__ = ('count', 'datatype', 'decode', 'encode', 'extra', 'states', 'values')
+
+    def __init__(self, datatype, src=None):
+        self.datatype = datatype
+        typecode, self.encode, self.decode = codecs[datatype]
+        self.values = array(typecode)
+        self.states = bytearray()
+        self.extra = {}
+        self.count = 0
+        if src:
+            self.ensure_capacity(max(src))
+            values, states, extra, encode = self.values, self.states, self.extra, self.encode
+            for book_id, val in src.items():
+                if val is None:
+                    states[book_id] = NONE
+                    continue
+                try:
+                    values[book_id] = encode(val)
+                except (TypeError, OverflowError):
+                    extra[book_id] = val
+                    states[book_id] = EXTRA
+                else:
+                    states[book_id] = PRESENT
+            self.count = len(src)
+
+    def ensure_capacity(self, book_id):
+        extra = book_id + 1 - len(self.states)
+        if extra > 0:
+            # Grow geometrically to make appends cheap
+            extra = max(extra, len(self.states) // 4)
+            self.states.extend(bytes(extra))
+            self.values.extend(array(self.values.typecode, bytes(extra * self.values.itemsize)))
+
+    def get(self, book_id, default=None):
+        try:
+            state = self.states[book_id]
+        except (IndexError, TypeError):
+            return default
+        if state == PRESENT:
+            val = self.values[book_id]
+            return val if self.decode is None else self.decode(val)
+        if state == NONE:
+            return None
+        if state == EXTRA:
+            return self.extra[book_id]
+        return default
+
+    def __getitem__(self, book_id):
+        ans = self.get(book_id, null)
+        if ans is null:
+            raise KeyError(book_id)
+        return ans
+
+    def __contains__(self, book_id):
+        try:
+            return self.states[book_id] != ABSENT
+        except (IndexError, TypeError):
+            return False
+
+    def __setitem__(self, book_id, val):
+        if type(book_id) is not int or book_id < 0:
+            raise KeyError(f'Invalid book id: {book_id!r}')
+        self.ensure_capacity(book_id)
+        states = self.states
+        if states[book_id] == ABSENT:
+            self.count += 1
+        elif states[book_id] == EXTRA:
+            del self.extra[book_id]
+        if val is None:
+            states[book_id] = NONE
+            return
+        try:
+            self.values[book_id] = self.encode(val)
+        except (TypeError, OverflowError):
+            self.extra[book_id] = val
+            states[book_id] = EXTRA
+        else:
+            states[book_id] = PRESENT
+
+    def __delitem__(self, book_id):
+        if book_id not in self:
+            raise KeyError(book_id)
+        if self.states[book_id] == EXTRA:
+            del self.extra[book_id]
+        self.states[book_id] = ABSENT
+        self.count -= 1
+
+    def pop(self, book_id, default=null):
+        ans = self.get(book_id, null)
+        if ans is null:
+            if default is null:
+                raise KeyError(book_id)
+            return default
+        del self[book_id]
+        return ans
+
+    def __iter__(self):
+        states = self.states
+        pos = 0
+        while True:
+            pos = next_present(states, pos)
+            if pos < 0:
+                break
+            yield pos
+            pos += 1
+
+    def __len__(self):
+        return self.count
+
+    def copy(self):
+        return dict(self.items())
+
+    def __copy__(self):
+        ' An independent compact copy, cheap as it copies only the arrays '
+        ans = self.__class__.__new__(self.__class__)
+        ans.datatype, ans.encode, ans.decode, ans.count = self.datatype, self.encode, self.decode, self.count
+        ans.values, ans.states, ans.extra = self.values[:], self.states[:], self.extra.copy()
+        return ans
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.datatype!r}, {dict(self.items())!r})'
+
+
+def next_present(states, pos):
+    n = len(states)
+    while pos < n:
+        if states[pos]:
+            return pos
+        # Skip runs of absent entries with a C level search in chunks
+        end = min(n, pos + 4096)
+        pos = end - len(states[pos:end].lstrip(b'\0'))
+    return -1
+
+
+class CompactLinks(MutableMapping):
+
+    ''' A mapping of book id to a tuple of item ids, stored as a CSR style
+    offsets array and a flat array of item ids. Changes made after
+    construction are kept in an overlay dict that is periodically merged into
+    the arrays. '''
+
+    __slots__ = ('changed', 'count', 'items_array', 'offsets', 'present')
+
+    def __init__(self, src=None):
+        self.changed = {}
+        self.count = 0
+        self.build(src or {})
+
+    def build(self, src):
+        n = (max(src) + 1) if src else 0
+        self.present = bytearray(n)
+        self.offsets = offsets = array('q', bytes(8 * (n + 1)))
+        self.items_array = items = array('q')
+        self.changed = {}
+        pos = 0
+        for book_id in range(n):
+            offsets[book_id] = pos
+            val = src.get(book_id, null)
+            if val is null:
+                continue
+            if type(val) is tuple:
+                try:
+                    items.extend(val)
+                except (TypeError, OverflowError):
+                    del items[pos:]
+                else:
+                    self.present[book_id] = 1
+                    pos = len(items)
+                    continue
+            # Values that are not tuples of ints are kept as is
+            self.changed[book_id] = val
+        offsets[n] = pos
+        self.count = len(src)
+
+    def compact(self):
+        self.build(dict(self.items()))
+
+    def get(self, book_id, default=None):
+        ans = self.changed.get(book_id, null)
+        if ans is not null:
+            return ans
+        try:
+            if self.present[book_id]:
+                o = self.offsets
+                return tuple(self.items_array[o[book_id]:o[book_id+1]])
+        except (IndexError, TypeError):
+            pass
+        return default
+
+    def __getitem__(self, book_id):
+        ans = self.get(book_id, null)
+        if ans is null:
+            raise KeyError(book_id)
+        return ans
+
+    def in_base(self, book_id):
+        try:
+            return bool(self.present[book_id])
+        except (IndexError, TypeError):
+            return False
+
+    def __contains__(self, book_id):
+        return book_id in self.changed or self.in_base(book_id)
+
+    def __setitem__(self, book_id, val):
+        if book_id not in self:
+            self.count += 1
+        if self.in_base(book_id):
+            self.present[book_id] = 0
+        self.changed[book_id] = val
+        if len(self.changed) > max(1024, self.count // 8):
+            self.compact()
+
+    def __delitem__(self, book_id):
+        if book_id not in self:
+            raise KeyError(book_id)
+        self.changed.pop(book_id, None)
+        if self.in_base(book_id):
+            self.present[book_id] = 0
+        self.count -= 1
+
+    def pop(self, book_id, default=null):
+        ans = self.get(book_id, null)
+        if ans is null:
+            if default is null:
+                raise KeyError(book_id)
+            return default
+        del self[book_id]
+        return ans
+
+    def __iter__(self):
+        present = self.present
+        pos = 0
+        while True:
+            pos = next_present(present, pos)
+            if pos < 0:
+                break
+            yield pos
+            pos += 1
+        yield from tuple(self.changed)
+
+    def __len__(self):
+        return self.count
+
+    def copy(self):
+        return dict(self.items())
+
+    def __copy__(self):
+        ' An independent compact copy, cheap as it copies only the arrays '
+        ans = self.__class__.__new__(self.__class__)
+        ans.offsets, ans.items_array, ans.present = self.offsets[:], self.items_array[:], self.present[:]
+        ans.changed, ans.count = self.changed.copy(), self.count
+        return ans
+
+
+def compact_column(datatype, book_col_map):
+    ' Return a compact version of book_col_map if datatype is supported, otherwise book_col_map unchanged '
+    if datatype in codecs and isinstance(book_col_map, dict):
+        return CompactColumn(datatype, book_col_map)
+    return book_col_map
+
+
+def compact_links(book_col_map):
+    if isinstance(book_col_map, dict):
+        return CompactLinks(book_col_map)
+    return book_col_map
+
+
+def benchmark(num_books=500000, tags_per_book=3, num_tags=5000):
+    '''
+    Compare the memory used and the time taken for lookups and sorting between
+    plain dicts and the compact mappings for a generated library.
+    Run with: calibre-debug -c "from calibre.db.compact import benchmark; benchmark()"
+    '''
+    import random
+    import tracemalloc
+    from time import monotonic
+
+    random.seed(1)
+    now = datetime.now(utc_tz)
+    columns = {
+        'datetime': lambda i: now - timedelta(seconds=random.randrange(10**9)),
+        'float': lambda i: random.random() * 100,
+        'int': lambda i: random.randrange(10**7),
+        'bool': lambda i: bool(i % 2),
+    }
+    ids = range(1, num_books + 1)
+
+    def measure(label, factory):
+        tracemalloc.start()
+        st = monotonic()
+        obj = factory()
+        build_time = monotonic() - st
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        g = obj.get
+        st = monotonic()
+        for book_id in ids:
+            g(book_id)
+        lookup_time = monotonic() - st
+        st = monotonic()
+        sorted(ids, key=g)
+        sort_time = monotonic() - st
+        print(f'{label:24} memory: {mem / 1024**2:8.1f} MB build: {build_time:6.2f}s lookups: {lookup_time:6.2f}s sort: {sort_time:6.2f}s')
+        return obj
+
+    # The values are created inside the measured region, as the dicts keep a
+    # Python object alive for every value while the compact mappings do not
+    for datatype, gen in columns.items():
+        measure(f'{datatype} dict', lambda: {i: gen(i) for i in ids})
+        measure(f'{datatype} compact', lambda: CompactColumn(datatype, {i: gen(i) for i in ids}))
+
+    def links():
+        return {i: tuple(random.sample(range(1, num_tags), tags_per_book)) for i in ids}
+    measure('links dict', links)
+    measure('links compact', lambda: CompactLinks(links()))
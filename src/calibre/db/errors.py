@@ -15,3 +15,7 @@ class NoSuchBook(KeyError):
     def __init__(self, book_id):
         KeyError.__init__(self, f'No book with id: {book_id} in database')
         self.book_id = book_id
+
+
+class SnapshotIsReadOnly(RuntimeError):
+    pass
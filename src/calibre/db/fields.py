@@ -8,6 +8,7 @@
 import sys
 from collections import Counter, defaultdict
 from collections.abc import Iterable
+from copy import copy
 from functools import partial
 from threading import Lock
 
@@ -121,6 +122,15 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
     def metadata(self):
         return self.table.metadata
 
+    def snapshot(self, db_weakref, table=None):
+        ''' Return a copy of this field using a snapshot of its table, or table,
+        an unchanged snapshot of it, for use in a read only snapshot of the
+        library, see Cache.snapshot() '''
+        ans = copy(self)
+        ans.table = self.table.snapshot() if table is None else table
+        ans.db_weakref = db_weakref
+        return ans
+
     def for_book(self, book_id, default_value=None):
         '''
         Return the value of this field for the book identified by book_id.
@@ -296,6 +306,13 @@ def date_sort_key(self, val):
     def bool_sort_key(self, val):
         return self._bool_sort_key(force_to_bool(val))
 
+    def snapshot(self, db_weakref, table=None):
+        ans = super().snapshot(db_weakref, table)
+        ans._lock = Lock()
+        with self._lock:
+            ans._render_cache = self._render_cache.copy()
+        return ans
+
     def __render_composite(self, book_id, mi, formatter, template_cache):
         ' INTERNAL USE ONLY. DO NOT USE THIS OUTSIDE THIS CLASS! '
         db = self.db_weakref()
@@ -422,6 +439,11 @@ def __init__(self, name, table, bools_are_tristate, get_template_functions, db_w
     def metadata(self):
         return self._metadata
 
+    def snapshot(self, db_weakref, table=None):
+        # The values come from the connected device, not the database, so
+        # share them with the library
+        return self
+
     def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
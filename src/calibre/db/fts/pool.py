@@ -2,12 +2,13 @@
 # License: GPL v3 Copyright: 2022, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import json
 import os
 import subprocess
 import sys
 import traceback
 from contextlib import suppress
-from queue import Queue
+from queue import Empty, Queue
 from threading import Event, Thread
 from time import monotonic
 
@@ -49,11 +50,73 @@ def __init__(self, job, err_msg=''):
             self.text = err_msg
 
 
+class ExtractionProcess:
+
+    ''' A long lived worker process that extracts text from many books, to
+    avoid paying the cost of interpreter startup and plugin loading per book '''
+
+    def __init__(self, code_to_exec):
+        import tempfile
+        self.stderr = tempfile.TemporaryFile()
+        self.process = start_pipe_worker(
+            code_to_exec, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=self.stderr, priority='low')
+        self.responses = Queue()
+        self.reader = Thread(name='FTSWorkerReader', daemon=True, target=self.read_responses)
+        self.reader.start()
+
+    def read_responses(self):
+        try:
+            for line in self.process.stdout:
+                self.responses.put(line)
+        except Exception:
+            pass
+        self.responses.put(None)
+
+    def send(self, path):
+        # Discard the error output of previous jobs, so that it is not
+        # reported for this one. The worker process is idle, waiting for this
+        # job, so it is not writing to stderr.
+        with suppress(Exception):
+            self.stderr.seek(0)
+            self.stderr.truncate()
+        self.process.stdin.write((json.dumps(path) + '\n').encode('utf-8'))
+        self.process.stdin.flush()
+
+    def error_output(self):
+        with suppress(Exception):
+            self.stderr.seek(0, os.SEEK_END)
+            self.stderr.seek(max(0, self.stderr.tell() - 65536))
+            return self.stderr.read().decode('utf-8', 'replace')
+        return ''
+
+    def close(self, timeout=0.5):
+        with suppress(Exception):
+            self.process.stdin.close()
+        with suppress(subprocess.TimeoutExpired):
+            self.process.wait(timeout)
+        self.kill()
+
+    def kill(self):
+        if self.process.returncode is None:
+            with suppress(OSError):
+                self.process.kill()
+            with suppress(Exception):
+                self.process.wait()
+        with suppress(Exception):
+            self.process.stdout.close()
+        with suppress(Exception):
+            self.stderr.close()
+
+
 class Worker(Thread):
 
-    code_to_exec = 'from calibre.db.fts.text import main; main({!r})'
+    code_to_exec = 'from calibre.db.fts.text import serve_jobs; serve_jobs({!r}, {!r})'
     max_duration = 30  # minutes
     poll_interval = 0.1  # seconds
+    # The worker process is restarted after this many books or when it uses
+    # more than max_process_memory MB
+    max_jobs_per_process = 100
+    max_process_memory = 512
 
     def __init__(self, jobs_queue, supervise_queue):
         super().__init__(name='FTSWorker', daemon=True)
@@ -62,57 +125,85 @@ def __init__(self, jobs_queue, supervise_queue):
         self.supervise_queue = supervise_queue
         self.keep_going = True
         self.working = False
+        self.extraction_process = None
 
     def run(self):
-        while self.keep_going:
-            x = self.jobs_queue.get()
-            if x is quit:
-                break
-            self.working = True
+        try:
+            while self.keep_going:
+                x = self.jobs_queue.get()
+                if x is quit:
+                    break
+                self.working = True
+                try:
+                    res = self.run_job(x)
+                    if res is not None and self.keep_going:
+                        self.supervise_queue.put(res)
+                except Exception:
+                    tb = traceback.format_exc()
+                    traceback.print_exc()
+                    if self.keep_going:
+                        self.supervise_queue.put(Result(x, tb))
+                finally:
+                    self.working = False
+        finally:
+            self.stop_extraction_process(graceful=self.keep_going)
+
+    def stop_extraction_process(self, graceful=False):
+        p, self.extraction_process = self.extraction_process, None
+        if p is not None:
+            if graceful:
+                p.close()
+            else:
+                p.kill()
+
+    def send_job(self, job):
+        p = self.extraction_process
+        if p is not None and p.process.poll() is None:
             try:
-                res = self.run_job(x)
-                if res is not None and self.keep_going:
-                    self.supervise_queue.put(res)
-            except Exception:
-                tb = traceback.format_exc()
-                traceback.print_exc()
-                if self.keep_going:
-                    self.supervise_queue.put(Result(x, tb))
-            finally:
-                self.working = False
+                p.send(job.path)
+                return p
+            except OSError:
+                pass
+        self.stop_extraction_process()
+        self.extraction_process = p = ExtractionProcess(
+            self.code_to_exec.format(self.max_jobs_per_process, self.max_process_memory))
+        p.send(job.path)
+        return p
 
     def run_job(self, job):
         time_limit = monotonic() + (self.max_duration * 60)
         txtpath = job.path + '.txt'
-        errpath = job.path + '.error'
         try:
-            with open(errpath, 'wb') as error:
-                p = start_pipe_worker(
-                    self.code_to_exec.format(job.path),
-                    stdout=subprocess.DEVNULL, stderr=error, stdin=subprocess.DEVNULL, priority='low',
-                )
-                while self.keep_going and monotonic() <= time_limit:
-                    with suppress(subprocess.TimeoutExpired):
-                        p.wait(self.poll_interval)
-                        break
-                if p.returncode is None:
-                    p.kill()
-                    if not self.keep_going:
-                        return
-                    return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
-                        job.fmt, human_readable(job.fmt_size)))
-                if os.path.exists(txtpath):
-                    return Result(job)
-            with open(errpath, 'rb') as f:
-                err = f.read().decode('utf-8', 'replace')
-                return Result(job, err)
+            p = self.send_job(job)
+            response = False
+            while self.keep_going and monotonic() <= time_limit:
+                with suppress(Empty):
+                    response = p.responses.get(timeout=self.poll_interval)
+                    break
+            if response is False:
+                self.stop_extraction_process()
+                if not self.keep_going:
+                    return
+                return Result(job, _('Extracting text from the {0} file of size {1} took too long').format(
+                    job.fmt, human_readable(job.fmt_size)))
+            if response is None:
+                # The worker process crashed
+                err = p.error_output()
+                self.stop_extraction_process()
+                return Result(job, err or _('The text extraction worker process crashed'))
+            response = json.loads(response)
+            if response['ok'] and os.path.exists(txtpath):
+                ans = Result(job)
+            else:
+                ans = Result(job, response.get('error') or p.error_output() or _('Failed to extract text'))
+            if response['recycle']:
+                self.stop_extraction_process(graceful=True)
+            return ans
         finally:
             with suppress(OSError):
                 os.remove(job.path)
             with suppress(OSError):
                 os.remove(txtpath)
-            with suppress(OSError):
-                os.remove(errpath)
 
 
 class Pool:
@@ -232,3 +323,57 @@ def supervise(self):
                     self.do_check_for_work()
             except Exception:
                 traceback.print_exc()
+
+
+def benchmark(num_books=200, num_workers=1):
+    '''
+    Measure the throughput of text extraction in books per minute, when using
+    a new worker process per book and when using long lived worker processes.
+    Run with: calibre-debug -c "from calibre.db.fts.pool import benchmark; benchmark()"
+    '''
+    from zipfile import ZIP_STORED, ZipFile
+
+    from calibre.ptempfile import TemporaryDirectory
+
+    def make_book(path, fmt, num):
+        text = f'This is the text of book number {num}. ' * 200
+        if fmt == 'TXT':
+            with open(path, 'wb') as f:
+                f.write(text.encode('utf-8'))
+            return
+        with ZipFile(path, 'w') as zf:
+            zf.writestr('mimetype', 'application/epub+zip', compress_type=ZIP_STORED)
+            zf.writestr('META-INF/container.xml', '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+<rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>''')
+            zf.writestr('content.opf', f'''<?xml version="1.0"?>
+<package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="id">
+<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Book {num}</dc:title><dc:identifier id="id">{num}</dc:identifier></metadata>
+<manifest><item id="t" href="index.html" media-type="application/xhtml+xml"/></manifest>
+<spine><itemref idref="t"/></spine>
+</package>''')
+            zf.writestr('index.html', f'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>t</title></head><body><p>{text}</p></body></html>')
+
+    with TemporaryDirectory() as tdir:
+        for label, jobs_per_process in (('One process per book', 1), ('Long lived processes', Worker.max_jobs_per_process)):
+            jobs_queue, supervise_queue = Queue(), Queue()
+            workers = []
+            for i in range(num_workers):
+                w = Worker(jobs_queue, supervise_queue)
+                w.max_jobs_per_process = jobs_per_process
+                w.start()
+                workers.append(w)
+            st = monotonic()
+            for i in range(num_books):
+                fmt = 'EPUB' if i % 2 else 'TXT'
+                path = os.path.join(tdir, f'{jobs_per_process}-{i}.{fmt.lower()}')
+                make_book(path, fmt, i)
+                jobs_queue.put(Job(i, fmt, path, os.path.getsize(path), '', st))
+            failures = sum(0 if supervise_queue.get().ok else 1 for i in range(num_books))
+            elapsed = monotonic() - st
+            for w in workers:
+                jobs_queue.put(quit)
+            for w in workers:
+                w.join()
+            print(f'{label}: {60 * num_books / elapsed:.1f} books/minute with {num_workers} worker(s), {failures} failures')
@@ -132,3 +132,42 @@ def main(pathtoebook):
     text = extract_text(pathtoebook)
     with open(pathtoebook + '.txt', 'wb') as f:
         f.write(text.encode('utf-8'))
+
+
+def serve_jobs(max_jobs=0, max_memory=0):
+    '''
+    Run in a long lived worker process, extracting text from the files whose
+    paths are sent as JSON lines on stdin. A JSON line is written to stdout
+    for every file. The process exits after max_jobs files or when its memory
+    usage exceeds max_memory MB, letting the parent start a fresh one.
+    '''
+    import json
+    import sys
+    import traceback
+
+    from calibre.utils.mem import memory
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8')
+    # Ensure any output from plugins does not corrupt the responses
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    jobs_done = 0
+    for line in sys.stdin:
+        line = line.strip()
+        if not line:
+            continue
+        path = json.loads(line)
+        try:
+            main(path)
+        except Exception:
+            ans = {'ok': False, 'error': traceback.format_exc()}
+        else:
+            ans = {'ok': True}
+        jobs_done += 1
+        try:
+            recycle = (max_jobs and jobs_done >= max_jobs) or (max_memory and memory() > max_memory)
+        except Exception:
+            recycle = True
+        ans['recycle'] = bool(recycle)
+        out.write(json.dumps(ans) + '\n')
+        out.flush()
+        if recycle:
+            break
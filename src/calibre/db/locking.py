@@ -8,9 +8,12 @@
 import os
 import sys
 import traceback
+from bisect import bisect_left
 from contextlib import contextmanager
 from threading import Condition, Lock, current_thread
 
+from calibre.utils.monotonic import monotonic
+
 
 @contextmanager
 def try_lock(lock):
@@ -89,6 +92,25 @@ def __init__(self):
         self._exclusive_queue = []
         # This is for recycling waiter objects.
         self._free_waiters = []
+        # The number of times a thread had to wait to acquire the lock and
+        # the total time spent waiting, for shared and exclusive locks. Only
+        # contended acquisitions are timed, so this costs nothing otherwise.
+        self.shared_waits = self.exclusive_waits = 0
+        self.shared_wait_time = self.exclusive_wait_time = 0.
+        # Set by the exclusive owner when the code it is running may
+        # temporarily give up the lock, see yield_exclusive()
+        self.yieldable = False
+        # Incremented every time an exclusive lock is fully released, unless
+        # the owner set tables_unchanged to indicate that it did not change
+        # the data protected by this lock. Used to tell when snapshots of
+        # that data are stale.
+        self.write_generation = 0
+        self.tables_unchanged = False
+        # Set by the owner when all the changes it made to the tables were
+        # reported with the fields they changed, see Cache.snapshot(). The
+        # last write_generation for which that was not the case.
+        self.changes_reported = False
+        self.unreported_generation = 0
 
     def acquire(self, blocking=True, shared=False):
         '''
@@ -122,6 +144,13 @@ def release(self):
                 self.is_exclusive -= 1
                 if not self.is_exclusive:
                     self._exclusive_owner = None
+                    if self.tables_unchanged:
+                        self.tables_unchanged = False
+                    else:
+                        self.write_generation += 1
+                        if not self.changes_reported:
+                            self.unreported_generation = self.write_generation
+                    self.changes_reported = False
                     # If there are waiting shared locks, issue them
                     # all and them wake everyone up.
                     if self._shared_queue:
@@ -175,7 +204,10 @@ def _acquire_shared(self, blocking=True):
             waiter = self._take_waiter()
             try:
                 self._shared_queue.append((me, waiter))
+                st = monotonic()
                 waiter.wait()
+                self.shared_wait_time += monotonic() - st
+                self.shared_waits += 1
                 assert not self.is_exclusive
             finally:
                 self._return_waiter(waiter)
@@ -202,7 +234,10 @@ def _acquire_exclusive(self, blocking=True):
             waiter = self._take_waiter()
             try:
                 self._exclusive_queue.append((me, waiter))
+                st = monotonic()
                 waiter.wait()
+                self.exclusive_wait_time += monotonic() - st
+                self.exclusive_waits += 1
             finally:
                 self._return_waiter(waiter)
         else:
@@ -210,6 +245,36 @@ def _acquire_exclusive(self, blocking=True):
             self.is_exclusive += 1
         return True
 
+    def yield_exclusive(self):
+        '''
+        Let the threads waiting for the lock have it, then re-acquire it
+        exclusively. Used by long running writers to avoid starving readers.
+        Must only be called by a thread holding the lock exclusively, exactly
+        once, as otherwise an outer caller would lose the lock it expects to
+        hold. Returns False, without releasing the lock, if no other thread is
+        waiting for it.
+        '''
+        me = current_thread()
+        with self._lock:
+            if self._exclusive_owner is not me or self.is_exclusive != 1:
+                raise LockingError('yield_exclusive() called by a thread not holding the lock exclusively exactly once')
+            if not self._shared_queue and not self._exclusive_queue:
+                return False
+            tables_unchanged, changes_reported = self.tables_unchanged, self.changes_reported
+        self.release()
+        self.acquire()
+        self.tables_unchanged, self.changes_reported = tables_unchanged, changes_reported
+        return True
+
+    def wait_stats(self):
+        ' The number of contended acquisitions and the time spent waiting for them, by type of lock '
+        with self._lock:
+            return {
+                'shared': {'waits': self.shared_waits, 'wait_time': self.shared_wait_time},
+                'exclusive': {'waits': self.exclusive_waits, 'wait_time': self.exclusive_wait_time},
+                'queued': {'shared': len(self._shared_queue), 'exclusive': len(self._exclusive_queue)},
+            }
+
     def _take_waiter(self):
         try:
             return self._free_waiters.pop()
@@ -222,6 +287,53 @@ def _return_waiter(self, waiter):
 # }}}
 
 
+class LockProfile:  # {{{
+
+    '''
+    Histograms of the time spent waiting to acquire a lock and the time it
+    was held, for every caller name, to find the callers that starve others.
+    '''
+
+    # Upper bounds of the histogram buckets, in seconds
+    BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data = {}
+
+    def record(self, name, is_shared, wait_time, hold_time):
+        with self.lock:
+            x = self.data.get(name)
+            if x is None:
+                n = len(self.BUCKETS) + 1
+                x = self.data[name] = {
+                    'shared': is_shared, 'calls': 0, 'wait_time': 0., 'hold_time': 0., 'max_wait_time': 0., 'max_hold_time': 0.,
+                    'wait_histogram': [0] * n, 'hold_histogram': [0] * n}
+            x['calls'] += 1
+            x['wait_time'] += wait_time
+            x['hold_time'] += hold_time
+            x['max_wait_time'] = max(x['max_wait_time'], wait_time)
+            x['max_hold_time'] = max(x['max_hold_time'], hold_time)
+            x['wait_histogram'][bisect_left(self.BUCKETS, wait_time)] += 1
+            x['hold_histogram'][bisect_left(self.BUCKETS, hold_time)] += 1
+
+    def stats(self):
+        ' A copy of the collected data, keyed by caller name. The last bucket of the histograms is for values larger than all of BUCKETS '
+        with self.lock:
+            return {name: {k: (list(v) if isinstance(v, list) else v) for k, v in x.items()} for name, x in self.data.items()}
+
+    def report(self, limit=20):
+        ' A human readable table of the callers that held the lock for the longest total time '
+        rows = sorted(self.stats().items(), key=lambda x: x[1]['hold_time'], reverse=True)[:limit]
+        lines = ['{:<40} {:>4} {:>8} {:>10} {:>10} {:>10} {:>10}'.format(
+            'Name', 'Type', 'Calls', 'Held (s)', 'Max held', 'Waited (s)', 'Max wait')]
+        for name, x in rows:
+            lines.append('{:<40} {:>4} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+                name, 'R' if x['shared'] else 'W', x['calls'], x['hold_time'], x['max_hold_time'], x['wait_time'], x['max_wait_time']))
+        return '\n'.join(lines)
+# }}}
+
+
 class RWLockWrapper:
 
     def __init__(self, shlock, is_shared=True):
@@ -272,6 +384,23 @@ def release(self, *args):
     __exit__ = release
 
 
+class NullLock:
+
+    ' A lock that does nothing, used for snapshots of the library, which are never changed '
+
+    def acquire(self, *args):
+        return True
+
+    def release(self, *args):
+        pass
+
+    __enter__ = acquire
+    __exit__ = release
+
+    def owns_lock(self):
+        return True
+
+
 class SafeReadLock:
 
     def __init__(self, read_lock):
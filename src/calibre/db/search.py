@@ -6,8 +6,10 @@
 __docformat__ = 'restructuredtext en'
 
 import operator
+import sys
 import weakref
 from collections import OrderedDict, deque
+from copy import copy
 from datetime import timedelta
 from functools import partial
 
@@ -15,7 +17,7 @@
 
 from calibre.constants import DEBUG, preferred_encoding
 from calibre.db.utils import force_to_bool
-from calibre.utils.config_base import prefs
+from calibre.utils.config_base import prefs, tweaks
 from calibre.utils.date import UNDEFINED_DATE, dt_as_local, now, parse_date
 from calibre.utils.icu import lower as icu_lower
 from calibre.utils.icu import primary_contains, primary_no_punc_contains, sort_key
@@ -818,12 +820,16 @@ def get_user_category_matches(self, location, query, candidates):
 
 class LRUCache:  # {{{
 
-    'A simple Least-Recently-Used cache'
+    'A simple Least-Recently-Used cache, optionally limited by the memory used by its values as well'
 
-    def __init__(self, limit=50):
+    def __init__(self, limit=50, memory_limit=0, sizeof=sys.getsizeof):
         self.item_map = {}
         self.age_map = deque()
         self.limit = limit
+        self.memory_limit = memory_limit
+        self.sizeof = sizeof
+        self.size_map = {}
+        self.memory_used = 0
 
     def _move_up(self, key):
         if key != self.age_map[-1]:
@@ -836,12 +842,29 @@ def add(self, key, val):
             return
 
         if len(self.age_map) >= self.limit:
-            self.item_map.pop(self.age_map.popleft())
+            self._evict()
 
         self.item_map[key] = val
         self.age_map.append(key)
+        if self.memory_limit:
+            self.size_map[key] = sz = self.sizeof(val)
+            self.memory_used += sz
+            while self.memory_used > self.memory_limit and len(self.age_map) > 1:
+                self._evict()
     __setitem__  = add
 
+    def _evict(self):
+        key = self.age_map.popleft()
+        self.item_map.pop(key)
+        self.memory_used -= self.size_map.pop(key, 0)
+
+    def refresh_size(self, key):
+        ' Must be called if the value for key is changed in place '
+        if self.memory_limit and key in self.item_map:
+            self.memory_used -= self.size_map.get(key, 0)
+            self.size_map[key] = sz = self.sizeof(self.item_map[key])
+            self.memory_used += sz
+
     def get(self, key, default=None):
         ans = self.item_map.get(key, default)
         if ans is not default:
@@ -851,9 +874,12 @@ def get(self, key, default=None):
     def clear(self):
         self.item_map.clear()
         self.age_map.clear()
+        self.size_map.clear()
+        self.memory_used = 0
 
     def pop(self, key, default=None):
         self.item_map.pop(key, default)
+        self.memory_used -= self.size_map.pop(key, 0)
         try:
             self.age_map.remove(key)
         except ValueError:
@@ -884,8 +910,34 @@ def __init__(self, db, opt_name, all_search_locations=()):
         self.bool_search = BooleanSearch()
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
-        self.cache = LRUCache()
+        self.cache = LRUCache(
+            limit=max(1, int(tweaks['search_cache_size'])),
+            memory_limit=max(0, int(tweaks['search_cache_max_memory'] * 1024 * 1024)))
         self.parse_cache = LRUCache(limit=100)
+        self.cache_hits = self.cache_misses = 0
+
+    def snapshot(self, dbcache, previous=None, changed_fields=None):
+        ''' A copy of this object with its own caches for use with dbcache, a
+        read only snapshot of the library. If previous, the search API of the
+        previous snapshot, is specified, its cached results for searches that
+        do not depend on changed_fields are kept. '''
+        ans = copy(self)
+        ans.cache = LRUCache(limit=self.cache.limit, memory_limit=self.cache.memory_limit)
+        ans.parse_cache = LRUCache(limit=self.parse_cache.limit)
+        ans.cache_hits = ans.cache_misses = 0
+        if previous is not None and len(previous.cache):
+            # Readers of the previous snapshot may be changing its cache,
+            # copying the dict is atomic
+            items = previous.cache.item_map.copy()
+            sqp = ans.create_parser(dbcache)
+            try:
+                for query, result in iteritems(items):
+                    fields = ans.fields_for_query(sqp, dbcache, query)
+                    if fields is not None and fields.isdisjoint(changed_fields):
+                        ans.cache.add(query, result)
+            finally:
+                sqp.dbcache = sqp.lookup_saved_search = None
+        return ans
 
     def get_saved_searches(self):
         return self.saved_searches
@@ -896,31 +948,74 @@ def change_locations(self, newlocs):
             self.parse_cache.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
-        else:
+    def update_or_clear(self, dbcache, book_ids=None, changed_fields=None):
+        '''
+        Update the cached search results after the books in book_ids have
+        changed. If changed_fields is not None, only cached searches that use
+        one of the fields in it are updated, the rest are left alone. Searches
+        that need updating are re-evaluated against only the changed books, if
+        that is cheap enough, otherwise they are removed from the cache.
+        '''
+        if not book_ids or not len(self.cache):
             self.clear_caches()
+            return
+        sqp = self.create_parser(dbcache)
+        try:
+            self._update_caches(sqp, dbcache, book_ids, changed_fields)
+        finally:
+            sqp.dbcache = sqp.lookup_saved_search = None
 
     def clear_caches(self):
         self.cache.clear()
 
     def update_caches(self, dbcache, book_ids):
-        sqp = self.create_parser(dbcache)
-        try:
-            return self._update_caches(sqp, book_ids)
-        finally:
-            sqp.dbcache = sqp.lookup_saved_search = None
+        self.update_or_clear(dbcache, book_ids)
 
     def discard_books(self, book_ids):
         book_ids = set(book_ids)
         for query, result in self.cache:
             result.difference_update(book_ids)
 
-    def _update_caches(self, sqp, book_ids):
+    def fields_for_query(self, sqp, dbcache, query):
+        ''' Return the set of fields the results of query depend on or None if
+        they could depend on any field '''
+        ans = set()
+        fm = dbcache.field_metadata
+        try:
+            for name, value in sqp.get_queried_fields(query):
+                name = icu_lower(name.strip())
+                if name.startswith('@') or name in ('all', 'vl', 'template'):
+                    return None
+                if name == 'series_sort':
+                    ans |= {'series', 'languages'}
+                    continue
+                key = fm.search_term_to_field_key(name)
+                if not isinstance(key, str) or key not in dbcache.fields or fm[key]['datatype'] == 'composite':
+                    # Grouped search terms, user categories and composite
+                    # columns can depend on arbitrary fields
+                    return None
+                ans.add(key)
+        except ParseException:
+            return None
+        return ans
+
+    def _update_caches(self, sqp, dbcache, book_ids, changed_fields=None):
+        affected = []
+        for query, result in tuple(self.cache):
+            if changed_fields is not None:
+                fields = self.fields_for_query(sqp, dbcache, query)
+                if fields is not None and fields.isdisjoint(changed_fields):
+                    continue
+            affected.append((query, result))
+        if not affected:
+            return
+        if len(book_ids) * len(affected) > self.MAX_CACHE_UPDATE:
+            for query, result in affected:
+                self.cache.pop(query)
+            return
         book_ids = sqp.all_book_ids = set(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        for query, result in affected:
             try:
                 matches = sqp.parse(query)
             except ParseException:
@@ -930,9 +1025,17 @@ def _update_caches(self, sqp, book_ids):
                 result.difference_update(book_ids - matches)
                 # add books that now match but did not before
                 result.update(matches)
+                self.cache.refresh_size(query)
         for query in remove:
             self.cache.pop(query)
 
+    def cache_stats(self):
+        return {
+            'size': len(self.cache), 'limit': self.cache.limit,
+            'memory_used': self.cache.memory_used, 'memory_limit': self.cache.memory_limit,
+            'hits': self.cache_hits, 'misses': self.cache_misses,
+        }
+
     def create_parser(self, dbcache, virtual_fields=None):
         return Parser(
             dbcache, set(), dbcache._pref('grouped_search_terms'),
@@ -969,6 +1072,17 @@ def query_is_cacheable(self, sqp, dbcache, query):
                             return False
         return True
 
+    def query_is_stable(self, sqp, dbcache, query):
+        ''' Return True if the results of query can change only when the
+        library is changed '''
+        fields = self.fields_for_query(sqp, dbcache, query)
+        if fields is None:
+            return False
+        fm = dbcache.field_metadata
+        # Dates can be searched for relative to today and whether books are
+        # on the device is not stored in the library
+        return not any(key == 'ondevice' or fm[key]['datatype'] == 'datetime' for key in fields)
+
     def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         ''' Do the search, caching the results. Results are cached only if the
         search is on the full library and no virtual field is searched on '''
@@ -983,6 +1097,7 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         if use_cache and book_ids is None and query and not search_restriction:
             cached = self.cache.get(query)
             if cached is not None:
+                self.cache_hits += 1
                 return cached
 
         restricted_ids = all_book_ids = dbcache._all_book_ids(type=set)
@@ -992,10 +1107,12 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
             if self.query_is_cacheable(sqp, dbcache, sr):
                 cached = self.cache.get(sr)
                 if cached is None:
+                    self.cache_misses += 1
                     restricted_ids = sqp.parse(sr)
                     if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
                         self.cache.add(sr, restricted_ids)
                 else:
+                    self.cache_hits += 1
                     restricted_ids = cached
                     if book_ids is not None:
                         restricted_ids = book_ids.intersection(restricted_ids)
@@ -1010,7 +1127,9 @@ def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         if use_cache and restricted_ids is all_book_ids:
             cached = self.cache.get(query)
             if cached is not None:
+                self.cache_hits += 1
                 return cached
+            self.cache_misses += 1
 
         sqp.all_book_ids = restricted_ids
         result = sqp.parse(query)
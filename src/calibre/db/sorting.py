@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# Sorting of books using precomputed per-field rank arrays. The rank of a book
+# for a field is the position of its sort key among the sort keys of all
+# books, with books that have equal sort keys getting the same rank. Once the
+# ranks are known, sorting on any number of fields is a series of stable
+# sorts on plain integers, which is much faster than building and comparing
+# sort keys for every book on every sort.
+
+import sys
+from array import array
+
+from calibre.db.utils import type_safe_sort_key_function
+
+
+def sorted_positions(keys, field_name, book_ids):
+    ''' Return the indices into keys in sorted order along with the keys that
+    were used for the sort. If the keys cannot be sorted, the books are sorted
+    by book_ids, the ids of the books the keys are for. '''
+    try:
+        return sorted(range(len(keys)), key=keys.__getitem__), keys
+    except Exception as err:
+        print('Failed to sort database on field:', field_name, 'with error:', err, file=sys.stderr)
+    try:
+        keys = list(map(type_safe_sort_key_function(), keys))
+        return sorted(range(len(keys)), key=keys.__getitem__), keys
+    except Exception as err:
+        print('Failed to type-safe sort database on field:', field_name, 'with error:', err, file=sys.stderr)
+    return sorted(range(len(book_ids)), key=book_ids.__getitem__), book_ids
+
+
+def compute_ranks(book_ids, keyfunc, field_name, dense=False):
+    '''
+    Return a mapping of book_id to rank for the specified books. If dense is
+    True the mapping is an array indexed by book id, otherwise it is a dict.
+    '''
+    book_ids = tuple(book_ids)
+    keys = list(map(keyfunc, book_ids))
+    order, keys = sorted_positions(keys, field_name, book_ids)
+    if dense:
+        ans = array('q', bytes(8 * ((max(book_ids) + 1) if book_ids else 0)))
+    else:
+        ans = {}
+    rank = 0
+    prev = None
+    for i, pos in enumerate(order):
+        key = keys[pos]
+        # Books whose keys are neither less nor greater than each other share
+        # a rank, matching the cmp() based comparison of sort keys
+        if i and (prev < key or key < prev):
+            rank += 1
+        ans[book_ids[pos]] = rank
+        prev = key
+    return ans
+
+
+class SortRanks:
+
+    ''' A cache of the rank arrays for fields, invalidated when the fields (or
+    the fields their sort keys depend on) are changed. '''
+
+    def __init__(self):
+        self.cache = {}
+        self.hits = self.misses = 0
+
+    def clear(self):
+        self.cache.clear()
+
+    def copy(self):
+        ans = SortRanks()
+        ans.cache = self.cache.copy()
+        return ans
+
+    def invalidate(self, changed_fields=None):
+        if changed_fields is None or 'languages' in changed_fields:
+            # The language of a book is used in the sort keys of many fields
+            self.cache.clear()
+            return
+        for name, (deps, ranks) in tuple(self.cache.items()):
+            if not deps.isdisjoint(changed_fields):
+                del self.cache[name]
+
+    def get(self, name, deps, keyfunc, ids_to_sort, all_book_ids):
+        '''
+        Return a mapping of book_id to rank for the books in ids_to_sort. If
+        deps is None, the field cannot be cached, otherwise the ranks are
+        computed for all books in the library and cached until one of the
+        fields in deps is changed.
+        '''
+        if deps is not None:
+            entry = self.cache.get(name)
+            if entry is not None:
+                ranks = entry[1]
+                # Books added after the ranks were computed have ids past the
+                # end of the array, as adding a book clears the cache
+                if not ids_to_sort or max(ids_to_sort) < len(ranks):
+                    self.hits += 1
+                    return ranks
+            if len(ids_to_sort) * 4 >= len(all_book_ids) and all_book_ids.issuperset(ids_to_sort):
+                # Only worth computing the ranks for the whole library if a
+                # large fraction of it is being sorted
+                self.misses += 1
+                ranks = compute_ranks(all_book_ids, keyfunc, name, dense=True)
+                self.cache[name] = frozenset(deps), ranks
+                return ranks
+        return compute_ranks(ids_to_sort, keyfunc, name)
+
+
+def multisort_by_ranks(ids_to_sort, rank_maps_and_orders):
+    '''
+    Sort ids_to_sort by the specified (ranks, ascending) pairs, the most
+    significant first. Books with equal ranks in all fields remain in the
+    order in which they are in ids_to_sort.
+    '''
+    ans = list(ids_to_sort)
+    # Stable sorts, from the least significant field to the most significant,
+    # give the same result as a single sort with a compound key. Note that
+    # sort() preserves the order of equal elements even when reverse is True.
+    for ranks, ascending in reversed(rank_maps_and_orders):
+        if ranks is None:
+            ans.sort(reverse=not ascending)
+        else:
+            ans.sort(key=ranks.__getitem__, reverse=not ascending)
+    return ans
@@ -8,9 +8,12 @@
 import numbers
 from collections import defaultdict
 from collections.abc import Iterable
+from copy import copy
 from datetime import datetime, timedelta
 
+from calibre.db.compact import compact_column, compact_links
 from calibre.ebooks.metadata import author_to_author_sort
+from calibre.utils.config_base import tweaks
 from calibre.utils.date import UNDEFINED_DATE, parse_date, utc_tz
 from calibre.utils.icu import lower as icu_lower
 from calibre_extensions.speedup import parse_date as _c_speedup
@@ -52,9 +55,17 @@ def c_parse(val):
 null = object()
 
 
+def copy_nested_map(m):
+    ans = {k:v.copy() for k, v in iteritems(m)}
+    return defaultdict(m.default_factory, ans) if isinstance(m, defaultdict) else ans
+
+
 class Table:
 
     supports_notes = False
+    # The attributes holding the data read from the database, and those of
+    # them whose values are sets or dicts that are changed in place
+    data_maps = nested_data_maps = ()
 
     def __init__(self, name, metadata, link_table=None):
         self.name, self.metadata = name, metadata
@@ -79,6 +90,16 @@ def __init__(self, name, metadata, link_table=None):
     def remove_books(self, book_ids, db):
         return set()
 
+    def snapshot(self):
+        ''' Return a copy of this table that is unaffected by later changes to
+        it. Must be called with the database lock held. '''
+        ans = copy(self)
+        for attr in self.data_maps:
+            val = getattr(self, attr, None)
+            if val is not None:
+                setattr(ans, attr, copy_nested_map(val) if attr in self.nested_data_maps else copy(val))
+        return ans
+
     def fix_link_table(self, db):
         pass
 
@@ -109,6 +130,7 @@ class OneToOneTable(Table):
     '''
 
     table_type = ONE_ONE
+    data_maps = ('book_col_map',)
 
     def read(self, db):
         idcol = 'id' if self.metadata['table'] == 'books' else 'book'
@@ -126,6 +148,13 @@ def read(self, db):
         else:
             us = self.unserialize
             self.book_col_map = {book_id:us(val) for book_id, val in query}
+        self.compact_book_col_map()
+
+    def compact_book_col_map(self):
+        if tweaks['compact_in_memory_tables'] and type(self) in (OneToOneTable, SizeTable):
+            # Sizes are ints, even though the size field has the float datatype
+            datatype = 'int' if type(self) is SizeTable else self.metadata['datatype']
+            self.book_col_map = compact_column(datatype, self.book_col_map)
 
     def remove_books(self, book_ids, db):
         clean = set()
@@ -151,6 +180,7 @@ def read(self, db):
             'SELECT books.id, (SELECT MAX(uncompressed_size) FROM data '
             'WHERE data.book=books.id) FROM books')
         self.book_col_map = dict(query)
+        self.compact_book_col_map()
 
     def update_sizes(self, size_map):
         self.book_col_map.update(size_map)
@@ -158,6 +188,8 @@ def update_sizes(self, size_map):
 
 class UUIDTable(OneToOneTable):
 
+    data_maps = ('book_col_map', 'uuid_to_id_map')
+
     def read(self, db):
         OneToOneTable.read(self, db)
         self.uuid_to_id_map = {v:k for k, v in iteritems(self.book_col_map)}
@@ -182,6 +214,9 @@ def lookup_by_uuid(self, uuid):
 
 class CompositeTable(OneToOneTable):
 
+    # Composite columns have no data of their own, they are rendered from the other columns
+    data_maps = ()
+
     def read(self, db):
         self.book_col_map = {}
         d = self.metadata['display']
@@ -205,6 +240,8 @@ class ManyToOneTable(Table):
 
     table_type = MANY_ONE
     supports_notes = True
+    data_maps = ('book_col_map', 'col_book_map', 'id_map', 'link_map')
+    nested_data_maps = ('col_book_map',)
 
     def read(self, db):
         self.id_map = {}
@@ -230,6 +267,8 @@ def read_maps(self, db):
                     self.metadata['link_column'], self.link_table)):
             cbm[item_id].add(book)
             bcm[book] = item_id
+        if tweaks['compact_in_memory_tables']:
+            self.book_col_map = compact_column('int', bcm)
 
     def fix_link_table(self, db):
         linked_item_ids = set(itervalues(self.book_col_map))
@@ -426,6 +465,8 @@ def read_maps(self, db):
             bcm[book].append(item_id)
 
         self.book_col_map = {k:tuple(v) for k, v in iteritems(bcm)}
+        if tweaks['compact_in_memory_tables']:
+            self.book_col_map = compact_links(self.book_col_map)
 
     def fix_link_table(self, db):
         linked_item_ids = {item_id for item_ids in itervalues(self.book_col_map) for item_id in item_ids}
@@ -577,6 +618,8 @@ def fix_case_duplicates(self, db):
 
 class AuthorsTable(ManyToManyTable):
 
+    data_maps = ManyToManyTable.data_maps + ('asort_map',)
+
     def read_id_maps(self, db):
         self.link_map = lm = {}
         self.asort_map = sm = {}
@@ -630,6 +673,8 @@ class FormatsTable(ManyToManyTable):
 
     do_clean_on_remove = False
     supports_notes = False
+    data_maps = ManyToManyTable.data_maps + ('fname_map', 'size_map')
+    nested_data_maps = ('col_book_map', 'fname_map', 'size_map')
 
     def read_id_maps(self, db):
         pass
@@ -716,6 +761,7 @@ def update_fmt(self, book_id, fmt, fname, size, db):
 class IdentifiersTable(ManyToManyTable):
 
     supports_notes = False
+    nested_data_maps = ('book_col_map', 'col_book_map')
 
     def read_id_maps(self, db):
         pass
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# An on-disk copy of the in-memory tables, so that opening a library does not
+# have to read every table from metadata.db with SQL, which is slow for very
+# large libraries. The copy is written after the tables are read from the
+# database, and used on the next open if the database file has not changed
+# since, as determined by its size, modification time and SQLite header. It is
+# stored in the calibre cache directory as it can always be re-created.
+# Enabled via the cache_tables_on_disk tweak.
+
+import hashlib
+import os
+import pickle
+
+from calibre.constants import cache_dir
+from calibre.utils.config_base import tweaks
+from calibre.utils.filenames import atomic_rename
+
+# Increment this when the format of the stored tables changes
+VERSION = 1
+
+
+def tables_cache_path(dbpath):
+    q = hashlib.sha1(os.path.abspath(dbpath).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir(), 'db-tables', q + '.pickle')
+
+
+def file_key(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def database_key(dbpath):
+    '''
+    A value that changes whenever the database is changed. The SQLite header
+    contains a counter that is incremented on every commit, except in WAL
+    mode, where commits change the WAL file instead. An empty WAL file is the
+    same as no WAL file, as it is created and removed by simply opening and
+    closing the database.
+    '''
+    with open(dbpath, 'rb') as f:
+        header = f.read(100)
+    wal_key = file_key(dbpath + '-wal')
+    if wal_key is not None and wal_key[0] == 0:
+        wal_key = None
+    return file_key(dbpath), header, wal_key
+
+
+def tables_signature(tables):
+    ' Changes when the set of tables or how they are read changes, for example, when a custom column is created '
+    ans = [VERSION, tweaks['compact_in_memory_tables']]
+    for name, table in sorted(tables.items()):
+        m = table.metadata
+        ans.append((name, type(table).__name__, m.get('datatype'), m.get('table'), m.get('column'), m.get('link_column'),
+                    bool(table.sort_alpha), table.link_table))
+    return tuple(ans)
+
+
+def load_tables(path, key, tables):
+    '''
+    Load the data of tables from the file at path, if it was saved with the
+    specified key. Returns False, leaving the tables unchanged, otherwise.
+    Tables that have no data maps are not loaded and must be read as usual.
+    '''
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return False
+    with f:
+        try:
+            header = pickle.load(f)
+            if header != (key, tables_signature(tables)):
+                return False
+            data = pickle.load(f)
+        except Exception:
+            return False
+    for name, table in tables.items():
+        if table.data_maps:
+            for attr, val in zip(table.data_maps, data[name]):
+                setattr(table, attr, val)
+    return True
+
+
+def save_tables(path, key, tables):
+    data = {name: tuple(getattr(table, attr) for attr in table.data_maps) for name, table in tables.items() if table.data_maps}
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tpath = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tpath, 'wb') as f:
+            # The small header is written separately so that a stale file can
+            # be rejected without reading the rest of it
+            pickle.dump((key, tables_signature(tables)), f, -1)
+            pickle.dump(data, f, -1)
+        atomic_rename(tpath, path)
+    finally:
+        if os.path.exists(tpath):
+            os.remove(tpath)
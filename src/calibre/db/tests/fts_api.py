@@ -130,6 +130,62 @@ def check(**kw):
         for w in workers:
             self.assertFalse(w.is_alive())
 
+    def test_fts_worker_crash(self):
+        from queue import Queue
+
+        from calibre.db.fts.pool import Job, Worker, quit
+        # A worker process that reports every job on stderr and crashes on
+        # files with the .crash extension
+        code_to_exec = '''
+import json, sys
+for line in sys.stdin:
+    path = json.loads(line)
+    sys.stderr.write('processing ' + path + '\\n')
+    sys.stderr.flush()
+    if path.endswith('.crash'):
+        sys.stderr.write('crashed\\n')
+        sys.stderr.flush()
+        raise SystemExit(1)
+    with open(path + '.txt', 'wb') as f:
+        f.write(b'text of ' + path.encode('utf-8'))
+    sys.stdout.write(json.dumps(dict(ok=True, recycle=False)) + '\\n')
+    sys.stdout.flush()
+'''
+        jobs_queue, supervise_queue = Queue(), Queue()
+        w = Worker(jobs_queue, supervise_queue)
+        w.code_to_exec = code_to_exec
+        w.start()
+        paths = [os.path.join(self.library_path, f'{i}.{ext}') for i, ext in enumerate(('txt', 'txt', 'crash', 'txt', 'crash'))]
+
+        def run(i):
+            jobs_queue.put(Job(i, 'TXT', paths[i], 1, '', time.monotonic()))
+            return supervise_queue.get(timeout=30)
+
+        try:
+            for i in range(2):
+                r = run(i)
+                self.assertTrue(r.ok)
+                self.ae(r.text, 'text of ' + paths[i])
+            first_process = w.extraction_process
+            # The error from a crash contains the output of only the crashed job
+            r = run(2)
+            self.assertFalse(r.ok)
+            self.ae(r.text.splitlines(), ['processing ' + paths[2], 'crashed'])
+            self.assertIsNone(w.extraction_process)
+            # A new worker process is started for the next job
+            r = run(3)
+            self.assertTrue(r.ok)
+            self.ae(r.text, 'text of ' + paths[3])
+            self.assertIsNotNone(w.extraction_process)
+            self.assertIsNot(w.extraction_process, first_process)
+            r = run(4)
+            self.assertFalse(r.ok)
+            self.ae(r.text.splitlines(), ['processing ' + paths[4], 'crashed'])
+        finally:
+            jobs_queue.put(quit)
+            w.join(30)
+        self.assertFalse(w.is_alive())
+
     def test_fts_search(self):
         cache = self.new_library()
         fts = cache.enable_fts()
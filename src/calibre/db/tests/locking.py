@@ -192,6 +192,58 @@ def lots_of_acquires():
         self.assertFalse(lock.is_shared)
         self.assertFalse(lock.is_exclusive)
 
+    def test_wait_stats(self):
+        lock = SHLock()
+        lock.acquire(shared=True)
+        lock.release()
+        s = lock.wait_stats()
+        self.assertEqual((s['shared']['waits'], s['exclusive']['waits']), (0, 0))
+
+        def exclusive():
+            lock.acquire()
+            lock.release()
+
+        lock.acquire(shared=True)
+        t = Thread(target=exclusive)
+        t.daemon = True
+        t.start()
+        while not lock.wait_stats()['queued']['exclusive']:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        lock.release()
+        t.join(5)
+        s = lock.wait_stats()
+        self.assertEqual((s['shared']['waits'], s['exclusive']['waits']), (0, 1))
+        self.assertGreaterEqual(s['exclusive']['wait_time'], 0.1)
+        self.assertEqual(s['queued'], {'shared': 0, 'exclusive': 0})
+
+    def test_yield_exclusive(self):
+        lock = SHLock()
+        self.assertRaises(LockingError, lock.yield_exclusive)
+        lock.acquire()
+        self.assertFalse(lock.yield_exclusive())
+        order = []
+
+        def reader():
+            lock.acquire(shared=True)
+            order.append('read')
+            lock.release()
+
+        t = Thread(target=reader)
+        t.daemon = True
+        t.start()
+        while not lock.wait_stats()['queued']['shared']:
+            time.sleep(0.01)
+        self.assertTrue(lock.yield_exclusive())
+        order.append('write')
+        t.join(5)
+        self.assertEqual(order, ['read', 'write'])
+        self.assertEqual(lock.is_exclusive, 1)
+        lock.acquire()
+        self.assertRaises(LockingError, lock.yield_exclusive)
+        lock.release(), lock.release()
+        self.assertFalse(lock.is_exclusive)
+
 
 def find_tests():
     import unittest
@@ -218,6 +218,29 @@ def test_sorting(self):  # {{{
         ae(list(range(1, 11)), cache.multisort([('#one', True), ('#two', True)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([4, 5, 1, 2, 3, 7, 8, 9, 10, 6], cache.multisort([('#one', True), ('#two', False)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
+
+        # Test caching of sort ranks
+        stats = cache.sort_cache_stats()
+        ae([4, 5, 1, 2, 3, 7, 8, 9, 10, 6], cache.multisort([('#one', True), ('#two', False)], ids_to_sort=sorted(cache.all_book_ids())))
+        ae(cache.sort_cache_stats()['hits'], stats['hits'] + 2)
+        cache.set_field('#two', {4: 0})
+        ae([5, 1, 2, 3, 4, 7, 8, 9, 10, 6], cache.multisort([('#one', True), ('#two', False)], ids_to_sort=sorted(cache.all_book_ids())))
+        cache.set_field('title', {1: 'zzz', 2: 'aaa'})
+        ae(2, cache.multisort([('title', True)])[0])
+        ae(1, cache.multisort([('title', False)])[0])
+        ae(1, cache.multisort([('sort', False)])[0])
+        book_id = cache.create_book_entry(Metadata('0000'), apply_import_tags=False)
+        ae(book_id, cache.multisort([('title', True)])[0])
+        ae(book_id, cache.multisort([('last_modified', False)])[0])
+        ae(2, cache.multisort([('title', True)], ids_to_sort=(1, 2))[0])
+
+        # Test that books whose sort keys cannot be compared are sorted by id
+        from calibre.db.sorting import compute_ranks
+
+        class Unsortable:
+            def __lt__(self, other):
+                raise ValueError('cannot compare')
+        ae({1: 0, 3: 1, 7: 2}, compute_ranks((3, 1, 7), lambda book_id: Unsortable(), 'unsortable'))
     # }}}
 
     def test_get_metadata(self):  # {{{
@@ -243,6 +266,18 @@ def test_get_metadata(self):  # {{{
             self.compare_metadata(mi1, mi2)
     # }}}
 
+    def test_fields_for_books(self):  # {{{
+        'Test that fields_for_books() returns the same values as field_for()'
+        cache = self.init_cache(self.library_path)
+        fields = sorted(cache.fields) + ['nonexistent']
+        book_ids = (3, 1, 2, 1, 100)
+        ans = cache.fields_for_books(fields, book_ids)
+        self.assertEqual(set(ans), set(fields))
+        for field in fields:
+            self.assertEqual(ans[field], [cache.field_for(field, book_id) for book_id in book_ids], f'{field} values differ')
+        self.assertEqual(cache.fields_for_books(('title',), ()), {'title': []})
+    # }}}
+
     def test_serialize_metadata(self):  # {{{
         from calibre.library.field_metadata import fm_as_dict
         from calibre.utils.serialize import json_dumps, json_loads, msgpack_dumps, msgpack_loads
@@ -528,6 +563,62 @@ def test_datetime(self):  # {{{
             self.assertEqual(UNDEFINED_DATE, c_parse(x))
     # }}}
 
+    def test_compact_tables(self):  # {{{
+        ' Test storing the in-memory tables compactly '
+        from calibre.db.compact import CompactColumn, CompactLinks
+        from calibre.utils.config_base import tweaks
+        from calibre.utils.date import UNDEFINED_DATE
+
+        c = CompactColumn('datetime', {3: p('2011-09-07'), 1: None, 7: UNDEFINED_DATE})
+        self.assertEqual(dict(c), {1: None, 3: p('2011-09-07'), 7: UNDEFINED_DATE})
+        c[10] = datetime.datetime(2011, 1, 1)  # naive datetimes go into the overflow map
+        self.assertEqual(c.pop(10), datetime.datetime(2011, 1, 1))
+        self.assertNotIn(2, c)
+        self.assertNotIn('x', c)
+        self.assertEqual(len(c), 3)
+        c = CompactColumn('int', {1: 2**70, 2: -3})
+        c[5] = 1
+        self.assertEqual(c.copy(), {1: 2**70, 2: -3, 5: 1})
+        del c[1]
+        self.assertRaises(KeyError, c.__getitem__, 1)
+        c = CompactLinks({1: (1, 2), 2: (), 4: ('a',)})
+        c[3] = (7,)
+        c[1] = (3,)
+        del c[2]
+        self.assertEqual(c.copy(), {1: (3,), 3: (7,), 4: ('a',)})
+        c.compact()
+        self.assertEqual(c.copy(), {1: (3,), 3: (7,), 4: ('a',)})
+
+        def all_values(cache):
+            ans = {f: {book_id: cache.field_for(f, book_id) for book_id in cache.all_book_ids()} for f in cache.fields if f != 'marked'}
+            for field in ('timestamp', 'series_index', 'tags', '#yesno', 'series', 'size'):
+                ans[field + '-sorted'] = cache.multisort([(field, True)])
+            return ans
+
+        expected = all_values(self.init_cache(self.cloned_library))
+        orig = tweaks['compact_in_memory_tables']
+        tweaks['compact_in_memory_tables'] = True
+        try:
+            cache = self.init_cache(self.cloned_library)
+            self.assertIsInstance(cache.fields['timestamp'].table.book_col_map, CompactColumn)
+            self.assertIsInstance(cache.fields['tags'].table.book_col_map, CompactLinks)
+            self.assertFalse(cache.fields['size'].table.book_col_map.extra)
+            self.assertEqual(expected, all_values(cache))
+            cache.set_field('tags', {1: ('Tag One', 'New tag'), 2: ()})
+            cache.set_field('#yesno', {1: False, 2: None})
+            cache.set_field('series_index', {1: 3.5})
+            cache.remove_books((3,))
+            for c in (cache, self.init_cache(cache.backend.library_path)):
+                self.assertEqual(c.field_for('tags', 1), ('Tag One', 'New tag'))
+                self.assertEqual(c.field_for('tags', 2), ())
+                self.assertIs(c.field_for('#yesno', 1), False)
+                self.assertIsNone(c.field_for('#yesno', 2))
+                self.assertEqual(c.field_for('series_index', 1), 3.5)
+                self.assertEqual(c.all_book_ids(), {1, 2})
+        finally:
+            tweaks['compact_in_memory_tables'] = orig
+    # }}}
+
     def test_restrictions(self):  # {{{
         ' Test searching with and without restrictions '
         cache = self.init_cache()
@@ -602,6 +693,34 @@ def test(hit, result, *args, **kw):
         cache.set_field('publisher', {3:'ppppp', 2:'other'})
         # Test cache update worked
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        # Test that only searches using the changed fields are updated
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        test(False, {3}, 'publisher:=ppppp')
+        cache.set_field('tags', {3:'sometag'})
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        test(True, {3}, 'publisher:=ppppp')
+        cache.set_field('publisher', {2:'ppppp'})
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        test(False, {2, 3}, 'publisher:=ppppp')
+        cache._search_api.MAX_CACHE_UPDATE = 100
+        cache.set_field('title', {2:'yyy'})
+        test(True, {3}, 'title:=xxx or title:"=Title One"')
+        stats = cache.search_cache_stats()
+        self.assertGreater(stats['misses'], 0)
+        ae(stats['size'], len(c))
+        # Test that changing the title or authors updates searches on their sort fields
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        test(False, {2}, 'title_sort:=yyy')
+        test(False, {3}, 'author_sort:=Unknown')
+        cache.set_field('title', {2:'zzz'})
+        test(False, set(), 'title_sort:=yyy')
+        cache.set_field('authors', {3:['New Author']})
+        test(False, set(), 'author_sort:=Unknown')
+        # Test detection of searches whose results can change without the library changing
+        for q in ('', 'title:xxx', 'tags:=sometag or publisher:ppppp'):
+            self.assertTrue(cache.search_is_stable(q), q)
+        for q in ('date:>7daysago', 'marked:true', 'ondevice:true', 'template:"{title}#@#:t:xxx"', 'vl:x'):
+            self.assertFalse(cache.search_is_stable(q), q)
     # }}}
 
     def test_proxy_metadata(self):  # {{{
@@ -955,3 +1074,45 @@ def evaluate(book, ctx):
         unload_user_template_functions('aaaaa')
         self.assertEqual(set(v.split(',')), {'Tag One', 'News', 'Tag Two', 'one argument'})
     # }}}
+
+    def test_tables_cache(self):  # {{{
+        ' Test storing the in-memory tables on disk for fast opening of libraries '
+        from calibre.db.backend import DB
+        from calibre.db.cache import Cache
+        path = os.path.join(self.library_path, 'tables-cache.pickle')
+
+        def open_library():
+            backend = DB(self.library_path)
+            backend.tables_cache_path = path
+            cache = Cache(backend)
+            cache.init()
+            return cache
+
+        def all_data(cache):
+            book_ids = sorted(cache.all_book_ids())
+            return {field: cache.all_field_for(field, book_ids) for field in cache.fields if field != 'ondevice'}
+
+        cache = open_library()
+        self.assertTrue(os.path.exists(path))
+        mtime = os.stat(path).st_mtime_ns
+        expected = all_data(cache)
+        cache.close()
+        # Unchanged library, tables are loaded from disk
+        cache = open_library()
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+        self.assertEqual(all_data(cache), expected)
+        self.assertEqual(cache.search('tags:"=News"'), {book_id for book_id, tags in expected['tags'].items() if 'News' in tags})
+        cache.set_field('title', {1: 'changed'})
+        cache.set_field('tags', {2: ('new tag',)})
+        cache.close()
+        # Changed library, tables are read from the database and saved again
+        cache = open_library()
+        self.assertNotEqual(os.stat(path).st_mtime_ns, mtime)
+        self.assertEqual(cache.field_for('title', 1), 'changed')
+        self.assertEqual(cache.field_for('tags', 2), ('new tag',))
+        expected = all_data(cache)
+        cache.close()
+        cache = open_library()
+        self.assertEqual(all_data(cache), expected)
+        cache.close()
+    # }}}
@@ -9,7 +9,7 @@
 
 from calibre import walk
 from calibre.db.tests.base import BaseTest
-from calibre.db.utils import ThumbnailCache
+from calibre.db.utils import PackedThumbnailCache, ThumbnailCache
 
 
 class UtilsTest(BaseTest):
@@ -20,8 +20,10 @@ def setUp(self):
     def tearDown(self):
         shutil.rmtree(self.tdir)
 
+    tc_class = ThumbnailCache
+
     def init_tc(self, name='1', max_size=1):
-        return ThumbnailCache(name=name, location=self.tdir, max_size=max_size, test_mode=True)
+        return self.tc_class(name=name, location=self.tdir, max_size=max_size, test_mode=True)
 
     def basic_fill(self, c, num=5):
         total = 0
@@ -33,6 +35,13 @@ def basic_fill(self, c, num=5):
 
     def test_thumbnail_cache(self):  # {{{
         ' Test the operation of the thumbnail cache '
+        for cls in (ThumbnailCache, PackedThumbnailCache):
+            shutil.rmtree(self.tdir)
+            os.mkdir(self.tdir)
+            self.tc_class = cls
+            self.do_test_thumbnail_cache(cls)
+
+    def do_test_thumbnail_cache(self, cls):
         c = self.init_tc()
         self.assertFalse(hasattr(c, 'total_size'), 'index read on initialization')
         c.invalidate(666)
@@ -79,5 +88,25 @@ def test_thumbnail_cache(self):  # {{{
         c.set_thumbnail_size(200, 201)
         self.assertIsNone(c[1][0])
         self.assertEqual(len(c), 0)
-        self.assertEqual(tuple(walk(c.location)), (os.path.join(c.location, 'version'),))
+        if cls is ThumbnailCache:
+            self.assertEqual(tuple(walk(c.location)), (os.path.join(c.location, 'version'),))
+        else:
+            self.assertFalse([x for x in os.listdir(c.location) if x.startswith('pack-')])
+        c.shutdown()
+
+        if cls is PackedThumbnailCache:
+            # Test compaction of packs as thumbnails are replaced
+            c = self.init_tc()
+            for i in range(20):
+                self.basic_fill(c)
+            self.assertEqual(len(c), 5)
+            disk_size = sum(os.path.getsize(os.path.join(c.location, x)) for x in os.listdir(c.location) if x.startswith('pack-'))
+            self.assertLessEqual(disk_size, 2 * c.total_size + c.pack_size)
+            c.insert(3, 33, b'replaced')
+            c.shutdown()
+            c = self.init_tc()
+            self.assertEqual(len(c), 5)
+            self.assertEqual(c[3], (b'replaced', 33))
+            self.assertEqual(c.get_for_group('group', 5), ((b'5' * 5000), 5))
+            self.assertEqual(c.get_for_group('other', 5), (None, None))
     # }}}
@@ -727,6 +727,45 @@ def test_invalidate():
         test_invalidate()
     # }}}
 
+    def test_category_cache(self):  # {{{
+        ' Test that the cached categories are properly invalidated on writes '
+        cache = self.init_cache()
+
+        def as_data(categories):
+            return {k: [(t.name, t.count, frozenset(t.id_set), t.avg_rating, t.sort) for t in v] for k, v in categories.items()}
+
+        def test_invalidate(book_ids=None):
+            cached = as_data(cache.get_categories(book_ids=book_ids))
+            cache.category_cache.clear()
+            self.assertEqual(cached, as_data(cache.get_categories(book_ids=book_ids)))
+
+        for book_ids in (None, frozenset({1, 2})):
+            test_invalidate(book_ids)
+            hits = cache.category_cache.hits
+            # Callers must be able to modify the returned items
+            for t in cache.get_categories(book_ids=book_ids)['tags']:
+                t.count = -1
+            self.assertGreater(cache.category_cache.hits, hits)
+            test_invalidate(book_ids)
+        # As for a virtual library that matches no books
+        self.assertFalse(cache.get_categories(book_ids=[])['tags'])
+        self.assertFalse(cache.get_categories(book_ids=[])['tags'])
+        cache.set_field('tags', {1: ('Tag One', 'New tag')})
+        test_invalidate()
+        cache.set_field('rating', {2: 6})
+        test_invalidate()
+        cache.set_field('languages', {1: ('fra',)})
+        test_invalidate()
+        cache.rename_items('tags', {cache.get_item_id('tags', 'New tag'):'xxx'})
+        test_invalidate()
+        cache.set_sort_for_authors({cache.get_item_id('authors', 'Author One'):'meow'})
+        test_invalidate()
+        cache.add_format(1, 'ADD', BytesIO(b'xxxx'))
+        test_invalidate()
+        cache.remove_books((3,))
+        test_invalidate()
+    # }}}
+
     def test_dump_and_restore(self):  # {{{
         ' Test roundtripping the db through SQL '
         import warnings
@@ -743,6 +782,217 @@ def test_dump_and_restore(self):  # {{{
             self.assertEqual(int(cache.backend.user_version), uv)
     # }}}
 
+    def test_write_chunking(self):  # {{{
+        ' Test that long running writes yield the lock between chunks and profiling of lock use '
+        cache = self.init_cache()
+        shlock = cache.write_lock._shlock
+        yields = []
+        orig = shlock.yield_exclusive
+
+        def yield_exclusive():
+            yields.append(shlock.is_exclusive)
+            return orig()
+        shlock.yield_exclusive = yield_exclusive
+        cache.set_write_chunk_size(1)
+        self.assertEqual(cache.set_field('title', {1: 'a', 2: 'b', 3: 'c'}), {1, 2, 3})
+        self.assertEqual(yields, [1, 1])
+        self.assertEqual([cache.field_for('title', i) for i in (1, 2, 3)], ['a', 'b', 'c'])
+        del yields[:]
+        # Callers that already hold the lock must keep it throughout
+        with cache.write_lock:
+            self.assertEqual(cache.set_field('title', {1: 'x', 2: 'y'}), {1, 2})
+        self.assertFalse(yields)
+        cache.dump_metadata()
+        self.assertEqual(len(yields), 2)
+        self.assertFalse(cache.dirtied_cache)
+        del yields[:]
+        cache.set_write_chunk_size(0)
+        cache.set_field('title', {1: 'p', 2: 'q'})
+        self.assertFalse(yields)
+        cache.set_write_chunk_size(2)
+        cache.remove_books((1, 2, 3))
+        self.assertEqual(len(yields), 1)
+        self.assertFalse(cache.all_book_ids())
+
+        cache = self.init_cache()
+        self.assertIsNone(cache.lock_profile_stats())
+        cache.set_lock_profiling()
+        cache.field_for('title', 1)
+        cache.set_field('title', {1: 'z'})
+        s = cache.lock_profile_stats()
+        self.assertTrue(s['field_for']['shared'])
+        self.assertFalse(s['set_field']['shared'])
+        self.assertEqual(s['set_field']['calls'], 1)
+        self.assertEqual(sum(s['set_field']['hold_histogram']), 1)
+        self.assertEqual(cache.field_for('title', 1), 'z')
+        cache.set_lock_profiling(False)
+        self.assertIsNone(cache.lock_profile_stats())
+    # }}}
+
+    def test_snapshot(self):  # {{{
+        ' Test read only snapshots of the in-memory tables '
+        from threading import Event, Thread
+
+        from calibre.db.errors import SnapshotIsReadOnly
+        cache = self.init_cache()
+        snap = cache.snapshot()
+        self.assertIs(snap, cache.snapshot())
+        self.assertIs(snap, snap.snapshot())
+        self.assertEqual(snap.all_book_ids(), cache.all_book_ids())
+        for field in ('title', 'authors', 'tags', 'identifiers', 'formats', 'series_index', 'rating'):
+            self.assertEqual(snap.all_field_for(field, (1, 2, 3)), cache.all_field_for(field, (1, 2, 3)))
+        self.assertEqual(snap.get_metadata(1).title, cache.field_for('title', 1))
+        self.assertRaises(SnapshotIsReadOnly, snap.set_field, 'title', {1: 'x'})
+        self.assertRaises(SnapshotIsReadOnly, snap._set_field, 'title', {1: 'x'})
+        title, tags, idents = cache.field_for('title', 1), cache.field_for('tags', 1), cache.field_for('identifiers', 1)
+        cache.set_field('title', {1: 'changed'})
+        cache.set_field('tags', {1: ('newtag',), 2: ('newtag',)})
+        cache.set_field('identifiers', {1: {'isbn': '1234'}})
+        # Changes do not affect existing snapshots
+        self.assertEqual(snap.field_for('title', 1), title)
+        self.assertEqual(snap.field_for('tags', 1), tags)
+        self.assertEqual(snap.field_for('identifiers', 1), idents)
+        self.assertEqual(snap.search('tags:"=newtag"'), set())
+        s2 = cache.snapshot()
+        self.assertIsNot(s2, snap)
+        self.assertGreater(s2.tables_generation(), snap.tables_generation())
+        self.assertEqual(s2.tables_generation(), cache.tables_generation())
+        self.assertNotEqual(s2.database_key(), snap.database_key())
+        self.assertEqual(s2.field_for('title', 1), 'changed')
+        self.assertEqual(s2.search('tags:"=newtag"'), {1, 2})
+        self.assertEqual(s2.multisort([('title', True)]), cache.multisort([('title', True)]))
+        # Only the tables of the fields changed by APIs that report them are
+        # copied, the other tables and the cached results that do not depend
+        # on the changed fields are shared with the previous snapshot
+        s2.search('rating:>3'), s2.search('title:changed'), s2.multisort([('rating', True)])
+        cache.set_field('title', {2: 'retitled'})
+        inc = cache.snapshot()
+        self.assertIs(inc.fields['tags'].table, s2.fields['tags'].table)
+        self.assertIsNot(inc.fields['title'].table, s2.fields['title'].table)
+        self.assertEqual(inc.field_for('title', 2), 'retitled')
+        self.assertNotEqual(s2.field_for('title', 2), 'retitled')
+        self.assertIn('rating:>3', inc._search_api.cache.item_map)
+        self.assertNotIn('title:changed', inc._search_api.cache.item_map)
+        self.assertIn('rating', inc.sort_ranks.cache)
+        self.assertEqual(inc.search('title:retitled'), {2})
+        # Other changes copy all the tables
+        with cache.write_lock:
+            cache._set_field('tags', {2: ('other',)})
+        full = cache.snapshot()
+        self.assertIsNot(full.fields['rating'].table, inc.fields['rating'].table)
+        self.assertEqual(full.field_for('tags', 2), ('other',))
+        self.assertNotIn('rating:>3', full._search_api.cache.item_map)
+        cache.remove_books((3,))
+        self.assertEqual(cache.snapshot().all_book_ids(), {1, 2})
+        self.assertEqual(s2.all_book_ids(), {1, 2, 3})
+        # Background writes and writes that change only the database, not
+        # the tables, do not make the snapshot stale
+        s3 = cache.snapshot()
+        key = s3.database_key()
+        cache.dump_metadata()
+        cache.set_last_read_position(1, 'EPUB', cfi='/2')
+        annot = {'type': 'highlight', 'uuid': 'snap-1', 'highlighted_text': 'text', 'timestamp': '2026-01-01T00:00:00+00:00'}
+        cache.merge_annotations_for_book(1, 'EPUB', [annot], user_type='web', user='reader')
+        self.assertIs(cache.snapshot(), s3)
+        self.assertEqual(cache.tables_generation(), s3.tables_generation())
+        # Data read from the database by the snapshot is current
+        self.assertNotEqual(s3.database_key(), key)
+        self.assertEqual(s3.database_key().partition(':')[0], key.partition(':')[0])
+        self.assertEqual(len(s3.get_last_read_positions(1, 'EPUB', '_')), 1)
+        self.assertEqual(s3.annotation_count_for_book(1), 1)
+
+        # A stale snapshot is replaced only once no writer holds the lock, so
+        # that it includes all changes made before it was requested, and
+        # readers of the database via the snapshot wait for writers
+        cache.set_field('title', {1: 'edited'})
+        writing, done = Event(), Event()
+
+        def write():
+            with cache.write_lock:
+                writing.set()
+                done.wait()
+        titles, positions = [], []
+        t = Thread(target=write)
+        t.start()
+        writing.wait()
+        readers = (
+            Thread(target=lambda: titles.append(cache.snapshot().field_for('title', 1))),
+            Thread(target=lambda: positions.append(s3.get_last_read_positions(1, 'EPUB', '_'))),
+        )
+        for r in readers:
+            r.start()
+            r.join(0.05)
+            self.assertTrue(r.is_alive())
+        done.set()
+        for x in (t,) + readers:
+            x.join()
+        self.assertEqual(titles, ['edited'])
+        self.assertEqual(len(positions[0]), 1)
+        s4 = cache.snapshot()
+        with cache.write_lock:
+            cache._set_field('title', {1: 'mine'})
+            # The thread changing the tables gets the previous snapshot
+            self.assertIs(cache.snapshot(), s4)
+        self.assertEqual(cache.snapshot().field_for('title', 1), 'mine')
+    # }}}
+
+    def test_wal_mode(self):  # {{{
+        ' Test the WAL mode of the library database with read only connections '
+        import time
+        from contextlib import closing
+        from threading import Thread
+
+        import apsw
+
+        from calibre.utils.config import tweaks
+        orig = tweaks['use_wal_for_library_database']
+        tweaks['use_wal_for_library_database'] = True
+        try:
+            cache = self.init_cache()
+        finally:
+            tweaks['use_wal_for_library_database'] = orig
+        backend = cache.backend
+        dbpath = backend.dbpath
+        self.assertEqual(backend.conn.get('PRAGMA journal_mode', all=False), 'wal')
+        self.assertIsNotNone(backend.read_pool)
+        # Commits change the WAL file, not the database file
+        for path in (dbpath, dbpath + '-wal'):
+            os.utime(path, (time.time() - 100, time.time() - 100))
+        lm = cache.last_modified()
+        cache.set_field('title', {1: 'WAL title'})
+        self.assertGreater(cache.last_modified(), lm)
+        annot = {'type': 'highlight', 'uuid': 'wal-1', 'highlighted_text': 'some text', 'timestamp': '2026-01-01T00:00:00+00:00'}
+        cache.merge_annotations_for_book(1, 'EPUB', [annot], user_type='web', user='reader')
+        self.assertEqual(cache.snapshot().annotation_count_for_book(1), 1)
+        self.assertEqual(cache.all_annotations_for_book(1)[0]['annotation']['uuid'], 'wal-1')
+        cache.add_custom_book_data('wal', {1: 'one'})
+        # Uncommitted changes are visible only to the thread making them
+        other = []
+        with backend.conn:
+            backend.execute('UPDATE books_plugin_data SET val=? WHERE book=1 AND name=?', ('"two"', 'wal'))
+            self.assertEqual(backend.get_custom_book_data('wal', (1,)), {1: 'two'})
+            t = Thread(target=lambda: other.append(backend.get_custom_book_data('wal', (1,))))
+            t.start()
+            t.join()
+        self.assertEqual(other, [{1: 'one'}])
+        self.assertEqual(backend.get_custom_book_data('wal', (1,)), {1: 'two'})
+        # Backups are self contained
+        bpath = os.path.join(self.mkdtemp(), 'backup.db')
+        backend.backup_database(bpath)
+        with closing(apsw.Connection(bpath)) as bconn:
+            self.assertEqual(next(bconn.execute('PRAGMA journal_mode'))[0], 'delete')
+            self.assertEqual(next(bconn.execute('SELECT count(*) FROM annotations'))[0], 1)
+        cache.close()
+        self.assertIsNone(backend.read_pool)
+        self.assertFalse(os.path.exists(dbpath + '-wal') and os.path.getsize(dbpath + '-wal'))
+        # Turning off the tweak turns off WAL mode
+        cache = self.init_cache()
+        self.assertEqual(cache.backend.conn.get('PRAGMA journal_mode', all=False), 'delete')
+        self.assertIsNone(cache.backend.read_pool)
+        self.assertEqual(cache.annotation_count_for_book(1), 1)
+        cache.close()
+    # }}}
+
     def test_set_author_data(self):  # {{{
         cache = self.init_cache()
         adata = cache.author_data()
@@ -5,11 +5,13 @@
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import errno
+import mmap
 import os
 import re
 import shutil
+import struct
 import sys
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
 from contextlib import suppress
 from locale import localeconv
 from threading import Lock
@@ -145,12 +147,7 @@ def _do_delete(self, path):
         except OSError as err:
             self.log('Failed to delete cached thumbnail file:', as_unicode(err))
 
-    def _load_index(self):
-        '''
-        Load the index, automatically removing incorrectly sized thumbnails and
-        pruning to fit max_size
-        '''
-
+    def _prepare_location(self):
         # Remove the cache if it isn't the current version
         version_path = os.path.join(self.location, 'version')
         current_version = 0
@@ -170,20 +167,8 @@ def _load_index(self):
         except OSError as err:
             if err.errno != errno.EEXIST:
                 self.log('Failed to make thumbnail cache dir:', as_unicode(err))
-        self.total_size = 0
-        self.items = OrderedDict()
-        order = self._read_order()
-
-        def listdir(*args):
-            try:
-                return os.listdir(os.path.join(*args))
-            except OSError:
-                return ()  # not a directory or no permission or whatever
-        entries = ('/'.join((parent, subdir, entry))
-                   for parent in listdir(self.location)
-                   for subdir in listdir(self.location, parent)
-                   for entry in listdir(self.location, parent, subdir))
 
+    def _read_invalidate(self):
         invalidate = set()
         try:
             with open(os.path.join(self.location, 'invalidate'), 'rb') as f:
@@ -205,6 +190,29 @@ def record(line):
                     except Exception:
                         return None
                 invalidate = {record(x) for x in raw.splitlines()}
+        return invalidate
+
+    def _load_index(self):
+        '''
+        Load the index, automatically removing incorrectly sized thumbnails and
+        pruning to fit max_size
+        '''
+        self._prepare_location()
+        self.total_size = 0
+        self.items = OrderedDict()
+        order = self._read_order()
+
+        def listdir(*args):
+            try:
+                return os.listdir(os.path.join(*args))
+            except OSError:
+                return ()  # not a directory or no permission or whatever
+        entries = ('/'.join((parent, subdir, entry))
+                   for parent in listdir(self.location)
+                   for subdir in listdir(self.location, parent)
+                   for entry in listdir(self.location, parent, subdir))
+
+        invalidate = self._read_invalidate()
         items = []
         try:
             for entry in entries:
@@ -236,16 +244,50 @@ def _invalidate_sizes(self):
                 self._remove(key)
             self.size_changed = False
 
+    def _delete_entry(self, entry):
+        self._do_delete(entry.path)
+
+    def _read_entry(self, entry):
+        try:
+            with open(entry.path, 'rb') as f:
+                return f.read()
+        except OSError as err:
+            self.log('Failed to read cached thumbnail:', entry.path, as_unicode(err))
+
+    def _write_entry(self, key, timestamp, data):
+        ' Store data for key, returning the new entry or None on failure '
+        group_id, book_id = key
+        ts = (f'{timestamp:.2f}').replace('.00', '')
+        path = f'{group_id}{os.sep}{book_id % 100}{os.sep}{book_id}-{ts}-{len(data)}-{self.thumbnail_size[0]}x{self.thumbnail_size[1]}'
+        path = os.path.join(self.location, path)
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+        except OSError as err:
+            d = os.path.dirname(path)
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                except OSError as err:
+                    self.log('Failed to write cached thumbnail:', path, as_unicode(err))
+                    return
+            else:
+                self.log('Failed to write cached thumbnail:', path, as_unicode(err))
+                return
+        return Entry(path, len(data), timestamp, self.thumbnail_size)
+
     def _remove(self, key):
         entry = self.items.pop(key, None)
         if entry is not None:
-            self._do_delete(entry.path)
+            self._delete_entry(entry)
             self.total_size -= entry.size
 
     def _apply_size(self):
         while self.total_size > self.max_size and self.items:
             entry = self.items.popitem(last=False)[1]
-            self._do_delete(entry.path)
+            self._delete_entry(entry)
             self.total_size -= entry.size
 
     def _write_order(self):
@@ -288,36 +330,24 @@ def set_thumbnail_size(self, width, height):
         return False
 
     def insert(self, book_id, timestamp, data):
+        self.insert_for_group(self.group_id, book_id, timestamp, data)
+
+    def insert_for_group(self, group_id, book_id, timestamp, data):
         if self.max_size < len(data):
             return
         with self.lock:
             if not hasattr(self, 'total_size'):
                 self._load_index()
             self._invalidate_sizes()
-            ts = (f'{timestamp:.2f}').replace('.00', '')
-            path = f'{self.group_id}{os.sep}{book_id % 100}{os.sep}{book_id}-{ts}-{len(data)}-{self.thumbnail_size[0]}x{self.thumbnail_size[1]}'
-            path = os.path.join(self.location, path)
-            key = (self.group_id, book_id)
+            key = (group_id, book_id)
             e = self.items.pop(key, None)
-            self.total_size -= getattr(e, 'size', 0)
-            try:
-                with open(path, 'wb') as f:
-                    f.write(data)
-            except OSError as err:
-                d = os.path.dirname(path)
-                if not os.path.exists(d):
-                    try:
-                        os.makedirs(d)
-                        with open(path, 'wb') as f:
-                            f.write(data)
-                    except OSError as err:
-                        self.log('Failed to write cached thumbnail:', path, as_unicode(err))
-                        return self._apply_size()
-                else:
-                    self.log('Failed to write cached thumbnail:', path, as_unicode(err))
-                    return self._apply_size()
-            self.items[key] = Entry(path, len(data), timestamp, self.thumbnail_size)
-            self.total_size += len(data)
+            if e is not None:
+                self._delete_entry(e)
+                self.total_size -= e.size
+            entry = self._write_entry(key, timestamp, data)
+            if entry is not None:
+                self.items[key] = entry
+                self.total_size += len(data)
             self._apply_size()
 
     def __len__(self):
@@ -337,28 +367,24 @@ def __contains__(self, book_id):
                 return (self.group_id, book_id) in self.items
 
     def __getitem__(self, book_id):
+        return self.get_for_group(self.group_id, book_id)
+
+    def get_for_group(self, group_id, book_id):
         with self.lock:
             if not hasattr(self, 'total_size'):
                 self._load_index()
             self._invalidate_sizes()
-            key = (self.group_id, book_id)
+            key = (group_id, book_id)
             entry = self.items.pop(key, None)
             if entry is None:
                 return None, None
             if entry.thumbnail_size != self.thumbnail_size:
-                try:
-                    os.remove(entry.path)
-                except OSError as err:
-                    if getattr(err, 'errno', None) != errno.ENOENT:
-                        self.log('Failed to remove cached thumbnail:', entry.path, as_unicode(err))
+                self._delete_entry(entry)
                 self.total_size -= entry.size
                 return None, None
             self.items[key] = entry
-            try:
-                with open(entry.path, 'rb') as f:
-                    data = f.read()
-            except OSError as err:
-                self.log('Failed to read cached thumbnail:', entry.path, as_unicode(err))
+            data = self._read_entry(entry)
+            if data is None:
                 return None, None
             return data, entry.timestamp
 
@@ -391,7 +417,7 @@ def empty(self):
             if not hasattr(self, 'total_size'):
                 self._load_index()
             for entry in itervalues(self.items):
-                self._do_delete(entry.path)
+                self._delete_entry(entry)
             self.total_size = 0
             self.items = OrderedDict()
 
@@ -408,6 +434,521 @@ def set_size(self, size_in_mb):
                 self._apply_size()
 
 
+PackedEntry = namedtuple('PackedEntry', 'key pack offset size timestamp thumbnail_size')
+# op, length of group id, book_id, timestamp, pack number, offset, size, width, height
+INDEX_RECORD = struct.Struct('<BHqdIQIHH')
+PUT_RECORD, DELETE_RECORD = 1, 2
+
+
+class PackedThumbnailCache(ThumbnailCache):
+    ''' A version of :class:`ThumbnailCache` that stores thumbnails in a few
+    large append-only pack files, with a binary index, instead of using one
+    file per thumbnail. Thumbnails are read via mmap and returned as
+    memoryviews, without copying. Packs that are mostly unused after
+    thumbnails are evicted are compacted. '''
+
+    INDEX_MAGIC = b'CTPI\x01'
+
+    def __init__(self, *args, **kwargs):
+        ThumbnailCache.__init__(self, *args, **kwargs)
+        self.maps = {}
+        self.pack_file = self.index_file = None
+        self.pack_totals, self.pack_live = {}, defaultdict(int)
+        self.current_pack = 0
+        self.index_records = 0
+        self.compacting = False
+
+    @property
+    def pack_size(self):
+        return max(64 * 1024, min(32 * 1024**2, self.max_size // 8))
+
+    def _pack_path(self, num):
+        return os.path.join(self.location, f'pack-{num}')
+
+    def _load_index(self):
+        self._prepare_location()
+        self.total_size = 0
+        self.items = items = OrderedDict()
+        self.pack_totals, self.pack_live = {}, defaultdict(int)
+        invalidate = self._read_invalidate()
+        try:
+            names = os.listdir(self.location)
+        except OSError as err:
+            self.log('Failed to read thumbnail cache dir:', as_unicode(err))
+            names = ()
+        for name in names:
+            if name.startswith('pack-'):
+                with suppress(ValueError, OSError):
+                    num = int(name[5:])
+                    self.pack_totals[num] = os.path.getsize(self._pack_path(num))
+            elif os.path.isdir(os.path.join(self.location, name)):
+                # Thumbnails stored one per file by ThumbnailCache
+                shutil.rmtree(os.path.join(self.location, name), ignore_errors=True)
+        raw = b''
+        try:
+            with open(os.path.join(self.location, 'index'), 'rb') as f:
+                raw = f.read()
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                self.log('Failed to read thumbnail cache index:', as_unicode(err))
+        pos, rsz = len(self.INDEX_MAGIC), INDEX_RECORD.size
+        if not raw.startswith(self.INDEX_MAGIC):
+            raw = b''
+        while pos + rsz <= len(raw):
+            op, glen, book_id, timestamp, pack, offset, size, width, height = INDEX_RECORD.unpack_from(raw, pos)
+            pos += rsz
+            group_id = raw[pos:pos+glen]
+            pos += glen
+            if len(group_id) < glen:
+                break  # truncated index
+            key = group_id.decode('utf-8', 'replace'), book_id
+            items.pop(key, None)
+            if op == PUT_RECORD:
+                items[key] = PackedEntry(key, pack, offset, size, timestamp, (width, height))
+        for key, entry in tuple(iteritems(items)):
+            if (key in invalidate or entry.thumbnail_size != self.thumbnail_size or
+                    entry.offset + entry.size > self.pack_totals.get(entry.pack, -1)):
+                del items[key]
+            else:
+                self.total_size += entry.size
+                self.pack_live[entry.pack] += entry.size
+        self.current_pack = max(self.pack_totals, default=0)
+        for num in tuple(self.pack_totals):
+            if not self.pack_live[num]:
+                self._delete_pack(num)
+        self._write_index()
+        self._apply_size()
+
+    def _write_index(self):
+        ' Replace the index with one that has only the current entries, in LRU order '
+        if self.index_file is not None:
+            self.index_file.close()
+            self.index_file = None
+        path = os.path.join(self.location, 'index')
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                f.write(self.INDEX_MAGIC)
+                for entry in itervalues(self.items):
+                    f.write(self._index_record(PUT_RECORD, entry))
+            os.replace(path + '.tmp', path)
+        except OSError as err:
+            self.log('Failed to write thumbnail cache index:', as_unicode(err))
+        self.index_records = len(self.items)
+
+    def _index_record(self, op, entry):
+        group_id = entry.key[0].encode('utf-8')
+        return INDEX_RECORD.pack(
+            op, len(group_id), entry.key[1], entry.timestamp, entry.pack, entry.offset, entry.size,
+            entry.thumbnail_size[0], entry.thumbnail_size[1]) + group_id
+
+    def _append_index(self, op, entry):
+        if self.index_records > 2 * len(self.items) + 1024:
+            return self._write_index()
+        try:
+            if self.index_file is None:
+                self.index_file = open(os.path.join(self.location, 'index'), 'ab')
+                if not self.index_file.tell():
+                    self.index_file.write(self.INDEX_MAGIC)
+            self.index_file.write(self._index_record(op, entry))
+            self.index_file.flush()
+        except OSError as err:
+            self.log('Failed to write to thumbnail cache index:', as_unicode(err))
+        self.index_records += 1
+
+    def _close_files(self):
+        for attr in ('pack_file', 'index_file'):
+            f = getattr(self, attr)
+            if f is not None:
+                with suppress(OSError):
+                    f.close()
+                setattr(self, attr, None)
+
+    def _delete_pack(self, num):
+        # Do not close the mmap as there may still be memoryviews into it, it
+        # is closed automatically once they are all released
+        self.maps.pop(num, None)
+        self.pack_totals.pop(num, None)
+        self.pack_live.pop(num, None)
+        if num == self.current_pack and self.pack_file is not None:
+            self.pack_file.close()
+            self.pack_file = None
+        try:
+            os.remove(self._pack_path(num))
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            # On Windows files that are mapped cannot be deleted, they are
+            # deleted the next time the index is loaded instead
+            self.log('Failed to delete thumbnail cache pack:', as_unicode(err))
+
+    def _append(self, key, timestamp, data, thumbnail_size):
+        total = self.pack_totals.get(self.current_pack, 0)
+        if total and total + len(data) > self.pack_size:
+            if self.pack_file is not None:
+                self.pack_file.close()
+                self.pack_file = None
+            self.current_pack = max(self.pack_totals, default=0) + 1
+        num = self.current_pack
+        try:
+            if self.pack_file is None:
+                self.pack_file = open(self._pack_path(num), 'ab')
+            offset = self.pack_file.tell()
+            self.pack_file.write(data)
+            self.pack_file.flush()
+        except OSError as err:
+            self.log('Failed to write cached thumbnail:', self._pack_path(num), as_unicode(err))
+            return
+        finally:
+            if self.pack_file is not None:
+                with suppress(OSError):
+                    self.pack_totals[num] = self.pack_file.tell()
+        self.pack_live[num] += len(data)
+        entry = PackedEntry(key, num, offset, len(data), timestamp, thumbnail_size)
+        self._append_index(PUT_RECORD, entry)
+        return entry
+
+    def _write_entry(self, key, timestamp, data):
+        return self._append(key, timestamp, data, self.thumbnail_size)
+
+    def _read_entry(self, entry):
+        end = entry.offset + entry.size
+        mm = self.maps.get(entry.pack)
+        if mm is None or len(mm) < end:
+            try:
+                with open(self._pack_path(entry.pack), 'rb') as f:
+                    mm = self.maps[entry.pack] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError) as err:
+                self.log('Failed to read cached thumbnail:', self._pack_path(entry.pack), as_unicode(err))
+                return
+            if len(mm) < end:
+                self.log('Cached thumbnail pack truncated:', self._pack_path(entry.pack))
+                return
+        return memoryview(mm)[entry.offset:end]
+
+    def _delete_entry(self, entry):
+        self.pack_live[entry.pack] -= entry.size
+        self._append_index(DELETE_RECORD, entry)
+        self._compact()
+
+    def _compact(self):
+        if self.compacting:
+            return
+        self.compacting = True
+        try:
+            for num in sorted(self.pack_totals):
+                if num not in self.pack_totals:
+                    continue
+                total, live = self.pack_totals[num], self.pack_live[num]
+                if live <= 0:
+                    self._delete_pack(num)
+                    continue
+                if num == self.current_pack:
+                    if total - live <= self.pack_size // 2:
+                        continue
+                    # Start a new pack so that this one can be compacted
+                    if self.pack_file is not None:
+                        self.pack_file.close()
+                        self.pack_file = None
+                    self.current_pack = max(self.pack_totals) + 1
+                if live * 2 >= total:
+                    continue
+                # Move the remaining thumbnails to the current pack
+                for entry in tuple(e for e in itervalues(self.items) if e.pack == num):
+                    data = self._read_entry(entry)
+                    new_entry = None if data is None else self._append(entry.key, entry.timestamp, data, entry.thumbnail_size)
+                    if new_entry is None:
+                        del self.items[entry.key]
+                        self.total_size -= entry.size
+                    else:
+                        self.items[entry.key] = new_entry
+                self._delete_pack(num)
+        finally:
+            self.compacting = False
+
+    def _write_order(self):
+        if hasattr(self, 'items'):
+            self._write_index()
+
+    def shutdown(self):
+        with self.lock:
+            self._write_order()
+            self._close_files()
+
+    def empty(self):
+        with self.lock:
+            self._close_files()
+            self.maps.clear()
+            if not hasattr(self, 'total_size'):
+                self._prepare_location()
+            with suppress(OSError):
+                for name in os.listdir(self.location):
+                    if name == 'index' or name.startswith('pack-'):
+                        self._do_delete(os.path.join(self.location, name))
+            self.total_size = 0
+            self.items = OrderedDict()
+            self.pack_totals, self.pack_live = {}, defaultdict(int)
+            self.current_pack = self.index_records = 0
+
+
+def benchmark_thumbnail_caches(num=50000, thumbnail_size=8000):
+    '''
+    Compare the time taken to load the index and read all thumbnails from a
+    cold start and when already loaded, for the one file per thumbnail and the
+    packed thumbnail cache.
+    Run with: calibre-debug -c "from calibre.db.utils import benchmark_thumbnail_caches; benchmark_thumbnail_caches()"
+    '''
+    import tempfile
+    from time import monotonic
+    data = os.urandom(thumbnail_size)
+    max_size = 2 * num * thumbnail_size / 1024**2
+    with tempfile.TemporaryDirectory() as tdir:
+        for cls in (ThumbnailCache, PackedThumbnailCache):
+            name = cls.__name__
+
+            def create():
+                return cls(name=name, location=tdir, max_size=max_size)
+            c = create()
+            st = monotonic()
+            for book_id in range(1, num + 1):
+                c.insert(book_id, book_id, data)
+            c.shutdown()
+            print(f'{name}: wrote {num} thumbnails in {monotonic() - st:.2f}s')
+            for label in ('cold', 'warm'):
+                if label == 'cold':
+                    c = create()
+                st = monotonic()
+                for book_id in range(1, num + 1):
+                    if c[book_id][0] is None:
+                        raise ValueError(f'Thumbnail for {book_id} missing from {name}')
+                print(f'{name}: {label} load of {num} thumbnails in {monotonic() - st:.2f}s')
+            c.shutdown()
+
+
+def create_benchmark_library(tdir, num_books):
+    ' Create a library with num_books books with varied metadata in tdir, for benchmarking '
+    from time import monotonic
+
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    from calibre.ebooks.metadata.book.base import Metadata
+    db = Cache(DB(tdir))
+    db.init()
+    st = monotonic()
+    with db.write_lock, db.backend.conn:
+        for i in range(num_books):
+            mi = Metadata(f'Book {i}', [f'Author {i % 500}', f'Author {i % 77}'])
+            mi.tags = [f'Tag {i % 100}', f'Tag {i % 33}']
+            mi.series, mi.series_index = f'Series {i % 200}', i % 10 + 1
+            mi.publisher, mi.rating = f'Publisher {i % 50}', i % 10
+            mi.comments = f'<p>The comments for book number {i}</p>'
+            mi.identifiers = {'isbn': f'{i:013d}'}
+            db._create_book_entry(mi, apply_import_tags=False)
+    print(f'Created {num_books} books in {monotonic() - st:.2f}s')
+    return db
+
+
+def benchmark_bulk_reads(num_books=10000):
+    '''
+    Compare the time taken to list the fields used by calibredb list and to
+    build the JSON used by the server book list, reading one book at a time
+    and with Cache.fields_for_books().
+    Run with: calibre-debug -c "from calibre.db.utils import benchmark_bulk_reads; benchmark_bulk_reads()"
+    '''
+    import tempfile
+    from time import monotonic
+
+    from calibre.srv.metadata import book_as_json, books_as_json
+    with tempfile.TemporaryDirectory() as tdir:
+        db = create_benchmark_library(tdir, num_books)
+        book_ids = sorted(db.all_book_ids())
+        fields = ('title', 'authors', 'author_sort', 'publisher', 'rating', 'timestamp', 'tags', 'comments',
+                  'series', 'series_index', 'identifiers', 'languages', 'pubdate', 'last_modified', 'uuid')
+
+        def one_at_a_time():
+            return {field: [db.field_for(field, book_id) for book_id in book_ids] for field in fields}
+
+        def bulk():
+            return db.fields_for_books(fields, book_ids)
+
+        def json_one_at_a_time():
+            return {book_id: book_as_json(db, book_id) for book_id in book_ids}
+
+        def json_bulk():
+            ans = {}
+            for i in range(0, len(book_ids), 100):
+                ans.update(books_as_json(db, book_ids[i:i+100]))
+            return ans
+
+        for label, func in (
+            ('Listing, one book at a time', one_at_a_time), ('Listing, fields_for_books()', bulk),
+            ('Server JSON, one book at a time', json_one_at_a_time), ('Server JSON, in batches', json_bulk),
+        ):
+            st = monotonic()
+            func()
+            print(f'{label}: {monotonic() - st:.2f}s for {num_books} books')
+        db.close()
+
+
+def benchmark_lock_contention(num_books=5000, num_readers=4, num_writes=3, chunk_sizes=(0, 50)):
+    '''
+    Measure how long readers wait while another thread makes bulk changes to
+    the library, with and without writes being done in chunks, see
+    Cache.set_write_chunk_size(). Readers repeatedly read the metadata of
+    single books, as the server does, while a writer sets the tags of every
+    book num_writes times. Also prints the API calls that held the database
+    lock the longest.
+    Run with: calibre-debug -c "from calibre.db.utils import benchmark_lock_contention; benchmark_lock_contention()"
+    '''
+    import tempfile
+    from threading import Event, Thread
+    from time import monotonic
+
+    with tempfile.TemporaryDirectory() as tdir:
+        db = create_benchmark_library(tdir, num_books)
+        book_ids = sorted(db.all_book_ids())
+        for chunk_size in chunk_sizes:
+            db.set_write_chunk_size(chunk_size)
+            db.set_lock_profiling(False)
+            db.set_lock_profiling(True)
+            stop, latencies = Event(), []
+
+            def reader(n):
+                lat = []
+                while not stop.is_set():
+                    book_id = book_ids[n % len(book_ids)]
+                    st = monotonic()
+                    db.get_proxy_metadata(book_id).tags
+                    db.field_for('title', book_id)
+                    lat.append(monotonic() - st)
+                    n += 7
+                latencies.extend(lat)
+
+            readers = [Thread(target=reader, args=(i,), daemon=True) for i in range(num_readers)]
+            for t in readers:
+                t.start()
+            st = monotonic()
+            for i in range(num_writes):
+                db.set_field('tags', {book_id: [f'Write {i}', f'Tag {book_id % 10}'] for book_id in book_ids})
+            write_time = monotonic() - st
+            stop.set()
+            for t in readers:
+                t.join()
+            latencies.sort()
+
+            def pct(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+            print(f'\nWrite chunk size: {chunk_size or "unchunked"}')
+            print(f'Writes: {num_writes} of {num_books} books in {write_time:.2f}s')
+            print(f'Reads: {len(latencies)} ({len(latencies) / write_time:.0f}/s), latency (ms) median: {pct(0.5):.2f}'
+                  f' 99%: {pct(0.99):.2f} max: {latencies[-1] * 1000:.2f}')
+            print(db.lock_profile.report(limit=5))
+        db.set_lock_profiling(False)
+        db.close()
+
+
+def benchmark_library_open(num_books=100000, repeat=3):
+    '''
+    Compare the time taken to open a library with num_books books when the
+    in-memory tables are read from the database and when they are loaded from
+    the copy stored on disk, see tables_cache.py.
+    Run with: calibre-debug -c "from calibre.db.utils import benchmark_library_open; benchmark_library_open()"
+    '''
+    import tempfile
+    from time import monotonic
+
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    with tempfile.TemporaryDirectory() as tdir:
+        create_benchmark_library(tdir, num_books).close()
+        cache_path = os.path.join(tdir, 'tables-cache.pickle')
+
+        def open_library(tables_cache_path):
+            st = monotonic()
+            backend = DB(tdir)
+            backend.tables_cache_path = tables_cache_path
+            db = Cache(backend)
+            db.init()
+            ans = monotonic() - st
+            db.close()
+            return ans
+
+        open_library(cache_path)
+        print(f'Size of metadata.db: {os.path.getsize(os.path.join(tdir, "metadata.db")) / 1024**2:.1f}MB'
+              f' of the stored tables: {os.path.getsize(cache_path) / 1024**2:.1f}MB')
+        for label, path in (('Reading from the database', None), ('Loading stored tables', cache_path)):
+            times = [open_library(path) for i in range(repeat)]
+            print(f'{label}: best of {repeat}: {min(times):.2f}s')
+
+
+def benchmark_annotation_sync(num_books=1000, num_readers=4, num_syncs=500):
+    '''
+    Compare the normal and WAL modes of the library database, see the
+    use_wal_for_library_database tweak. A writer syncs highlights into
+    books, as the E-book viewer in the Content server does, while readers
+    use a snapshot of the library to read annotations, as the server does.
+    Run with: calibre-debug -c "from calibre.db.utils import benchmark_annotation_sync; benchmark_annotation_sync()"
+    '''
+    import tempfile
+    from threading import Event, Thread
+    from time import monotonic
+
+    from calibre.utils.config import tweaks
+    from calibre.utils.date import utcnow
+
+    def run(use_wal):
+        with tempfile.TemporaryDirectory() as tdir:
+            orig = tweaks['use_wal_for_library_database']
+            tweaks['use_wal_for_library_database'] = use_wal
+            try:
+                db = create_benchmark_library(tdir, num_books)
+            finally:
+                tweaks['use_wal_for_library_database'] = orig
+            book_ids = sorted(db.all_book_ids())
+            stop, latencies = Event(), []
+
+            def reader(n):
+                lat = []
+                while not stop.is_set():
+                    book_id = book_ids[n % len(book_ids)]
+                    sdb = db.snapshot()
+                    st = monotonic()
+                    sdb.all_annotations_for_book(book_id)
+                    sdb.annotation_count_for_book(book_id)
+                    sdb.get_last_read_positions(book_id, 'EPUB', 'reader')
+                    lat.append(monotonic() - st)
+                    n += 7
+                latencies.extend(lat)
+
+            readers = [Thread(target=reader, args=(i,), daemon=True) for i in range(num_readers)]
+            for t in readers:
+                t.start()
+            st = monotonic()
+            for i in range(num_syncs):
+                book_id = book_ids[i % len(book_ids)]
+                annot = {'type': 'highlight', 'uuid': f'highlight-{i}', 'highlighted_text': f'Highlighted text number {i}',
+                         'timestamp': utcnow().isoformat()}
+                db.merge_annotations_for_book(book_id, 'EPUB', [annot], user_type='web', user='reader')
+                db.set_last_read_position(book_id, 'EPUB', 'reader', 'device', cfi=f'/2/4/{i}', pos_frac=i / num_syncs)
+            write_time = monotonic() - st
+            stop.set()
+            for t in readers:
+                t.join()
+            db.close()
+            latencies.sort()
+
+            def pct(p):
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+            print(f'\n{"WAL" if use_wal else "Rollback journal"} mode')
+            print(f'Syncs: {num_syncs} in {write_time:.2f}s')
+            print(f'Reads: {len(latencies)} ({len(latencies) / write_time:.0f}/s), latency (ms) median: {pct(0.5):.2f}'
+                  f' 99%: {pct(0.99):.2f} max: {latencies[-1] * 1000:.2f}')
+
+    run(False)
+    run(True)
+
+
 number_separators = None
 
 
@@ -1101,6 +1101,9 @@ class Amazon(Source):
     has_html_comments = True
     supports_gzip_transfer_encoding = True
     prefer_results_with_isbn = False
+    # Amazon blocks clients that make too many requests
+    max_concurrent_queries = 1
+    min_query_interval = 1
 
     AMAZON_DOMAINS = {
         'com': _('US'),
@@ -8,7 +8,9 @@
 
 import re
 import threading
+import time
 from functools import total_ordering
+from time import monotonic
 
 from calibre import browser, random_user_agent
 from calibre.customize import Plugin
@@ -25,6 +27,58 @@ def create_log(ostream=None):
     return log
 
 
+class Throttle:
+
+    '''
+    Limits the number of queries made to a source at the same time and how
+    often they can be started, for when metadata is downloaded for many books
+    at once.
+    '''
+
+    def __init__(self, max_concurrent=1, min_interval=0):
+        self.semaphore = threading.BoundedSemaphore(max(1, max_concurrent))
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def acquire(self, abort=None):
+        ' Wait until a query can be started. Returns False, without acquiring, if abort is set while waiting. '
+        while not self.semaphore.acquire(timeout=0.1):
+            if abort is not None and abort.is_set():
+                return False
+        if self.min_interval > 0:
+            with self.lock:
+                now = monotonic()
+                start = max(now, self.next_start)
+                self.next_start = start + self.min_interval
+            delay = start - now
+            if delay > 0:
+                if abort is None:
+                    time.sleep(delay)
+                elif abort.wait(delay):
+                    self.semaphore.release()
+                    return False
+        return True
+
+    def release(self):
+        self.semaphore.release()
+
+
+def wait_started_at(workers, since):
+    '''
+    The time from which to wait for the workers that are still running: since
+    or, if later, the time the last of them started its query. Returns None
+    while any of them are still waiting for their turn to query the source,
+    see Throttle, so that time spent waiting is not counted against them.
+    '''
+    for w in workers:
+        if w.is_alive():
+            if w.query_started_at is None:
+                return None
+            since = max(since, w.query_started_at)
+    return since
+
+
 # Comparing Metadata objects for relevance {{{
 words = ('the', 'a', 'an', 'of', 'and')
 prefix_pat = re.compile(r'^(%s)\s+'%('|'.join(words)))
@@ -235,9 +289,20 @@ class Source(Plugin):
     #: ISBNs will be ignored
     prefer_results_with_isbn = True
 
+    #: The maximum number of queries (calls to :meth:`identify` and
+    #: :meth:`download_cover`) to this source that can run at the same time,
+    #: when downloading metadata for many books at once. Set to 1 if the
+    #: source cannot handle concurrent queries or blocks clients that make them.
+    max_concurrent_queries = 2
+
+    #: The minimum number of seconds between the starts of two queries to this
+    #: source, for sources that limit the rate of requests
+    min_query_interval = 0
+
     def __init__(self, *args, **kwargs):
         Plugin.__init__(self, *args, **kwargs)
         self.running_a_test = False  # Set to True when using identify_test()
+        self.throttle = Throttle(self.max_concurrent_queries, self.min_query_interval)
         self._isbn_to_identifier_cache = {}
         self._identifier_to_cover_url_cache = {}
         self.cache_lock = threading.RLock()
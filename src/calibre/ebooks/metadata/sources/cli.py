@@ -47,6 +47,8 @@ def option_parser():
                    ' By default, all metadata plugins will be used.'
                    ' Can be specified multiple times for multiple plugins.'
                    ' All plugin names: {}').format(', '.join(p.name for p in all_metadata_plugins())))
+    parser.add_option('--no-cache', default=False, action='store_true',
+            help=_('Do not use results cached from earlier downloads, always query the metadata sources.'))
 
     return parser
 
@@ -76,7 +78,7 @@ def main(args=sys.argv):
     allowed_plugins = frozenset(opts.allowed_plugin)
     results = identify(log, abort, title=opts.title, authors=authors,
             identifiers=identifiers, timeout=int(opts.timeout),
-            allowed_plugins=allowed_plugins or None)
+            allowed_plugins=allowed_plugins or None, use_results_cache=not opts.no_cache)
 
     if not results:
         prints(buf.getvalue(), file=sys.stderr)
@@ -87,7 +89,7 @@ def main(args=sys.argv):
     cf = None
     if opts.cover and results:
         cover = download_cover(log, title=opts.title, authors=authors,
-                identifiers=result.identifiers, timeout=int(opts.timeout))
+                identifiers=result.identifiers, timeout=int(opts.timeout), use_results_cache=not opts.no_cache)
         if cover is None:
             if not opts.opf:
                 prints('No cover found', file=sys.stderr)
@@ -11,8 +11,9 @@
 from threading import Event, Thread
 
 from calibre.customize.ui import metadata_plugins
-from calibre.ebooks.metadata.sources.base import create_log
+from calibre.ebooks.metadata.sources.base import create_log, wait_started_at
 from calibre.ebooks.metadata.sources.prefs import msprefs
+from calibre.ebooks.metadata.sources.results_cache import cover_entry, load_cover_entry, log_cache_stats, run_cached
 from calibre.utils.img import image_from_data, image_to_data, remove_borders_from_image, save_cover_data_to
 from calibre.utils.imghdr import identify
 from polyglot.queue import Empty, Queue
@@ -20,7 +21,7 @@
 
 class Worker(Thread):
 
-    def __init__(self, plugin, abort, title, authors, identifiers, timeout, rq, get_best_cover=False):
+    def __init__(self, plugin, abort, title, authors, identifiers, timeout, rq, get_best_cover=False, use_results_cache=True):
         Thread.__init__(self)
         self.daemon = True
 
@@ -32,24 +33,40 @@ def __init__(self, plugin, abort, title, authors, identifiers, timeout, rq, get_
         self.title, self.authors, self.identifiers = (title, authors,
                 identifiers)
         self.timeout, self.rq = timeout, rq
-        self.time_spent = None
+        self.use_results_cache = use_results_cache
+        self.time_spent = self.cache_hit = self.query_started_at = None
 
     def run(self):
         start_time = time.time()
-        if not self.abort.is_set():
+        extra = {'get_best_cover': self.get_best_cover} if self.plugin.can_get_multiple_covers else {}
+        self.cache_hit = run_cached(
+            'cover', self.plugin, self.query, self.use_results_cache, self.rq, self.abort, self.log,
+            cover_entry, load_cover_entry, title=self.title, authors=self.authors, identifiers=self.identifiers, **extra)
+        self.time_spent = time.time() - start_time
+
+    def query(self, rq):
+        if not self.plugin.throttle.acquire(self.abort):
+            return False
+        self.query_started_at = time.time()
+        try:
+            if self.abort.is_set():
+                return False
             try:
                 if self.plugin.can_get_multiple_covers:
-                    self.plugin.download_cover(self.log, self.rq, self.abort,
+                    self.plugin.download_cover(self.log, rq, self.abort,
                         title=self.title, authors=self.authors, get_best_cover=self.get_best_cover,
                         identifiers=self.identifiers, timeout=self.timeout)
                 else:
-                    self.plugin.download_cover(self.log, self.rq, self.abort,
+                    self.plugin.download_cover(self.log, rq, self.abort,
                         title=self.title, authors=self.authors,
                         identifiers=self.identifiers, timeout=self.timeout)
             except:
                 self.log.exception('Failed to download cover from',
                         self.plugin.name)
-        self.time_spent = time.time() - start_time
+                return False
+            return True
+        finally:
+            self.plugin.throttle.release()
 
 
 def is_worker_alive(workers):
@@ -80,7 +97,7 @@ def process_result(log, result):
 
 
 def run_download(log, results, abort,
-        title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False):
+        title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False, use_results_cache=True):
     '''
     Run the cover download, putting results into the queue :param:`results`.
 
@@ -97,8 +114,8 @@ def run_download(log, results, abort,
     plugins = [p for p in metadata_plugins(['cover']) if p.is_configured()]
 
     rq = Queue()
-    workers = [Worker(p, abort, title, authors, identifiers, timeout, rq, get_best_cover=get_best_cover) for p
-            in plugins]
+    workers = [Worker(p, abort, title, authors, identifiers, timeout, rq, get_best_cover=get_best_cover,
+                      use_results_cache=use_results_cache) for p in plugins]
     for w in workers:
         w.start()
 
@@ -106,8 +123,8 @@ def run_download(log, results, abort,
     wait_time = msprefs['wait_after_first_cover_result']
     found_results = {}
 
-    start_time = time.time()  # Use a global timeout to workaround misbehaving plugins that hang
-    while time.time() - start_time < 301:
+    start_time = time.time()
+    while True:
         time.sleep(0.1)
         try:
             x = rq.get_nowait()
@@ -123,7 +140,17 @@ def run_download(log, results, abort,
         if not is_worker_alive(workers):
             break
 
-        if first_result_at is not None and time.time() - first_result_at > wait_time:
+        # Use a global timeout to workaround misbehaving plugins that hang,
+        # not counting time spent waiting for a turn to query a source, unless
+        # it is so long that the query for some other book must have hung
+        waiting_since, limit = wait_started_at(workers, start_time), 301
+        if waiting_since is None:
+            waiting_since, limit = start_time, 3 * 301
+        if time.time() - waiting_since > limit:
+            break
+
+        waiting_since = None if first_result_at is None else wait_started_at(workers, first_result_at)
+        if waiting_since is not None and time.time() - waiting_since > wait_time:
             log('Not waiting for any more results')
             abort.set()
 
@@ -156,10 +183,11 @@ def run_download(log, results, abort,
         if wlog:
             log(wlog)
         log('\n'+'*'*80)
+    log_cache_stats(log, workers)
 
 
 def download_cover(log,
-        title=None, authors=None, identifiers={}, timeout=30):
+        title=None, authors=None, identifiers={}, timeout=30, use_results_cache=True):
     '''
     Synchronous cover download. Returns the "best" cover as per user
     prefs/cover resolution.
@@ -172,7 +200,7 @@ def download_cover(log,
     abort = Event()
 
     run_download(log, rq, abort, title=title, authors=authors,
-            identifiers=identifiers, timeout=timeout, get_best_cover=True)
+            identifiers=identifiers, timeout=timeout, get_best_cover=True, use_results_cache=use_results_cache)
 
     results = []
 
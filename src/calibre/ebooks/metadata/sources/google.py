@@ -213,6 +213,9 @@ class GoogleBooks(Source):
     })
     supports_gzip_transfer_encoding = True
     cached_cover_url_is_reliable = False
+    # Google throttles requests returning 403 Forbidden errors
+    max_concurrent_queries = 1
+    min_query_interval = 0.5
 
     GOOGLE_COVER = 'https://books.google.com/books?id=%s&printsec=frontcover&img=1'
 
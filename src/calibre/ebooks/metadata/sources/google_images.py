@@ -67,6 +67,7 @@ class GoogleImages(Source):
     capabilities = frozenset(['cover'])
     can_get_multiple_covers = True
     supports_gzip_transfer_encoding = True
+    max_concurrent_queries = 1
     options = (Option('max_covers', 'number', 5, _('Maximum number of covers to get'),
                       _('The maximum number of covers to process from the Google search result')),
                Option('size', 'choices', 'svga', _('Cover size'),
@@ -16,8 +16,9 @@
 from calibre.customize.ui import all_metadata_plugins, metadata_plugins
 from calibre.ebooks.metadata import authors_to_sort_string, check_issn
 from calibre.ebooks.metadata.book.base import Metadata
-from calibre.ebooks.metadata.sources.base import create_log
+from calibre.ebooks.metadata.sources.base import create_log, wait_started_at
 from calibre.ebooks.metadata.sources.prefs import msprefs
+from calibre.ebooks.metadata.sources.results_cache import identify_entry, load_identify_entry, log_cache_stats, run_cached
 from calibre.ebooks.metadata.xisbn import xisbn
 from calibre.utils.date import UNDEFINED_DATE, as_utc, utc_tz
 from calibre.utils.formatter import EvalFormatter
@@ -32,22 +33,39 @@
 
 class Worker(Thread):
 
-    def __init__(self, plugin, kwargs, abort):
+    def __init__(self, plugin, kwargs, abort, use_results_cache=True):
         Thread.__init__(self)
         self.daemon = True
 
         self.plugin, self.kwargs, self.rq = plugin, kwargs, Queue()
         self.abort = abort
+        self.use_results_cache = use_results_cache
+        self.cache_hit = self.query_started_at = None
         self.buf = StringIO()
         self.log = create_log(self.buf)
 
     def run(self):
-        start = time.time()
+        kw = self.kwargs
+        self.cache_hit = run_cached(
+            'identify', self.plugin, self.query, self.use_results_cache, self.rq, self.abort, self.log,
+            identify_entry, load_identify_entry, title=kw['title'], authors=kw['authors'], identifiers=kw['identifiers'])
+        if self.cache_hit:
+            self.plugin.dl_time_spent = 0
+
+    def query(self, rq):
+        if not self.plugin.throttle.acquire(self.abort):
+            return False
+        start = self.query_started_at = time.time()
+        ok = False
         try:
-            self.plugin.identify(self.log, self.rq, self.abort, **self.kwargs)
+            self.plugin.identify(self.log, rq, self.abort, **self.kwargs)
+            ok = True
         except:
             self.log.exception('Plugin', self.plugin.name, 'failed')
+        finally:
+            self.plugin.throttle.release()
         self.plugin.dl_time_spent = time.time() - start
+        return ok
 
     @property
     def name(self):
@@ -370,7 +388,7 @@ def merge_identify_results(result_map, log):
 
 
 def identify(log, abort,  # {{{
-        title=None, authors=None, identifiers={}, timeout=30, allowed_plugins=None):
+        title=None, authors=None, identifiers={}, timeout=30, allowed_plugins=None, use_results_cache=True):
     if title == _('Unknown'):
         title = None
     if authors == [_('Unknown')]:
@@ -392,7 +410,7 @@ def identify(log, abort,  # {{{
     log('Using plugins:', ', '.join(['%s %s' % (p.name, p.version) for p in plugins]))
     log('The log from individual plugins is below')
 
-    workers = [Worker(p, kwargs, abort) for p in plugins]
+    workers = [Worker(p, kwargs, abort, use_results_cache) for p in plugins]
     for w in workers:
         w.start()
 
@@ -424,7 +442,10 @@ def get_results():
         if not is_worker_alive(workers):
             break
 
-        if (first_result_at is not None and time.time() - first_result_at > wait_time):
+        # Sources that had to wait for their turn get the full wait time
+        # after starting their query
+        waiting_since = None if first_result_at is None else wait_started_at(workers, first_result_at)
+        if waiting_since is not None and time.time() - waiting_since > wait_time:
             log.warn('Not waiting any longer for more results. Still running'
                     ' sources:')
             for worker in workers:
@@ -493,6 +514,7 @@ def get_results():
                     result.comments = html2text(result.comments)
 
     log('The identify phase took %.2f seconds'%(time.time() - start_time))
+    log_cache_stats(log, workers)
     log('The longest time (%f) was taken by:'%longest, lp)
     log('Merging results from different sources')
     start_time = time.time()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# A metadata source that makes up its results after a delay, instead of
+# querying a server, for testing and benchmarking bulk metadata downloads.
+
+from threading import Event, Lock
+
+from calibre.ebooks.metadata.book.base import Metadata
+from calibre.ebooks.metadata.sources.base import Source
+
+
+class MockSource(Source):
+
+    name = 'Mock source'
+    version = (1, 0, 0)
+    description = 'Returns made up metadata and covers after a delay, without using the network'
+    capabilities = frozenset(('identify', 'cover'))
+    touched_fields = frozenset(('title', 'authors', 'identifier:mock'))
+
+    def __init__(self, name='Mock source', latency=0.1, max_concurrent_queries=2, min_query_interval=0):
+        self.name, self.latency = name, latency
+        self.max_concurrent_queries, self.min_query_interval = max_concurrent_queries, min_query_interval
+        Source.__init__(self, None)
+        self.lock = Lock()
+        self.num_queries = self.active_queries = self.max_active_queries = self.num_results = 0
+
+    def simulate_query(self, abort):
+        with self.lock:
+            self.num_queries += 1
+            self.active_queries += 1
+            self.max_active_queries = max(self.max_active_queries, self.active_queries)
+        try:
+            abort.wait(self.latency)
+        finally:
+            with self.lock:
+                self.active_queries -= 1
+
+    def identify(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30):
+        self.simulate_query(abort)
+        if not abort.is_set():
+            with self.lock:
+                self.num_results += 1
+            mi = Metadata(title, authors)
+            mi.set_identifier('mock', str(self.num_queries))
+            mi.source_relevance = 0
+            result_queue.put(mi)
+
+    def download_cover(self, log, result_queue, abort, title=None, authors=None, identifiers={}, timeout=30, get_best_cover=False):
+        self.simulate_query(abort)
+        if not abort.is_set():
+            result_queue.put((self, b'cover data'))
+
+
+def query_sources(sources, title, authors):
+    ' Query all the sources, each in its own thread, first for metadata and then for a cover, the way identify() and download_cover() do '
+    from calibre.ebooks.metadata.sources.covers import Worker as CoverWorker
+    from calibre.ebooks.metadata.sources.identify import Worker
+    from polyglot.queue import Queue
+    abort = Event()
+    kwargs = {'title': title, 'authors': authors, 'identifiers': {}, 'timeout': 30}
+    workers = [Worker(s, kwargs, abort, use_results_cache=False) for s in sources]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    rq = Queue()
+    workers = [CoverWorker(s, abort, title, authors, {}, 30, rq, use_results_cache=False) for s in sources if 'cover' in s.capabilities]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return rq.qsize()
+
+
+def benchmark_bulk_download(num_books=40, worker_counts=(1, 2, 4, 8), latency=0.2):
+    '''
+    Measure how the number of books processed at a time affects the speed of
+    bulk metadata downloads, using mock sources with different limits on the
+    number of concurrent queries they allow.
+    Run with: calibre-debug -c "from calibre.ebooks.metadata.sources.mock import benchmark_bulk_download; benchmark_bulk_download()"
+    '''
+    from time import monotonic
+
+    from calibre.ebooks.metadata.sources.worker import download_concurrently
+    print(f'Downloading metadata and covers for {num_books} books, each query takes {latency}s')
+    for num_workers in worker_counts:
+        sources = [
+            MockSource('Unlimited', latency, max_concurrent_queries=num_workers),
+            MockSource('Two at a time', latency, max_concurrent_queries=2),
+            MockSource('Rate limited', latency, max_concurrent_queries=1, min_query_interval=latency / 2),
+        ]
+        st = monotonic()
+        download_concurrently(range(num_books), lambda book_id: query_sources(sources, f'Book {book_id}', ['Some author']), num_workers)
+        elapsed = monotonic() - st
+        print(f'{num_workers} books at a time: {elapsed:.2f}s ({num_books / elapsed:.1f} books/s),'
+              ' most concurrent queries per source:', ', '.join(f'{s.name}: {s.max_active_queries}' for s in sources))
+
+
+def find_tests():
+    import unittest
+    from time import monotonic
+
+    class TestBulkDownload(unittest.TestCase):
+
+        def test_throttled_concurrent_download(self):
+            from calibre.ebooks.metadata.sources.worker import download_concurrently
+            limited = MockSource('Limited', 0.05, max_concurrent_queries=2)
+            single = MockSource('Single', 0.01, max_concurrent_queries=1, min_query_interval=0.02)
+            results = download_concurrently(range(8), lambda book_id: query_sources((limited, single), f'Book {book_id}', ['A']), 6)
+            self.assertEqual(results, dict.fromkeys(range(8), 2))
+            for s in (limited, single):
+                self.assertEqual(s.num_queries, 16)
+                self.assertEqual(s.active_queries, 0)
+            self.assertEqual(limited.max_active_queries, 2)
+            self.assertEqual(single.max_active_queries, 1)
+
+        def test_no_results_lost_while_waiting(self):
+            # Sources that have to wait for their turn to be queried must not
+            # be aborted because other sources returned results long before
+            from io import StringIO
+            from unittest.mock import patch
+
+            from calibre.ebooks.metadata.sources import identify as identify_module
+            from calibre.ebooks.metadata.sources.base import create_log
+            from calibre.ebooks.metadata.sources.prefs import msprefs
+            from calibre.ebooks.metadata.sources.worker import download_concurrently
+            fast = MockSource('Fast', 0.01, max_concurrent_queries=6)
+            slow = MockSource('Slow', 0.15, max_concurrent_queries=1)
+            prefs = dict(msprefs.defaults, wait_after_first_identify_result=0.3)
+
+            def download(book_id):
+                return identify_module.identify(create_log(StringIO()), Event(), title=f'Book {book_id}', authors=['A'], use_results_cache=False)
+
+            with patch.object(identify_module, 'metadata_plugins', lambda capabilities: [fast, slow]), patch.object(identify_module, 'msprefs', prefs):
+                download_concurrently(range(6), download, 6)
+            self.assertEqual(fast.num_results, 6)
+            self.assertEqual(slow.num_results, 6)
+
+        def test_throttle(self):
+            from calibre.ebooks.metadata.sources.base import Throttle
+            t = Throttle(1, 0.05)
+            st = monotonic()
+            for i in range(3):
+                self.assertTrue(t.acquire())
+                t.release()
+            self.assertGreaterEqual(monotonic() - st, 0.1)
+            abort = Event()
+            self.assertTrue(t.acquire(abort))
+            abort.set()
+            self.assertFalse(t.acquire(abort))
+            t.release()
+            self.assertTrue(t.acquire())
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestBulkDownload)
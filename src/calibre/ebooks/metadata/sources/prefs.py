@@ -24,6 +24,10 @@
 msprefs.defaults['series_map_rules'] = ()
 msprefs.defaults['id_link_rules'] = {}
 msprefs.defaults['keep_dups'] = False
+msprefs.defaults['concurrent_bulk_downloads'] = 4  # books
+# Results from metadata sources are cached on disk, see results_cache.py
+msprefs.defaults['results_cache_ttl'] = 1  # days, zero disables the cache
+msprefs.defaults['results_cache_size'] = 100  # MB
 
 # Google covers are often poor quality (scans/errors) but they have high
 # resolution, so they trump covers from better sources. So make sure they
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# A persistent cache of the results of querying metadata sources, so that
+# downloading metadata again for the same books, for example, after a bulk
+# download failed part way through, does not query the sources again. Results
+# are kept for msprefs['results_cache_ttl'] days in a database in the calibre
+# cache folder, whose size is limited to msprefs['results_cache_size'] MB.
+# Only successful queries are cached.
+
+import hashlib
+import json
+import os
+import time
+import unicodedata
+from threading import Lock
+
+import apsw
+
+from calibre.constants import cache_dir
+from calibre.ebooks.metadata.sources.prefs import msprefs
+from calibre.utils.serialize import msgpack_dumps, msgpack_loads
+
+# Increment this when the format of the cached results changes
+VERSION = 1
+
+
+def normalize(x):
+    return ' '.join(unicodedata.normalize('NFKC', x or '').casefold().split())
+
+
+def cache_key(kind, plugin, title=None, authors=None, identifiers=None, **extra):
+    ' A key for a query of kind, either identify or cover, to the source plugin '
+    data = (
+        VERSION, kind, plugin.name, plugin.version, dict(plugin.prefs), normalize(title),
+        sorted(normalize(a) for a in authors or ()),
+        sorted((normalize(k), (v or '').strip()) for k, v in (identifiers or {}).items()),
+        sorted(extra.items()),
+    )
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+
+class RecordingQueue:
+
+    ' Wraps the queue a source puts results into, recording the results, so that they can be cached '
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.items = []
+
+    def put(self, item, *a, **kw):
+        self.items.append(item)
+        self.queue.put(item, *a, **kw)
+
+    def put_nowait(self, item):
+        self.put(item, False)
+
+
+def identify_entry(plugin, results):
+    ' The data to cache for the results of identify() on plugin, including the parts of its cache that they use '
+    vals = {v for mi in results for v in mi.identifiers.values()}
+    caches = plugin.dump_caches()
+    isbn_map = {isbn: q for isbn, q in caches['isbn_to_identifier'].items() if isbn in vals or q in vals}
+    vals |= set(isbn_map.values())
+    cover_map = {k: url for k, url in caches['identifier_to_cover'].items() if k in vals}
+    return {
+        'results': list(results), 'relevance': [getattr(mi, 'source_relevance', 0) for mi in results],
+        'caches': {'isbn_to_identifier': isbn_map, 'identifier_to_cover': cover_map},
+    }
+
+
+def load_identify_entry(plugin, entry, result_queue):
+    plugin.load_caches(entry['caches'])
+    for mi, relevance in zip(entry['results'], entry['relevance']):
+        mi.source_relevance = relevance
+        result_queue.put(mi)
+
+
+def cover_entry(plugin, results):
+    return [data for p, data in results]
+
+
+def load_cover_entry(plugin, entry, result_queue):
+    for data in entry:
+        result_queue.put((plugin, data))
+
+
+class ResultsCache:
+
+    def __init__(self, path=None, ttl=None, max_size=None):
+        self.path = path or os.path.join(cache_dir(), 'metadata-sources', 'results.sqlite')
+        self.ttl = (msprefs['results_cache_ttl'] if ttl is None else ttl) * 86400
+        self.max_size = (msprefs['results_cache_size'] if max_size is None else max_size) * 1024 * 1024
+        self.lock = Lock()
+        self._conn = None
+        self.num_stored = 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.max_size > 0
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = apsw.Connection(self.path)
+            conn.setbusytimeout(5000)
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, created REAL NOT NULL, size INTEGER NOT NULL, data BLOB NOT NULL);'
+                'CREATE INDEX IF NOT EXISTS results_created ON results (created);')
+            self._conn = conn
+        return self._conn
+
+    def get(self, key):
+        ' Return the cached data for key or None if there is none or it has expired '
+        ans = None
+        with self.lock:
+            try:
+                for created, data in self.conn.execute('SELECT created, data FROM results WHERE key=?', (key,)):
+                    if time.time() - created < self.ttl:
+                        ans = msgpack_loads(data)
+            except Exception:
+                # The cache must never cause downloads to fail
+                import traceback
+                traceback.print_exc()
+        return ans
+
+    def set(self, key, data):
+        with self.lock:
+            try:
+                raw = msgpack_dumps(data)
+                with self.conn:
+                    self.conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, time.time(), len(raw), raw))
+                self.num_stored += 1
+                if self.num_stored % 32 == 1:
+                    self.expire()
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+    def expire(self):
+        ' Remove expired results, and the oldest results if the cache is too large '
+        conn = self.conn
+        with conn:
+            conn.execute('DELETE FROM results WHERE created < ?', (time.time() - self.ttl,))
+            total = conn.execute('SELECT SUM(size) FROM results').fetchone()[0] or 0
+            if total > self.max_size:
+                # Go down to 90% of the limit, so that this is not needed on every store
+                excess, remove = total - int(0.9 * self.max_size), []
+                for key, size in conn.execute('SELECT key, size FROM results ORDER BY created'):
+                    if excess <= 0:
+                        break
+                    remove.append((key,))
+                    excess -= size
+                conn.executemany('DELETE FROM results WHERE key=?', remove)
+
+    def clear(self):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('DELETE FROM results')
+
+    def close(self):
+        with self.lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_results_cache = None
+_results_cache_lock = Lock()
+
+
+def results_cache():
+    ' The cache used for all queries in this process, or None if caching is disabled '
+    global _results_cache
+    with _results_cache_lock:
+        if _results_cache is None:
+            _results_cache = ResultsCache()
+        return _results_cache if _results_cache.enabled else None
+
+
+def log_cache_stats(log, workers):
+    hits = sum(1 for w in workers if w.cache_hit)
+    misses = sum(1 for w in workers if w.cache_hit is False)
+    if hits or misses:
+        log(f'Cache of earlier downloads: {hits} hits, {misses} misses')
+
+
+def run_cached(kind, plugin, query, use_cache, result_queue, abort, log, make_entry, load_entry, **key_data):
+    '''
+    Run query(result_queue), using cached results from an earlier run, if
+    available. Returns True if cached results were used, False if not and None
+    if caching is disabled.
+    '''
+    cache = results_cache() if use_cache else None
+    if cache is None:
+        query(result_queue)
+        return None
+    key = cache_key(kind, plugin, **key_data)
+    entry = cache.get(key)
+    if entry is not None:
+        log('Using results from the cache of earlier downloads')
+        load_entry(plugin, entry, result_queue)
+        return True
+    rq = RecordingQueue(result_queue)
+    if query(rq) and rq.items and not abort.is_set():
+        cache.set(key, make_entry(plugin, rq.items))
+    return False
+
+
+def find_tests():
+    import unittest
+    from threading import Event
+
+    from calibre.ptempfile import TemporaryDirectory
+    from polyglot.queue import Queue
+
+    class TestResultsCache(unittest.TestCase):
+
+        def setUp(self):
+            from calibre.ebooks.metadata.sources.mock import MockSource
+            self.tdir = TemporaryDirectory('_results_cache')
+            self.cache = ResultsCache(os.path.join(self.tdir.__enter__(), 'results.sqlite'), ttl=1, max_size=1)
+            self.source = MockSource(latency=0)
+
+        def tearDown(self):
+            self.cache.close()
+            self.tdir.__exit__(None, None, None)
+
+        def test_cache_key(self):
+            k = cache_key('identify', self.source, title='The  Title', authors=['A B'], identifiers={'isbn': '1'})
+            self.assertEqual(k, cache_key('identify', self.source, title='the title', authors=['a b'], identifiers={'ISBN': '1 '}))
+            self.assertNotEqual(k, cache_key('cover', self.source, title='the title', authors=['a b'], identifiers={'isbn': '1'}))
+            self.assertNotEqual(k, cache_key('identify', self.source, title='Other', authors=['A B'], identifiers={'isbn': '1'}))
+
+        def test_store_and_expire(self):
+            c = self.cache
+            c.set('a', {'x': b'1'})
+            self.assertEqual(c.get('a'), {'x': b'1'})
+            self.assertIsNone(c.get('b'))
+            with c.conn:
+                c.conn.execute('UPDATE results SET created=created-86401')
+            self.assertIsNone(c.get('a'))
+            c.expire()
+            self.assertEqual(c.conn.execute('SELECT COUNT(*) FROM results').fetchone()[0], 0)
+            for i in range(4):
+                c.set(str(i), b'x' * 400 * 1024)
+            c.expire()
+            self.assertIsNone(c.get('0'))
+            self.assertIsNotNone(c.get('3'))
+
+        def test_run_cached(self):
+            import calibre.ebooks.metadata.sources.results_cache as m
+            orig, m._results_cache = m._results_cache, self.cache
+            try:
+                abort, s = Event(), self.source
+
+                def query(rq):
+                    s.identify(None, rq, abort, title='T', authors=['A'])
+                    return True
+
+                def run():
+                    rq = Queue()
+                    hit = run_cached('identify', s, query, True, rq, abort, lambda *a: None,
+                                     identify_entry, load_identify_entry, title='T', authors=['A'])
+                    return hit, rq.get_nowait()
+
+                hit, mi = run()
+                self.assertFalse(hit)
+                hit, cached = run()
+                self.assertTrue(hit)
+                self.assertEqual(s.num_queries, 1)
+                self.assertEqual((cached.title, cached.authors, cached.identifiers), (mi.title, mi.authors, mi.identifiers))
+            finally:
+                m._results_cache = orig
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestResultsCache)
@@ -3,6 +3,7 @@
 # License: GPLv3 Copyright: 2012, Kovid Goyal <kovid at kovidgoyal.net>
 import os
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
 from io import BytesIO
 from threading import Event, Thread
@@ -61,53 +62,84 @@ def wrapper(*a, **k):
     return wrapper
 
 
+def download_for_book(book_id, opf, do_identify, covers, ensure_fields, tdir):
+    '''
+    Download metadata and cover for a single book, writing the results to
+    tdir. Returns (metadata_failed, cover_failed, something_found).
+    '''
+    mi = OPF(BytesIO(opf), basedir=tdir,
+            populate_spine=False).to_book_metadata()
+    title, authors, identifiers = mi.title, mi.authors, mi.identifiers
+    metadata_failed = cover_failed = found = False
+    log = GUILog()
+
+    if do_identify:
+        results = []
+        try:
+            results = identify(log, Event(), title=title, authors=authors,
+                identifiers=identifiers)
+        except:
+            pass
+        if results:
+            found = True
+            mi = merge_result(mi, results[0], ensure_fields=ensure_fields)
+            identifiers = mi.identifiers
+            if not mi.is_null('rating'):
+                # set_metadata expects a rating out of 10
+                mi.rating *= 2
+            with open(os.path.join(tdir, '%d.mi'%book_id), 'wb') as f:
+                f.write(metadata_to_opf(mi, default_lang='und'))
+        else:
+            log.error('Failed to download metadata for', title)
+            metadata_failed = True
+
+    if covers:
+        cdata = download_cover(log, title=title, authors=authors,
+                identifiers=identifiers)
+        if cdata is None:
+            cover_failed = True
+        else:
+            with open(os.path.join(tdir, '%d.cover'%book_id), 'wb') as f:
+                f.write(cdata[-1])
+            found = True
+
+    with open(os.path.join(tdir, '%d.log'%book_id), 'wb') as f:
+        f.write(log.plain_text.encode('utf-8'))
+    return metadata_failed, cover_failed, found
+
+
+def download_concurrently(book_ids, download_one, num_workers):
+    '''
+    Call download_one(book_id) for every book, with num_workers books being
+    processed at a time. Downloading is I/O bound, and the metadata sources
+    themselves limit how many queries are made to them at a time, see
+    Source.max_concurrent_queries. Returns a map of book_id to result.
+    '''
+    if num_workers < 2:
+        return {book_id: download_one(book_id) for book_id in book_ids}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {book_id: executor.submit(download_one, book_id) for book_id in book_ids}
+    return {book_id: f.result() for book_id, f in futures.items()}
+
+
 @shutdown_webengine_workers
-def main(do_identify, covers, metadata, ensure_fields, tdir):
+def main(do_identify, covers, metadata, ensure_fields, tdir, num_workers=None):
     failed_ids = set()
     failed_covers = set()
     all_failed = True
-    log = GUILog()
     patch_plugins()
-
-    for book_id, mi in iteritems(metadata):
-        mi = OPF(BytesIO(mi), basedir=tdir,
-                populate_spine=False).to_book_metadata()
-        title, authors, identifiers = mi.title, mi.authors, mi.identifiers
-        cdata = None
-        log.clear()
-
-        if do_identify:
-            results = []
-            try:
-                results = identify(log, Event(), title=title, authors=authors,
-                    identifiers=identifiers)
-            except:
-                pass
-            if results:
-                all_failed = False
-                mi = merge_result(mi, results[0], ensure_fields=ensure_fields)
-                identifiers = mi.identifiers
-                if not mi.is_null('rating'):
-                    # set_metadata expects a rating out of 10
-                    mi.rating *= 2
-                with open(os.path.join(tdir, '%d.mi'%book_id), 'wb') as f:
-                    f.write(metadata_to_opf(mi, default_lang='und'))
-            else:
-                log.error('Failed to download metadata for', title)
-                failed_ids.add(book_id)
-
-        if covers:
-            cdata = download_cover(log, title=title, authors=authors,
-                    identifiers=identifiers)
-            if cdata is None:
-                failed_covers.add(book_id)
-            else:
-                with open(os.path.join(tdir, '%d.cover'%book_id), 'wb') as f:
-                    f.write(cdata[-1])
-                all_failed = False
-
-        with open(os.path.join(tdir, '%d.log'%book_id), 'wb') as f:
-            f.write(log.plain_text.encode('utf-8'))
+    if num_workers is None:
+        num_workers = msprefs['concurrent_bulk_downloads']
+
+    results = download_concurrently(metadata, lambda book_id: download_for_book(
+        book_id, metadata[book_id], do_identify, covers, ensure_fields, tdir), num_workers)
+    for book_id, (metadata_failed, cover_failed, found) in iteritems(results):
+        if metadata_failed:
+            failed_ids.add(book_id)
+        if cover_failed:
+            failed_covers.add(book_id)
+        if found:
+            all_failed = False
 
     return failed_ids, failed_covers, all_failed
 
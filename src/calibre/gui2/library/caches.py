@@ -9,7 +9,7 @@
 
 from qt.core import QImage, QPixmap
 
-from calibre.db.utils import ThumbnailCache as TC
+from calibre.db.utils import PackedThumbnailCache as TC
 from polyglot.builtins import itervalues
 
 
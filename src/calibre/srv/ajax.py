@@ -16,7 +16,7 @@
 from calibre.srv.content import icon as get_icon
 from calibre.srv.errors import BookNotFound, HTTPNotFound
 from calibre.srv.routes import endpoint, json
-from calibre.srv.utils import custom_fields_to_display, decode_name, encode_name, get_db, http_date
+from calibre.srv.utils import JSONStream, LazyJSONObject, batched, custom_fields_to_display, decode_name, encode_name, get_db, http_date
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.date import isoformat, timestampfromdt
 from calibre.utils.icu import numeric_sort_key as sort_key
@@ -156,7 +156,7 @@ def book(ctx, rd, book_id, library_id):
 
     If id_is_uuid is true then the book_id is assumed to be a book uuid instead.
     '''
-    db = get_db(ctx, rd, library_id)
+    db = get_db(ctx, rd, library_id, snapshot=True)
     with db.safe_read_lock:
         id_is_uuid = rd.query.get('id_is_uuid', 'false')
         oid = book_id
@@ -196,7 +196,7 @@ def books(ctx, rd, library_id):
 
     If id_is_uuid is true then the book_id is assumed to be a book uuid instead.
     '''
-    db = get_db(ctx, rd, library_id)
+    db = get_db(ctx, rd, library_id, snapshot=True)
     with db.safe_read_lock:
         id_is_uuid = rd.query.get('id_is_uuid', 'false')
         ids = rd.query.get('ids')
@@ -212,24 +212,33 @@ def books(ctx, rd, library_id):
                     ids = {int(x) for x in ids}
                 except Exception:
                     raise HTTPNotFound('ids must a comma separated list of integers')
-        last_modified = None
         category_urls = rd.query.get('category_urls', 'true').lower() == 'true'
         device_compatible = rd.query.get('device_compatible', 'false').lower() == 'true'
         device_for_template = rd.query.get('device_for_template', None)
-        ans = {}
         allowed_book_ids = ctx.allowed_book_ids(rd, db)
-        for book_id in ids:
-            if book_id not in allowed_book_ids:
-                ans[book_id] = None
-                continue
-            data, lm = book_to_json(
-                ctx, rd, db, book_id, get_category_urls=category_urls,
-                device_compatible=device_compatible, device_for_template=device_for_template)
-            last_modified = lm if last_modified is None else max(lm, last_modified)
-            ans[book_id] = data
+        ids = tuple(ids)
+        # The Last-Modified header has to be sent before the metadata is
+        # generated, so get it directly from the last_modified field
+        last_modified = max((db._field_for('last_modified', book_id) for book_id in ids if book_id in allowed_book_ids), default=None)
+
+    def entries():
+        # The metadata is generated in batches as it is sent, so that memory
+        # use does not grow with the number of books
+        for batch in batched(ids, 100):
+            with db.safe_read_lock:
+                ans = []
+                for book_id in batch:
+                    data = None
+                    if book_id in allowed_book_ids and db._has_id(book_id):
+                        data = book_to_json(
+                            ctx, rd, db, book_id, get_category_urls=category_urls,
+                            device_compatible=device_compatible, device_for_template=device_for_template)[0]
+                    ans.append((book_id, data))
+            yield from ans
+
     if last_modified is not None:
         rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
-    return ans
+    return JSONStream(LazyJSONObject(entries()))
 
 # }}}
 
@@ -249,7 +258,7 @@ def categories(ctx, rd, library_id):
         }
 
     '''
-    db = get_db(ctx, rd, library_id)
+    db = get_db(ctx, rd, library_id, snapshot=True)
     with db.safe_read_lock:
         ans = {}
         categories = ctx.get_categories(rd, db, vl=rd.query.get('vl') or '')
@@ -341,7 +350,7 @@ def category(ctx, rd, encoded_name, library_id):
     https://manual.calibre-ebook.com/sub_groups.html
     '''
 
-    db = get_db(ctx, rd, library_id)
+    db = get_db(ctx, rd, library_id, snapshot=True)
     with db.safe_read_lock:
         num, offset = get_pagination(rd.query)
         sort, sort_order = rd.query.get('sort'), rd.query.get('sort_order')
@@ -471,7 +480,7 @@ def books_in(ctx, rd, encoded_category, encoded_item, library_id):
 
     Optional: ?num=100&offset=0&sort=title&sort_order=asc&get_additional_fields=
     '''
-    db = get_db(ctx, rd, library_id)
+    db = get_db(ctx, rd, library_id, snapshot=True)
     with db.safe_read_lock:
         try:
             dname, ditem = map(decode_name, (encoded_category, encoded_item))
@@ -567,7 +576,7 @@ def search(ctx, rd, library_id):
 
     Optional: ?num=100&offset=0&sort=title&sort_order=asc&query=&vl=
     '''
-    db = get_db(ctx, rd, library_id)
+    db = get_db(ctx, rd, library_id, snapshot=True)
     query = rd.query.get('query')
     num, offset = get_pagination(rd.query)
     with db.safe_read_lock:
@@ -581,3 +590,10 @@ def library_info(ctx, rd):
     ' Return info about available libraries '
     library_map, default_library = ctx.library_info(rd)
     return {'library_map':library_map, 'default_library':default_library}
+
+
+@endpoint('/ajax/library-stats', postprocess=json)
+def library_stats(ctx, rd):
+    ' Statistics about the libraries loaded by the server, their load times and evictions '
+    ctx.check_for_write_access(rd)
+    return ctx.library_broker.stats()
@@ -112,6 +112,13 @@ def validate_nonce(key_order, nonce, realm, secret):
     return s_nonce == nonce
 
 
+def create_nonce_secret():
+    ' The secret and key order used to synthesize nonces, see AuthController '
+    secret = as_hex_unicode(os.urandom(random.randint(20, 30)))
+    key_order = '{%d}:{%d}:{%d}' % random.choice(tuple(permutations((0,1,2))))  # noqa: UP031
+    return secret, key_order
+
+
 def is_nonce_stale(nonce, max_age_seconds=MAX_AGE_SECONDS):
     try:
         timestamp = struct.unpack(b'!dH', from_hex_bytes(as_bytestring(nonce.partition(':')[0])))[0]
@@ -242,13 +249,14 @@ class AuthController:
 
     def __init__(self,
                  user_credentials=None, prefer_basic_auth=False, realm='calibre',
-                 max_age_seconds=MAX_AGE_SECONDS, log=None, ban_time_in_minutes=0, ban_after=5):
+                 max_age_seconds=MAX_AGE_SECONDS, log=None, ban_time_in_minutes=0, ban_after=5, nonce_secret=None):
         self.user_credentials, self.prefer_basic_auth = user_credentials, prefer_basic_auth
         self.ban_list = BanList(ban_time_in_minutes=ban_time_in_minutes, max_failures_before_ban=ban_after)
         self.log = log
-        self.secret = as_hex_unicode(os.urandom(random.randint(20, 30)))
+        # Server processes that share the listening port must share the
+        # secret, so that nonces issued by one are valid in the others
+        self.secret, self.key_order = nonce_secret or create_nonce_secret()
         self.max_age_seconds = max_age_seconds
-        self.key_order = '{%d}:{%d}:{%d}' % random.choice(tuple(permutations((0,1,2))))  # noqa: UP031
         self.realm = realm
         if '"' in realm:
             raise ValueError('Double-quotes are not allowed in the authentication realm')
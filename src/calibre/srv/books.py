@@ -7,9 +7,10 @@
 import os
 import tempfile
 import time
+from collections import Counter
 from functools import partial
 from hashlib import sha1
-from threading import Lock, RLock
+from threading import Lock, RLock, Thread
 
 from calibre.constants import cache_dir, iswindows
 from calibre.customize.ui import plugin_for_input_format
@@ -22,6 +23,7 @@
 from calibre.srv.utils import get_db, get_library_data
 from calibre.utils.filenames import rmtree
 from calibre.utils.localization import _
+from calibre.utils.monotonic import monotonic
 from calibre.utils.resources import get_path as P
 from calibre.utils.serialize import json_dumps
 from polyglot.builtins import as_unicode, itervalues
@@ -29,6 +31,7 @@
 cache_lock = RLock()
 queued_jobs = {}
 failed_jobs = {}
+render_claims = {}
 
 
 def abspath(x):
@@ -46,7 +49,7 @@ def books_cache_dir():
     if _books_cache_dir:
         return _books_cache_dir
     base = abspath(os.path.join(cache_dir(), 'srvb'))
-    for d in 'sf':
+    for d in 'sfq':
         try:
             os.makedirs(os.path.join(base, d))
         except OSError as e:
@@ -73,47 +76,175 @@ def safe_remove(x, is_file=None):
         pass
 
 
-def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime):
+def format_hash(db, book_id, fmt):
+    ' Return the hash of the rendered book and the size and mtime of the format or None if there is no such format. Must be called with the read lock held. '
+    fm = db.format_metadata(book_id, fmt, allow_cache=False)
+    if not fm:
+        return None
+    size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
+    return book_hash(db.library_id, book_id, fmt, size, mtime), size, mtime
+
+
+def manifest_path(bhash):
+    return abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
+
+
+def clean_render_staging():
+    ''' Remove left over files from renders that did not complete. When running
+    as several server processes, this must be called before forking, as the
+    processes share the staging directory. '''
     global staging_cleaned
+    staging_cleaned = True
     tdir = os.path.join(books_cache_dir(), 's')
+    for x in os.listdir(tdir):
+        safe_remove(os.path.join(tdir, x))
+
+
+def claim_render(ctx, bhash):
+    ''' When running as several server processes, ensure that only one of them
+    renders a book. Returns False if another process is rendering it or has
+    rendered it. Must be called with cache_lock held. '''
+    if ctx.write_coordinator is None:
+        return True
+    from calibre.srv.worker_processes import claim_file
+    f = claim_file(os.path.join(books_cache_dir(), 'q', bhash))
+    if f is None:
+        return False
+    render_claims[bhash] = f
+    if os.path.exists(manifest_path(bhash)):
+        release_render_claim(bhash)
+        return False
+    return True
+
+
+def release_render_claim(bhash):
+    f = render_claims.pop(bhash, None)
+    if f is not None:
+        from calibre.srv.worker_processes import release_file_claim
+        release_file_claim(f)
+
+
+def queue_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, priority='normal'):
+    ''' Start rendering a book, returning the job id or None if another server
+    process is rendering it. Must be called with cache_lock held. '''
     if not staging_cleaned:
-        staging_cleaned = True
-        for x in os.listdir(tdir):
-            safe_remove(os.path.join(tdir, x))
+        clean_render_staging()
+    if not claim_render(ctx, bhash):
+        return None
+    try:
+        job_id = start_render_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, priority)
+    except BaseException:
+        release_render_claim(bhash)
+        raise
+    queued_jobs[bhash] = job_id
+    return job_id
+
+
+def start_render_job(ctx, copy_format_to, bhash, fmt, book_id, size, mtime, priority):
+    tdir = os.path.join(books_cache_dir(), 's')
     fd, pathtoebook = tempfile.mkstemp(prefix='', suffix=('.' + fmt.lower()), dir=tdir)
     with os.fdopen(fd, 'wb') as f:
         copy_format_to(f)
     tdir = tempfile.mkdtemp('', '', tdir)
     job_id = ctx.start_job(f'Render book {book_id} ({fmt})', 'calibre.srv.render_book', 'render', args=(
         pathtoebook, tdir, {'size':size, 'mtime':mtime, 'hash':bhash}),
-        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir))
-    queued_jobs[bhash] = job_id
+        job_done_callback=job_done, job_data=(bhash, pathtoebook, tdir, ctx.opts.max_book_render_cache_size * 1024 * 1024),
+        priority=priority)
     return job_id
 
 
-last_final_clean_time = 0
+def tree_size(path):
+    ans = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for x in filenames:
+            try:
+                ans += os.path.getsize(os.path.join(dirpath, x))
+            except OSError:
+                pass
+    return ans
+
+
+class RenderedBooks:
 
+    ''' Keeps track of the sizes of the rendered books in the cache, so that
+    the least recently read ones can be removed when it becomes too large.
+    Must only be used with cache_lock held. '''
 
-def clean_final(interval=24 * 60 * 60):
-    global last_final_clean_time
+    def __init__(self):
+        self.sizes = None
+        self.total_size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.last_clean_time = 0
+
+    def scan(self, fdir):
+        if self.sizes is None:
+            self.sizes = {x: tree_size(os.path.join(fdir, x)) for x in os.listdir(fdir)}
+            self.total_size = sum(self.sizes.values())
+
+    def added(self, fdir, bhash):
+        self.scan(fdir)
+        size = tree_size(os.path.join(fdir, bhash))
+        self.total_size += size - self.sizes.get(bhash, 0)
+        self.sizes[bhash] = size
+
+    def remove(self, fdir, bhash):
+        safe_remove(os.path.join(fdir, bhash), False)
+        if self.sizes is not None:
+            self.total_size -= self.sizes.pop(bhash, 0)
+
+    def stats(self):
+        return {
+            'books': -1 if self.sizes is None else len(self.sizes), 'size': self.total_size,
+            'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+        }
+
+
+rendered_books = RenderedBooks()
+
+
+def clean_final(max_size=0, interval=24 * 60 * 60, keep=None):
+    '''
+    Remove rendered books that have not been read for interval seconds and, if
+    the cache is larger than max_size bytes, the least recently read books
+    until it is no longer too large. Must be called with cache_lock held.
+    '''
+    fdir = os.path.join(books_cache_dir(), 'f')
+    rb = rendered_books
+    rb.scan(fdir)
     now = time.time()
-    if now - last_final_clean_time < interval:
+    check_age = now - rb.last_clean_time >= interval
+    if check_age:
+        rb.last_clean_time = now
+    elif max_size <= 0 or rb.total_size <= max_size:
         return
-    last_final_clean_time = now
-    fdir = os.path.join(books_cache_dir(), 'f')
-    for x in os.listdir(fdir):
+    last_read = []
+    for x in tuple(rb.sizes):
+        if x == keep:
+            continue
         try:
+            # The manifest is touched every time the book is opened
             tm = os.path.getmtime(os.path.join(fdir, x, 'calibre-book-manifest.json'))
         except OSError:
-            continue
-        if now - tm >= interval:
-            # This book has not been accessed for a long time, delete it
-            safe_remove(x)
+            tm = 0
+        else:
+            if check_age and now - tm >= interval:
+                # This book has not been accessed for a long time, delete it
+                rb.remove(fdir, x)
+                rb.evictions += 1
+                continue
+        last_read.append((tm, x))
+    if max_size > 0 and rb.total_size > max_size:
+        last_read.sort()
+        for tm, x in last_read:
+            if rb.total_size <= max_size:
+                break
+            rb.remove(fdir, x)
+            rb.evictions += 1
 
 
 def job_done(job):
     with cache_lock:
-        bhash, pathtoebook, tdir = job.data
+        bhash, pathtoebook, tdir, max_size = job.data
         queued_jobs.pop(bhash, None)
         safe_remove(pathtoebook)
         if job.failed:
@@ -121,13 +252,102 @@ def job_done(job):
             safe_remove(tdir, False)
         else:
             try:
-                clean_final()
-                dest = os.path.join(books_cache_dir(), 'f', bhash)
-                safe_remove(dest, False)
-                os.rename(tdir, dest)
+                fdir = os.path.join(books_cache_dir(), 'f')
+                rendered_books.remove(fdir, bhash)
+                os.rename(tdir, os.path.join(fdir, bhash))
+                rendered_books.added(fdir, bhash)
+                clean_final(max_size, keep=bhash)
             except Exception:
                 import traceback
                 failed_jobs[bhash] = (False, traceback.format_exc())
+        release_render_claim(bhash)
+
+
+# Same order as used by the web reader to choose the format to read
+PRERENDER_FORMATS = ('EPUB', 'AZW3', 'DOCX', 'LIT', 'MOBI', 'ODT', 'RTF', 'MD', 'MARKDOWN', 'TXT', 'PDF')
+
+
+class PreRenderer:
+
+    ''' Renders books that are likely to be read soon in the background, as
+    low priority jobs, so that they open quickly in the web reader. The
+    candidates are the most recently read, most downloaded and most recently
+    added books in a library. '''
+
+    INTERVAL = 10 * 60  # seconds
+
+    def __init__(self):
+        self.lock = Lock()
+        self.last_run = {}
+        self.downloads = {}
+        self.queued = 0
+
+    def book_downloaded(self, library_id, book_id):
+        with self.lock:
+            c = self.downloads.get(library_id)
+            if c is None:
+                c = self.downloads[library_id] = Counter()
+            c[book_id] += 1
+
+    def candidates(self, db, library_id, count):
+        ' Return an ordered mapping of book_id to format, where the format is None if it should be chosen automatically '
+        ans = {}
+        for book_id, fmt in last_read_cache().recently_read_books(library_id, count):
+            ans.setdefault(book_id, fmt)
+        with self.lock:
+            c = self.downloads.get(library_id)
+            most_downloaded = [book_id for book_id, n in c.most_common(count)] if c else ()
+        for book_id in most_downloaded:
+            ans.setdefault(book_id, None)
+        for book_id in db.newly_added_book_ids(count=count):
+            ans.setdefault(book_id, None)
+        return ans
+
+    def schedule(self, ctx, db, library_id):
+        ' Queue pre-rendering for the specified library, if it has not been done recently '
+        count = ctx.opts.prerender_books
+        if count < 1 or ctx.jobs_manager is None:
+            return
+        now = monotonic()
+        with self.lock:
+            last = self.last_run.get(library_id)
+            if last is not None and now - last < self.INTERVAL:
+                return
+            self.last_run[library_id] = now
+        # Copying the books out of the library can take a while, so do it in
+        # a thread rather than in the request that triggered it
+        Thread(name='PreRenderBooks', target=self.run, args=(ctx, db, library_id, count), daemon=True).start()
+
+    def run(self, ctx, db, library_id, count):
+        try:
+            for book_id, fmt in self.candidates(db, library_id, count).items():
+                self.prerender(ctx, db, book_id, fmt)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+    def prerender(self, ctx, db, book_id, fmt=None):
+        with db.safe_read_lock:
+            if fmt is None:
+                available = set(db._formats(book_id) or ())
+                for q in PRERENDER_FORMATS:
+                    if q in available and plugin_for_input_format(q) is not None:
+                        fmt = q
+                        break
+                else:
+                    return
+            x = format_hash(db, book_id, fmt)
+            if x is None:
+                return
+            bhash, size, mtime = x
+            with cache_lock:
+                if bhash in queued_jobs or bhash in failed_jobs or os.path.exists(manifest_path(bhash)):
+                    return
+                if queue_job(ctx, partial(db._copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime, priority='low') is not None:
+                    self.queued += 1
+
+
+prerenderer = PreRenderer()
 
 
 @endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
@@ -139,13 +359,12 @@ def book_manifest(ctx, rd, book_id, fmt):
     if not ctx.has_id(rd, db, book_id):
         raise BookNotFound(book_id, db)
     with db.safe_read_lock:
-        fm = db.format_metadata(book_id, fmt, allow_cache=False)
-        if not fm:
+        x = format_hash(db, book_id, fmt)
+        if x is None:
             raise HTTPNotFound(f'No {fmt} format for the book (id:{book_id}) in the library: {library_id}')
-        size, mtime = map(int, (fm['size'], time.mktime(fm['mtime'].utctimetuple())*10))
-        bhash = book_hash(db.library_id, book_id, fmt, size, mtime)
+        bhash, size, mtime = x
         with cache_lock:
-            mpath = abspath(os.path.join(books_cache_dir(), 'f', bhash, 'calibre-book-manifest.json'))
+            mpath = manifest_path(bhash)
             if force_reload:
                 safe_remove(mpath, True)
             try:
@@ -156,6 +375,7 @@ def book_manifest(ctx, rd, book_id, fmt):
                 user = rd.username or None
                 ans['last_read_positions'] = db.get_last_read_positions(book_id, fmt, user) if user else []
                 ans['annotations_map'] = db.annotations_map_for_book(book_id, fmt, user_type='web', user=user or '*')
+                rendered_books.hits += 1
                 return ans
             except OSError as e:
                 if e.errno != errno.ENOENT:
@@ -165,11 +385,31 @@ def book_manifest(ctx, rd, book_id, fmt):
                 return {'aborted':x[0], 'traceback':x[1], 'job_status':'finished'}
             job_id = queued_jobs.get(bhash)
             if job_id is None:
+                rendered_books.misses += 1
                 job_id = queue_job(ctx, partial(db.copy_format_to, book_id, fmt), bhash, fmt, book_id, size, mtime)
+                if job_id is None:
+                    # Another server process is rendering the book
+                    return {'aborted': False, 'traceback': None, 'job_status': 'running'}
+            else:
+                # The book may be waiting to be pre-rendered
+                ctx.jobs_manager.bump_job(job_id)
     status, result, tb, aborted = ctx.job_status(job_id)
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
 
+@endpoint('/book-render-cache-stats', postprocess=json)
+def book_render_cache_stats(ctx, rd):
+    ' Statistics about the cache of books rendered for the web reader '
+    ctx.check_for_write_access(rd)
+    with cache_lock:
+        ans = rendered_books.stats()
+        ans['max_size'] = ctx.opts.max_book_render_cache_size * 1024 * 1024
+        ans['queued'] = len(queued_jobs)
+        ans['failed'] = len(failed_jobs)
+    ans['prerender_queued'] = prerenderer.queued
+    return ans
+
+
 @endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
 def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     db, library_id = get_library_data(ctx, rd)[:2]
@@ -13,7 +13,7 @@
 from calibre.ebooks.metadata.meta import get_metadata
 from calibre.srv.changes import books_added, books_deleted, metadata
 from calibre.srv.errors import HTTPBadRequest, HTTPForbidden, HTTPNotFound
-from calibre.srv.metadata import book_as_json
+from calibre.srv.metadata import books_as_json
 from calibre.srv.routes import endpoint, json, msgpack_or_json
 from calibre.srv.utils import get_db, get_library_data
 from calibre.utils.imghdr import what
@@ -216,7 +216,8 @@ def to_lang_code(x):
     ctx.notify_changes(db.backend.library_path, metadata(dirtied))
     all_ids = dirtied if all_dirtied else (dirtied & loaded_book_ids)
     all_ids |= {book_id}
-    return {bid: book_as_json(db, bid) for bid in all_ids}
+    ans = books_as_json(db, all_ids)
+    return {bid: ans.get(bid) for bid in all_ids}
 
 
 @endpoint('/cdb/copy-to-library/{target_library_id}/{library_id=None}', needs_db_write=True,
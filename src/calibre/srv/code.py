@@ -17,11 +17,13 @@
 from calibre.db.view import sanitize_sort_field_name
 from calibre.ebooks.metadata.book.render import resolve_default_author_link
 from calibre.srv.ajax import search_result
+from calibre.srv.books import prerenderer
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPForbidden, HTTPNotFound, HTTPRedirect, HTTPTempRedirect
+from calibre.srv.http_response import parse_if_none_match
 from calibre.srv.last_read import last_read_cache
-from calibre.srv.metadata import book_as_json, categories_as_json, categories_settings, get_gpref, icon_map, web_search_link
+from calibre.srv.metadata import book_as_json, books_as_json, categories_as_json, categories_settings, get_gpref, icon_map, web_search_link
 from calibre.srv.routes import endpoint, json
-from calibre.srv.utils import get_library_data, get_use_roman
+from calibre.srv.utils import JSONStream, LazyJSONObject, batched, get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.icu import numeric_sort_key, sort_key
 from calibre.utils.localization import _, get_lang, lang_code_for_user_manual, lang_map_for_ui, localize_website_link
@@ -80,7 +82,7 @@ def console_print(ctx, rd):
 
 
 def get_basic_query_data(ctx, rd):
-    db, library_id, library_map, default_library = get_library_data(ctx, rd)
+    db, library_id, library_map, default_library = get_library_data(ctx, rd, snapshot=True)
     skeys = db.field_metadata.sortable_field_keys()
     sorts, orders = [], []
     for x in rd.query.get('sort', '').split(','):
@@ -233,23 +235,66 @@ def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
         ans['book_details_vertical_categories'] = db._pref('book_details_vertical_categories', ())
         ans['fields_that_support_notes'] = tuple(db._field_supports_notes())
         ans['categories_using_hierarchy'] = db._pref('categories_using_hierarchy', ())
-        mdata = ans['metadata'] = {}
         try:
             extra_books = {
                 int(x) for x in rd.query.get('extra_books', '').split(',')
             }
         except Exception:
             extra_books = ()
-        for coll in (ans['search_result']['book_ids'], extra_books):
-            for book_id in coll:
-                if book_id not in mdata:
-                    data = book_as_json(db, book_id)
-                    if data is not None:
-                        mdata[book_id] = data
+    # The metadata is serialized in batches as it is sent, so that memory use
+    # does not grow with the number of books requested
+    ans['metadata'] = LazyJSONObject(iter_books_as_json(db, (ans['search_result']['book_ids'], extra_books)))
     return ans
 
 
-@endpoint('/interface-data/books-init', postprocess=json)
+def iter_books_as_json(db, book_id_lists):
+    seen = set()
+
+    def unique_ids():
+        for coll in book_id_lists:
+            for book_id in coll:
+                if book_id not in seen:
+                    seen.add(book_id)
+                    yield book_id
+
+    for batch in batched(unique_ids(), 100):
+        yield from books_as_json(db, batch).items()
+
+
+# Larger responses are streamed rather than being held in memory
+MAX_CACHED_INIT_BOOKS = 500
+
+
+def library_init_response(ctx, rd, endpoint, db, num, sorts, orders, vl, ans):
+    '''
+    Add the library data and the first page of books to ans and return it
+    serialized as JSON. The response depends only on ans, the request
+    parameters, the user and the state of the library, so it is identified by
+    an ETag computed from those, letting clients that already have it get a
+    304 and other clients get it from the cache without a new search.
+    '''
+    if num > MAX_CACHED_INIT_BOOKS:
+        ans.update(get_library_init_data(ctx, rd, db, num, sorts, orders, vl))
+        return json(ctx, rd, endpoint, JSONStream(ans))
+    # The translations are large, use their hash in the etag instead
+    key_data = {k: (v.get('hash') if k == 'translations' and isinstance(v, dict) else v) for k, v in iteritems(ans)}
+    etag = json_dumps([
+        endpoint.__name__, rd.opts.url_prefix, db.library_id, db.database_key(), rd.username,
+        ctx.restriction_for(rd, db), vl, sorts, orders, num, rd.query.get('search', ''),
+        rd.query.get('extra_books', ''), key_data])
+    etag = f'"{hashlib.sha1(etag).hexdigest()}"'
+
+    def generate():
+        ans.update(get_library_init_data(ctx, rd, db, num, sorts, orders, vl))
+        return b''.join(JSONStream(ans))
+
+    if etag in parse_if_none_match(rd.inheaders.get('If-None-Match', '')):
+        ctx.interface_data_not_modified()
+        return rd.etagged_dynamic_response(etag, generate, content_type='application/json; charset=UTF-8')
+    return json(ctx, rd, endpoint, ctx.get_interface_data(db, etag, generate))
+
+
+@endpoint('/interface-data/books-init')
 def books(ctx, rd):
     '''
     Get data to create list of books
@@ -257,18 +302,16 @@ def books(ctx, rd):
     Optional: ?num=50&sort=timestamp.desc&library_id=<default library>
               &search=''&extra_books=''&vl=''
     '''
-    ans = {}
     try:
         num = int(rd.query.get('num', rd.opts.num_per_page))
     except Exception:
         raise HTTPNotFound('Invalid number of books: {!r}'.format(rd.query.get('num')))
     library_id, db, sorts, orders, vl = get_basic_query_data(ctx, rd)
-    ans = get_library_init_data(ctx, rd, db, num, sorts, orders, vl)
-    ans['library_id'] = library_id
-    return ans
+    prerenderer.schedule(ctx, db, library_id)
+    return library_init_response(ctx, rd, books, db, num, sorts, orders, vl, {'library_id': library_id})
 
 
-@endpoint('/interface-data/init', postprocess=json)
+@endpoint('/interface-data/init')
 def interface_data(ctx, rd):
     '''
     Return the data needed to create the server UI as well as a list of books.
@@ -294,8 +337,18 @@ def interface_data(ctx, rd):
         num = int(rd.query.get('num', rd.opts.num_per_page))
     except Exception:
         raise HTTPNotFound('Invalid number of books: {!r}'.format(rd.query.get('num')))
-    ans.update(get_library_init_data(ctx, rd, db, num, sorts, orders, vl))
-    return ans
+    prerenderer.schedule(ctx, db, ans['library_id'])
+    return library_init_response(ctx, rd, interface_data, db, num, sorts, orders, vl, ans)
+
+
+@endpoint('/interface-data/cache-stats', postprocess=json)
+def interface_data_cache_stats(ctx, rd):
+    '''
+    Return the hit counts and memory use of the cache of responses for the
+    init and books-init endpoints
+    '''
+    ctx.check_for_write_access(rd)
+    return ctx.interface_data_cache_stats()
 
 
 @endpoint('/interface-data/newly-added', postprocess=json)
@@ -305,7 +358,7 @@ def newly_added(ctx, rd):
 
     Optional: ?num=3&library_id=<default library>
     '''
-    db, library_id = get_library_data(ctx, rd)[:2]
+    db, library_id = get_library_data(ctx, rd, snapshot=True)[:2]
     count = int(rd.query.get('num', 3))
     nbids = ctx.newest_book_ids(rd, db, count=count)
     with db.safe_read_lock:
@@ -322,7 +375,7 @@ def more_books(ctx, rd):
 
     Optional: ?num=50&library_id=<default library>
     '''
-    db, library_id = get_library_data(ctx, rd)[:2]
+    db, library_id = get_library_data(ctx, rd, snapshot=True)[:2]
 
     try:
         num = int(rd.query.get('num', rd.opts.num_per_page))
@@ -342,13 +395,8 @@ def more_books(ctx, rd):
         ans['search_result'] = search_result(
             ctx, rd, db, query, num, offset, sorts, orders, vl
         )
-        mdata = ans['metadata'] = {}
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
-
-    return ans
+    ans['metadata'] = LazyJSONObject(iter_books_as_json(db, (ans['search_result']['book_ids'],)))
+    return JSONStream(ans)
 
 
 @endpoint('/interface-data/set-session-data', postprocess=json, methods=POSTABLE)
@@ -382,9 +430,8 @@ def get_books(ctx, rd):
     except Exception:
         raise HTTPNotFound('Invalid number of books: {!r}'.format(rd.query.get('num')))
     searchq = rd.query.get('search', '')
-    db = get_library_data(ctx, rd)[0]
+    db = get_library_data(ctx, rd, snapshot=True)[0]
     ans = {}
-    mdata = ans['metadata'] = {}
     with db.safe_read_lock:
         try:
             ans['search_result'] = search_result(
@@ -394,11 +441,8 @@ def get_books(ctx, rd):
             # This must not be translated as it is used by the front end to
             # detect invalid search expressions
             raise HTTPBadRequest(f'Invalid search expression: {as_unicode(err)}')
-        for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
-            if data is not None:
-                mdata[book_id] = data
-    return ans
+    ans['metadata'] = LazyJSONObject(iter_books_as_json(db, (ans['search_result']['book_ids'],)))
+    return JSONStream(ans)
 
 
 @endpoint('/interface-data/book-metadata/{book_id=0}', postprocess=json)
@@ -428,7 +472,7 @@ def web_search(ctx, rd, book_id, field, item_val):
     Redirect to a web search URL for the specified item.
     Optional: ?library_id=<default library>
     '''
-    db, library_id = get_library_data(ctx, rd)[:2]
+    db, library_id = get_library_data(ctx, rd, snapshot=True)[:2]
     try:
         book_id = int(book_id)
     except Exception:
@@ -451,10 +495,10 @@ def tag_browser(ctx, rd):
     Optional: ?library_id=<default library>&sort_tags_by=name&partition_method=first letter
               &collapse_at=25&dont_collapse=&hide_empty_categories=&vl=''
     '''
-    db, library_id = get_library_data(ctx, rd)[:2]
+    db, library_id = get_library_data(ctx, rd, snapshot=True)[:2]
     opts = categories_settings(rd.query, db, gst_container=tuple)
     vl = rd.query.get('vl') or ''
-    etag = json_dumps([db.last_modified().isoformat(), rd.username, library_id, vl, list(opts)])
+    etag = json_dumps([db.database_key(), rd.username, library_id, vl, list(opts)])
     etag = hashlib.sha1(etag).hexdigest()
 
     def generate():
@@ -479,7 +523,7 @@ def field_names(ctx, rd, field):
     if field == 'languages':
         ans = all_lang_names()
     else:
-        db, library_id = get_library_data(ctx, rd)[:2]
+        db, library_id = get_library_data(ctx, rd, snapshot=True)[:2]
         try:
             ans = tuple(sorted(db.all_field_names(field), key=numeric_sort_key))
         except ValueError:
@@ -493,7 +537,7 @@ def field_id_map(ctx, rd, field):
     Get a map of all ids:names for the specified field
     Optional: ?library_id=<default library>
     '''
-    db, library_id = get_library_data(ctx, rd)[:2]
+    db, library_id = get_library_data(ctx, rd, snapshot=True)[:2]
     try:
         return db.get_id_map(field)
     except ValueError:
@@ -6,9 +6,11 @@
 
 import base64
 import errno
+import hashlib
 import os
 import re
-from contextlib import suppress
+from collections import OrderedDict
+from contextlib import contextmanager, suppress
 from functools import partial
 from io import BytesIO
 from json import load as load_json_file
@@ -23,6 +25,7 @@
 from calibre.ebooks.metadata.meta import set_metadata
 from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
+from calibre.srv.books import prerenderer
 from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.metadata import encode_stat_result
 from calibre.srv.routes import endpoint, json
@@ -46,11 +49,82 @@
 
 # Get book formats/cover as a cached filesystem file {{{
 
-rename_counter = 0
+
+class FileCache:
+
+    ''' Keeps track of the files in the cache of copied files, so that the
+    least recently used ones can be removed when it becomes too large, and
+    provides a lock per file, so that copying one file does not block requests
+    for other files. '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.file_locks = {}
+        self.files = OrderedDict()
+        self.total_size = 0
+        self.rename_counter = 0
+
+    @contextmanager
+    def locked(self, fname):
+        with self.lock:
+            entry = self.file_locks.get(fname)
+            if entry is None:
+                entry = self.file_locks[fname] = [Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.file_locks[fname]
+
+    def remove(self, fname):
+        ''' Remove the file, it may be open and being sent to a client, which
+        will continue to work. Must be called with the lock for fname held. '''
+        with self.lock:
+            self.total_size -= self.files.pop(fname, 0)
+            self._remove(fname)
+
+    def _remove(self, fname):
+        if iswindows:
+            # On windows in order to re-use fname, we have to rename it
+            # before deleting it
+            self.rename_counter += 1
+            dname = os.path.join(os.path.dirname(fname), f'_{self.rename_counter:x}')
+            atomic_rename(fname, dname)
+            os.remove(dname)
+        else:
+            os.remove(fname)
+
+    def used(self, fname, size, max_size):
+        ' Mark fname as most recently used, removing least recently used files if the cache is too large '
+        with self.lock:
+            self.total_size += size - self.files.pop(fname, 0)
+            self.files[fname] = size
+            if max_size <= 0:
+                return
+            for victim in tuple(self.files):
+                if self.total_size <= max_size:
+                    break
+                if victim in self.file_locks:
+                    continue  # being copied or checked
+                try:
+                    self._remove(victim)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    continue
+                self.total_size -= self.files.pop(victim)
+
+
+file_cache = FileCache()
 
 
 def reset_caches():
-    pass
+    global file_cache
+    file_cache = FileCache()
 
 
 def open_for_write(fname):
@@ -69,8 +143,9 @@ def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func
     socket, as this can potentially lock the library for an extended period. So
     instead we copy out the data from the library folder into a temp folder. We
     make sure to only do this copy once, using the previous copy, if there have
-    been no changes to the data for the file since the last copy. '''
-    global rename_counter
+    been no changes to the data for the file since the last copy. Concurrent
+    requests for the same file wait for a single copy, requests for other
+    files are not blocked. '''
 
     # Avoid too many items in a single directory for performance
     base = os.path.join(rd.tdir, 'fcache', ((f'{book_id:x}')[-3:]))
@@ -88,22 +163,15 @@ def safe_mtime():
             return os.path.getmtime(fname)
 
     mt = mtime if isinstance(mtime, (int, float)) else timestampfromdt(mtime)
-    with lock:
+    fc = file_cache
+    with fc.locked(fname):
         previous_mtime = safe_mtime()
         if previous_mtime is None or previous_mtime < mt:
             if previous_mtime is not None:
                 # File exists and may be open, so we cannot change its
                 # contents, as that would lead to corrupted downloads in any
                 # clients that are currently downloading the file.
-                if iswindows:
-                    # On windows in order to re-use bname, we have to rename it
-                    # before deleting it
-                    rename_counter += 1
-                    dname = os.path.join(base, f'_{rename_counter:x}')
-                    atomic_rename(fname, dname)
-                    os.remove(dname)
-                else:
-                    os.remove(fname)
+                fc.remove(fname)
             ans = open_for_write(fname)
             copy_func(ans)
             ans.seek(0)
@@ -117,6 +185,7 @@ def safe_mtime():
                 ans = open_for_write(fname)
                 copy_func(ans)
                 ans.seek(0)
+        fc.used(fname, os.fstat(ans.fileno()).st_size, ctx.opts.max_file_cache_size * 1024 * 1024)
         if ctx.testing:
             rd.outheaders['Used-Cache'] = used_cache
             rd.outheaders['Tempfile'] = as_hex_unicode(fname)
@@ -153,16 +222,32 @@ def cover(ctx, rd, library_id, db, book_id, width=None, height=None):
     if width is None and height is None:
         def copy_func(dest):
             db.copy_cover_to(book_id, dest)
-    else:
-        prefix += f'-{width}x{height}'
+        return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
+    return scaled_cover(ctx, rd, f'{prefix}-{width}x{height}', library_id, db, book_id, width, height, mtime)
 
-        def copy_func(dest):
-            buf = BytesIO()
-            db.copy_cover_to(book_id, buf)
-            quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
-            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
-            dest.write(data)
-    return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
+
+def scaled_cover(ctx, rd, prefix, library_id, db, book_id, width, height, mtime):
+    ''' Scaled covers are small and numerous, so instead of a temporary file
+    per cover, they are stored in a packed thumbnail cache and served from
+    memory. '''
+    mt = mtime if isinstance(mtime, (int, float)) else timestampfromdt(mtime)
+    tc = ctx.get_thumbnail_cache(rd.tdir)
+    group_id = f'{library_id}-{width}x{height}'
+    data, timestamp = tc.get_for_group(group_id, book_id)
+    used_cache = 'yes'
+    if data is None or timestamp < mt:
+        used_cache = 'no'
+        buf = BytesIO()
+        db.copy_cover_to(book_id, buf)
+        quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+        data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
+        tc.insert_for_group(group_id, book_id, mt, data)
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = used_cache
+    etag = hashlib.sha1()
+    for x in (prefix, library_id, book_id, mt):
+        etag.update(str(x).encode('utf-8'))
+    return rd.etagged_dynamic_response(etag.hexdigest(), lambda: data, 'image/jpeg')
 
 
 def fname_for_content_disposition(fname, as_encoded_unicode=False):
@@ -225,6 +310,7 @@ def copy_func(dest):
     rd.outheaders['Content-Disposition'] = (
         f'''{cd}; filename="{book_filename(rd, book_id, mi, fmt)}"; filename*=utf-8''{book_filename(rd, book_id, mi, fmt, as_encoded_unicode=True)}''')
 
+    prerenderer.book_downloaded(library_id, book_id)
     return create_file_copy(ctx, rd, 'fmt', library_id, book_id, fmt, mtime, copy_func, extra_etag_data=extra_etag_data)
 # }}}
 
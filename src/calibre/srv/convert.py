@@ -10,7 +10,7 @@
 from calibre.customize.ui import input_profiles, output_profiles, run_plugins_on_postconvert
 from calibre.db.errors import NoSuchBook
 from calibre.srv.changes import formats_added
-from calibre.srv.errors import BookNotFound, HTTPNotFound
+from calibre.srv.errors import BookNotFound, HTTPBadRequest, HTTPNotFound
 from calibre.srv.routes import endpoint, json
 from calibre.srv.utils import get_library_data
 from calibre.utils.localization import _
@@ -156,6 +156,10 @@ def queue_job(ctx, rd, library_id, db, fmt, book_id, conversion_data):
 
 @endpoint('/conversion/start/{book_id}', postprocess=json, needs_db_write=True, types={'book_id': int}, methods=receive_data_methods)
 def start_conversion(ctx, rd, book_id):
+    if ctx.write_coordinator is not None:
+        # The status of a conversion job is only known to the process running
+        # it, and polls for the status can go to any process
+        raise HTTPBadRequest('Converting books is not supported when running several server processes')
     db, library_id = get_library_data(ctx, rd)[:2]
     if not ctx.has_id(rd, db, book_id):
         raise BookNotFound(book_id, db)
@@ -103,6 +103,7 @@ def start(self):
                         pass
                 return
             self.handler.set_jobs_manager(self.loop.jobs_manager)
+            self.handler.set_thread_pool(self.loop.pool)
             self.current_thread = t = Thread(
                 name='EmbeddedServer', target=self.serve_forever
             )
@@ -10,11 +10,13 @@
 from calibre.srv.auth import AuthController
 from calibre.srv.errors import HTTPForbidden
 from calibre.srv.library_broker import LibraryBroker, path_for_db
+from calibre.srv.metrics import Metrics
 from calibre.srv.routes import Router
 from calibre.srv.users import UserManager
+from calibre.srv.utils import PrecompressedOutput
 from calibre.utils.date import utcnow
 from calibre.utils.search_query_parser import ParseException
-from polyglot.builtins import itervalues
+from polyglot.builtins import iteritems, itervalues
 
 
 class Context:
@@ -22,25 +24,44 @@ class Context:
     log = None
     url_for = None
     jobs_manager = None
+    thread_pool = None
+    # Set when running as one of several server processes, see worker_processes.py
+    write_coordinator = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
+    INTERFACE_DATA_CACHE_SIZE = 16
+    THUMBNAIL_CACHE_SIZE = 256  # MB
+    thumbnail_cache = None
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
-        self.library_broker = libraries if isinstance(libraries, LibraryBroker) else LibraryBroker(libraries)
+        self.library_broker = libraries if isinstance(libraries, LibraryBroker) else LibraryBroker(
+            libraries, max_loaded=opts.max_loaded_libraries, idle_timeout=opts.library_idle_timeout * 60,
+            write_chunk_size=opts.db_write_chunk_size)
         self.testing = testing
         self.lock = Lock()
         self.user_manager = UserManager(opts.userdb)
         self.ignored_fields = frozenset(filter(None, (x.strip() for x in (opts.ignored_fields or '').split(','))))
         self.displayed_fields = frozenset(filter(None, (x.strip() for x in (opts.displayed_fields or '').split(','))))
         self._notify_changes = notify_changes
+        self.interface_data_cache_counts = {'hits': 0, 'misses': 0, 'not_modified': 0}
+        self.metrics = Metrics(slow_request_threshold=opts.slow_request_threshold)
+
+    def get_thumbnail_cache(self, tdir):
+        ' The cache of scaled covers, stored in the temporary directory of the server '
+        with self.lock:
+            if self.thumbnail_cache is None:
+                from calibre.db.utils import PackedThumbnailCache
+                self.thumbnail_cache = PackedThumbnailCache(
+                    name='thumbnails', location=tdir, max_size=self.THUMBNAIL_CACHE_SIZE, thumbnail_size=(0, 0))
+            return self.thumbnail_cache
 
     def notify_changes(self, library_path, change_event):
         if self._notify_changes is not None:
             self._notify_changes(library_path, change_event)
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
-        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data)
+    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, priority='normal'):
+        return self.jobs_manager.start_job(name, module, func, args, kwargs, job_done_callback, job_data, priority)
 
     def job_status(self, job_id):
         return self.jobs_manager.job_status(job_id)
@@ -128,15 +149,35 @@ def get_effective_book_ids(self, db, request_data, vl, report_parse_errors=False
                 raise
             return frozenset()
 
+    def books_key(self, request_data, db, vl, report_parse_errors=False):
+        '''
+        Return a key identifying the books in the restriction and virtual
+        library, for caching data generated from them, and the set of those
+        books if it had to be computed. The books are identified by the
+        restriction and virtual library rather than by their ids, which would
+        be expensive to hash and compare for large libraries, if their searches
+        can only change when the library does, as the entries are invalidated
+        whenever the library changes.
+        '''
+        restriction = self.restriction_for(request_data, db)
+        vl_search = db.pref('virtual_libraries', {}).get(vl, '') if vl else ''
+        if db.search_is_stable(restriction) and db.search_is_stable(vl_search):
+            return (restriction, vl), None
+        # For example, a search on marked books or relative dates
+        book_ids = self.get_effective_book_ids(db, request_data, vl, report_parse_errors=report_parse_errors)
+        return book_ids, book_ids
+
     def get_categories(self, request_data, db, sort='name', first_letter_sort=True,
                        vl='', report_parse_errors=False):
-        restrict_to_ids = self.get_effective_book_ids(db, request_data, vl,
-                                          report_parse_errors=report_parse_errors)
-        key = restrict_to_ids, sort, first_letter_sort
+        books_key, restrict_to_ids = self.books_key(request_data, db, vl, report_parse_errors=report_parse_errors)
+        key = 'categories', books_key, sort, first_letter_sort
         with self.lock:
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
             if old is None or old[0] <= db.last_modified():
+                if restrict_to_ids is None:
+                    restrict_to_ids = self.get_effective_book_ids(db, request_data, vl,
+                                                      report_parse_errors=report_parse_errors)
                 categories = db.get_categories(book_ids=restrict_to_ids, sort=sort, first_letter_sort=first_letter_sort)
                 cache[key] = old = (utcnow(), categories)
                 if len(cache) > self.CATEGORY_CACHE_SIZE:
@@ -146,12 +187,14 @@ def get_categories(self, request_data, db, sort='name', first_letter_sort=True,
             return old[1]
 
     def get_tag_browser(self, request_data, db, opts, render, vl=''):
-        restrict_to_ids = self.get_effective_book_ids(db, request_data, vl)
-        key = restrict_to_ids, opts
+        books_key, restrict_to_ids = self.books_key(request_data, db, vl)
+        key = 'tag-browser', books_key, opts
         with self.lock:
             cache = self.library_broker.category_caches[db.server_library_id]
             old = cache.pop(key, None)
             if old is None or old[0] <= db.last_modified():
+                if restrict_to_ids is None:
+                    restrict_to_ids = self.get_effective_book_ids(db, request_data, vl)
                 categories = db.get_categories(book_ids=restrict_to_ids, sort=opts.sort_by, first_letter_sort=opts.collapse_model == 'first letter')
                 data = json.dumps(render(db, categories), ensure_ascii=False)
                 if isinstance(data, str):
@@ -163,6 +206,46 @@ def get_tag_browser(self, request_data, db, opts, render, vl=''):
                 cache[key] = old
             return old[1]
 
+    def get_interface_data(self, db, etag, generate):
+        '''
+        Return the response identified by etag, serialized and compressed,
+        calling generate() to create it if it is not cached. The etag must
+        change whenever the response would, so entries are never invalidated,
+        only evicted when they are the least recently used.
+        '''
+        with self.lock:
+            cache = self.library_broker.interface_data_caches[db.server_library_id]
+            ans = cache.pop(etag, None)
+            if ans is not None:
+                cache[etag] = ans
+                self.interface_data_cache_counts['hits'] += 1
+                return ans
+            self.interface_data_cache_counts['misses'] += 1
+        # Generated without the lock held as it involves a search and
+        # serializing the metadata of all the books in the response
+        ans = PrecompressedOutput(generate(), etag)
+        with self.lock:
+            cache = self.library_broker.interface_data_caches[db.server_library_id]
+            cache[etag] = ans
+            if len(cache) > self.INTERFACE_DATA_CACHE_SIZE:
+                cache.popitem(last=False)
+        return ans
+
+    def interface_data_not_modified(self):
+        with self.lock:
+            self.interface_data_cache_counts['not_modified'] += 1
+
+    def interface_data_cache_stats(self):
+        ' Hit counts and memory used by the cache of interface data responses '
+        with self.lock:
+            ans = dict(self.interface_data_cache_counts)
+            ans['libraries'] = {
+                library_id: {'entries': len(cache), 'size': sum(x.size for x in itervalues(cache))}
+                for library_id, cache in iteritems(self.library_broker.interface_data_caches)}
+        total = ans['hits'] + ans['misses'] + ans['not_modified']
+        ans['hit_rate'] = (ans['hits'] + ans['not_modified']) / total if total else 0
+        return ans
+
     def search(self, request_data, db, query, vl='', report_restriction_errors=False):
         try:
             restrict_to_ids = self.get_effective_book_ids(db, request_data, vl, report_parse_errors=report_restriction_errors)
@@ -189,19 +272,20 @@ def search(self, request_data, db, query, vl='', report_restriction_errors=False
             return old[1]
 
 
-SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'fts')
+SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert', 'fts', 'metrics')
 
 
 class Handler:
 
-    def __init__(self, libraries, opts, testing=False, notify_changes=None):
+    def __init__(self, libraries, opts, testing=False, notify_changes=None, nonce_secret=None):
         ctx = Context(libraries, opts, testing=testing, notify_changes=notify_changes)
         self.auth_controller = None
         if opts.auth:
             has_ssl = opts.ssl_certfile is not None and opts.ssl_keyfile is not None
             prefer_basic_auth = {'auto':has_ssl, 'basic':True}.get(opts.auth_mode, False)
             self.auth_controller = AuthController(
-                user_credentials=ctx.user_manager, prefer_basic_auth=prefer_basic_auth, ban_time_in_minutes=opts.ban_for, ban_after=opts.ban_after)
+                user_credentials=ctx.user_manager, prefer_basic_auth=prefer_basic_auth, ban_time_in_minutes=opts.ban_for, ban_after=opts.ban_after,
+                nonce_secret=nonce_secret)
         self.router = Router(ctx=ctx, url_prefix=opts.url_prefix, auth_controller=self.auth_controller)
         for module in SRV_MODULES:
             module = import_module('calibre.srv.' + module)
@@ -211,15 +295,21 @@ def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.dispatch = self.router.dispatch
 
     def set_log(self, log):
-        self.router.ctx.log = log
+        self.router.ctx.log = self.router.ctx.metrics.log = log
         if self.auth_controller is not None:
             self.auth_controller.log = log
 
     def set_jobs_manager(self, jobs_manager):
         self.router.ctx.jobs_manager = jobs_manager
 
+    def set_thread_pool(self, thread_pool):
+        self.router.ctx.thread_pool = thread_pool
+
     def close(self):
+        self.router.ctx.metrics.shutdown()
         self.router.ctx.library_broker.close()
+        if self.router.ctx.thumbnail_cache is not None:
+            self.router.ctx.thumbnail_cache.shutdown()
 
     @property
     def ctx(self):
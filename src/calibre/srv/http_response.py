@@ -11,7 +11,7 @@
 import time
 import uuid
 from collections import namedtuple
-from functools import wraps
+from functools import partial, wraps
 from io import DEFAULT_BUFFER_SIZE, BytesIO
 from itertools import chain, repeat
 from operator import itemgetter
@@ -20,12 +20,24 @@
 from calibre.constants import __version__
 from calibre.srv.errors import HTTPSimpleResponse
 from calibre.srv.http_request import HTTPRequest, read_headers
-from calibre.srv.loop import WRITE
-from calibre.srv.utils import HTTP1, HTTP11, Cookie, MultiDict, get_translator_for_lang, http_date, socket_errors_socket_closed, sort_q_values
+from calibre.srv.loop import WAIT, WRITE
+from calibre.srv.utils import (
+    HTTP1,
+    HTTP11,
+    Cookie,
+    MultiDict,
+    PrecompressedOutput,
+    WorkerGeneratedOutput,
+    get_translator_for_lang,
+    http_date,
+    socket_errors_socket_closed,
+    sort_q_values,
+)
 from calibre.utils.monotonic import monotonic
 from calibre.utils.speedups import ReadOnlyFileBuffer
 from polyglot import http_client, reprlib
 from polyglot.builtins import error_message, iteritems, itervalues, reraise, string_or_bytes
+from polyglot.queue import Full
 
 Range = namedtuple('Range', 'start stop size')
 MULTIPART_SEPARATOR = uuid.uuid4().hex
@@ -170,16 +182,21 @@ def gzip_prefix():
 
 
 def compress_readable_output(src_file, compress_level=6):
+    return compress_chunks(iter(partial(src_file.read, DEFAULT_BUFFER_SIZE), b''), compress_level)
+
+
+def compress_chunks(chunks, compress_level=6):
     crc = zlib.crc32(b'')
     size = 0
     zobj = zlib.compressobj(compress_level,
                             zlib.DEFLATED, -zlib.MAX_WBITS,
                             zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY)
     prefix_written = False
-    while True:
-        data = src_file.read(DEFAULT_BUFFER_SIZE)
+    for data in chunks:
         if not data:
-            break
+            continue
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
         size += len(data)
         crc = zlib.crc32(data, crc)
         data = zobj.compress(data)
@@ -187,7 +204,7 @@ def compress_readable_output(src_file, compress_level=6):
             prefix_written = True
             data = gzip_prefix() + data
         yield data
-    yield zobj.flush() + struct.pack(b'<L', crc & 0xffffffff) + struct.pack(b'<L', size)
+    yield (b'' if prefix_written else gzip_prefix()) + zobj.flush() + struct.pack(b'<L', crc & 0xffffffff) + struct.pack(b'<L', size)
 # }}}
 
 
@@ -328,7 +345,7 @@ def filesystem_file_output(output, outheaders, stat_result):
 
 
 def dynamic_output(output, outheaders, etag=None):
-    if isinstance(output, bytes):
+    if isinstance(output, (bytes, memoryview)):
         data = output
     else:
         data = output.encode('utf-8')
@@ -351,11 +368,13 @@ def __call__(self):
 
 class GeneratedOutput:
 
-    def __init__(self, output, etag=None):
+    def __init__(self, output, etag=None, in_worker=False):
         self.output = output
         self.content_length = None
         self.etag = etag
         self.accept_ranges = False
+        # Generate the chunks in worker threads, not the event loop thread
+        self.in_worker = in_worker
 
 
 class StaticOutput:
@@ -581,7 +600,11 @@ def write_response_body(self, output):
             else:
                 self.set_state(WRITE, self.write_buf, output.src_file)
         elif isinstance(output, GeneratedOutput):
-            self.set_state(WRITE, self.write_iter, chain(output.output, repeat(None, 1)))
+            chunks = chain(output.output, repeat(None, 1))
+            if output.in_worker:
+                self.generate_chunk_in_worker(chunks)
+            else:
+                self.set_state(WRITE, self.write_iter, chunks)
         else:
             raise TypeError(f'Unknown output type: {output!r}')
 
@@ -606,8 +629,26 @@ def write_range(self, buf, end, ranges, event):
         if self.write(buf, end=end):
             self.set_state(WRITE, self.write_ranges, buf, ranges)
 
-    def write_iter(self, output, event):
-        chunk = next(output)
+    def write_iter(self, output, event, in_worker=False):
+        self.send_chunk(next(output), output, event, in_worker)
+
+    def generate_chunk_in_worker(self, output):
+        try:
+            self.pool.put_nowait(self.socket.fileno(), partial(next, output))
+        except Full:
+            # The worker threads are busy, generate the chunk in this thread
+            self.set_state(WRITE, self.write_iter, output, in_worker=True)
+        else:
+            self.set_state(WAIT, self.chunk_generated, output)
+
+    def chunk_generated(self, output, event):
+        ok, result = event
+        if not ok:
+            # The response has started, so the connection is closed
+            reraise(*result)
+        self.send_chunk(result, output, event, True)
+
+    def send_chunk(self, chunk, output, event, in_worker):
         if chunk is None:
             self.set_state(WRITE, self.write_chunk, ReadOnlyFileBuffer(b'0\r\n\r\n'), output, last=True)
         else:
@@ -615,15 +656,19 @@ def write_iter(self, output, event):
                 if not isinstance(chunk, bytes):
                     chunk = chunk.encode('utf-8')
                 chunk = (f'{len(chunk):X}\r\n').encode('ascii') + chunk + b'\r\n'
-                self.set_state(WRITE, self.write_chunk, ReadOnlyFileBuffer(chunk), output)
+                self.set_state(WRITE, self.write_chunk, ReadOnlyFileBuffer(chunk), output, in_worker=in_worker)
+            elif in_worker:
+                self.generate_chunk_in_worker(output)
             else:
                 # Empty chunk, ignore it
                 self.write_iter(output, event)
 
-    def write_chunk(self, buf, output, event, last=False):
+    def write_chunk(self, buf, output, event, last=False, in_worker=False):
         if self.write(buf):
             if last:
                 self.reset_state()
+            elif in_worker:
+                self.generate_chunk_in_worker(output)
             else:
                 self.set_state(WRITE, self.write_iter, output)
 
@@ -649,6 +694,7 @@ def finalize_output(self, output, request, is_http1):
 
         opts = self.opts
         outheaders = request.outheaders
+        precompressed = None
         stat_result = file_metadata(output)
         if stat_result is not None:
             output = filesystem_file_output(output, outheaders, stat_result)
@@ -671,12 +717,19 @@ def finalize_output(self, output, request, is_http1):
             output = ReadableOutput(ReadOnlyFileBuffer(output.data), etag=output.etag, content_length=output.content_length)
         elif isinstance(output, ETaggedDynamicOutput):
             output = dynamic_output(output(), outheaders, etag=output.etag)
+        elif isinstance(output, WorkerGeneratedOutput):
+            output = GeneratedOutput(output.chunks, in_worker=True)
+        elif isinstance(output, PrecompressedOutput):
+            precompressed = output.compressed
+            output = ReadableOutput(ReadOnlyFileBuffer(output.data), etag=output.etag, content_length=len(output.data))
+            output.accept_ranges = False
         else:
             output = GeneratedOutput(output)
         ct = outheaders.get('Content-Type', '').partition(';')[0]
         compressible = (not ct or ct.startswith(('text/', 'image/svg')) or ct.partition(';')[0] in COMPRESSIBLE_TYPES)
         compressible = (compressible and request.status_code == http_client.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
+                        # The length of generated output is not known in advance
+                        (opts.compress_min_size > -1 and (output.content_length is None or output.content_length >= opts.compress_min_size)) and
                         acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == http_client.OK and
                         not is_http1)
@@ -708,7 +761,15 @@ def finalize_output(self, output, request, is_http1):
             outheaders.set('Content-Encoding', 'gzip', replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', f'{output.content_length}')
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            if precompressed is not None:
+                # The compressed size is known, so send it with a Content-Length
+                output = ReadableOutput(ReadOnlyFileBuffer(precompressed), etag=output.etag, content_length=len(precompressed))
+                output.accept_ranges = False
+                compressible = False
+            elif isinstance(output, GeneratedOutput):
+                output = GeneratedOutput(compress_chunks(output.output), etag=output.etag, in_worker=output.in_worker)
+            else:
+                output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
         if output.content_length is not None and not compressible and not ranges:
             outheaders.set('Content-Length', f'{output.content_length}', replace_all=True)
 
@@ -15,8 +15,9 @@
 from polyglot.builtins import iteritems, itervalues
 from polyglot.queue import Empty, Queue
 
-StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data')
+StartEvent = namedtuple('StartEvent', 'job_id name module function args kwargs callback data priority')
 DoneEvent = namedtuple('DoneEvent', 'job_id')
+BumpEvent = namedtuple('BumpEvent', 'job_id')
 
 
 class Job(Thread):
@@ -29,7 +30,10 @@ def __init__(self, start_event, events_queue):
         self.events_queue = events_queue
         self.job_name = start_event.name
         self.job_id = start_event.job_id
-        self.func = partial(fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs, abort=self.abort_event)
+        self.priority = start_event.priority
+        self.func = partial(
+            fork_job, start_event.module, start_event.function, start_event.args, start_event.kwargs,
+            abort=self.abort_event, priority=start_event.priority)
         self.data, self.callback = start_event.data, start_event.callback
         self.result = self.traceback = None
         self.done = False
@@ -98,11 +102,16 @@ def __init__(self, opts, log):
         self.job_id = count()
         self.waiting_job_ids = set()
         self.waiting_jobs = deque()
+        # Jobs that are started only when no other jobs are waiting, one at a time
+        self.low_priority_jobs = deque()
         self.max_block = None
         self.shutting_down = False
         self.event_loop = None
 
-    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None):
+    def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=None, job_data=None, priority='normal'):
+        ''' Queue a job. Jobs with priority 'low' run in a worker process with
+        low priority and are only started when there are no other jobs
+        waiting. '''
         with self.lock:
             if self.shutting_down:
                 return None
@@ -111,10 +120,16 @@ def start_job(self, name, module, func, args=(), kwargs=None, job_done_callback=
                 t.daemon = True
                 t.start()
             job_id = next(self.job_id)
-            self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data))
+            self.events.put(StartEvent(job_id, name, module, func, args, kwargs or {}, job_done_callback, job_data, priority))
             self.waiting_job_ids.add(job_id)
             return job_id
 
+    def bump_job(self, job_id):
+        ' Run a waiting low priority job as a normal job, for when a user is waiting for its result '
+        with self.lock:
+            if job_id in self.waiting_job_ids and not self.shutting_down:
+                self.events.put(BumpEvent(job_id))
+
     def job_status(self, job_id):
         with self.lock:
             if not self.shutting_down:
@@ -127,6 +142,15 @@ def job_status(self, job_id):
                     return 'waiting', None, None, None
         return None, None, None, None
 
+    def stats(self):
+        ' The number of running jobs and of jobs waiting to be started '
+        with self.lock:
+            return {
+                'running': len(self.jobs), 'waiting': len(self.waiting_job_ids),
+                'low_priority_waiting': len(self.low_priority_jobs), 'max_jobs': self.max_jobs,
+                'finished': len(self.finished_jobs),
+            }
+
     def abort_job(self, job_id):
         job = self.jobs.get(job_id)
         if job is not None:
@@ -175,8 +199,10 @@ def run(self):
             if ev is None:
                 self.abort_hanging_jobs()
             elif isinstance(ev, StartEvent):
-                self.waiting_jobs.append(ev)
+                (self.low_priority_jobs if ev.priority == 'low' else self.waiting_jobs).append(ev)
                 self.start_waiting_jobs()
+            elif isinstance(ev, BumpEvent):
+                self.bump_waiting_job(ev.job_id)
             elif isinstance(ev, DoneEvent):
                 self.job_finished(ev.job_id)
             elif ev is False:
@@ -188,8 +214,22 @@ def start_waiting_jobs(self):
                 ev = self.waiting_jobs.popleft()
                 self.jobs[ev.job_id] = Job(ev, self.events)
                 self.waiting_job_ids.discard(ev.job_id)
+            if self.low_priority_jobs and not self.waiting_jobs and len(self.jobs) < self.max_jobs and not any(
+                    job.priority == 'low' for job in itervalues(self.jobs)):
+                ev = self.low_priority_jobs.popleft()
+                self.jobs[ev.job_id] = Job(ev, self.events)
+                self.waiting_job_ids.discard(ev.job_id)
         self.update_max_block()
 
+    def bump_waiting_job(self, job_id):
+        with self.lock:
+            for ev in self.low_priority_jobs:
+                if ev.job_id == job_id:
+                    self.low_priority_jobs.remove(ev)
+                    self.waiting_jobs.append(ev._replace(priority='normal'))
+                    break
+        self.start_waiting_jobs()
+
     def update_max_block(self):
         with self.lock:
             mb = None
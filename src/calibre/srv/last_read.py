@@ -74,6 +74,13 @@ def get_recently_read(self, user):
                 })
             return ans
 
+    def recently_read_books(self, library_id, limit=10):
+        ' The (book_id, format) pairs most recently read by any user in the specified library '
+        with lock:
+            return [(book, fmt) for book, fmt, epoch in self.execute(
+                'SELECT book,format,MAX(epoch) AS latest FROM last_read_positions WHERE library_id=? GROUP BY book,format ORDER BY latest DESC LIMIT ?',
+                (library_id, limit))]
+
 
 path_cache = {}
 
@@ -2,7 +2,9 @@
 # License: GPLv3 Copyright: 2017, Kovid Goyal <kovid at kovidgoyal.net>
 
 
+import gc
 import os
+import sys
 from collections import OrderedDict, defaultdict
 from threading import RLock as Lock
 
@@ -92,10 +94,41 @@ def db_matches(db, library_id, library_path):
     return samefile(dbpath, os.path.join(library_path, os.path.basename(dbpath)))
 
 
+def refcount_of_item(container, key):
+    # The number of references to container[key], always measured this way,
+    # so that the counts can be compared
+    return sys.getrefcount(container[key])
+
+
 class LibraryBroker:
 
-    def __init__(self, libraries):
+    # Libraries used more recently than this are never evicted to make room
+    # for another library, as requests may still be using them
+    MIN_IDLE_FOR_EVICTION = 60  # seconds
+    EVICTION_CHECK_INTERVAL = 10  # seconds
+
+    def __init__(self, libraries, max_loaded=0, idle_timeout=0, write_chunk_size=0):
+        '''
+        :param max_loaded: The maximum number of libraries to keep loaded at a
+        time, zero for no limit.
+        :param idle_timeout: Libraries not used for this many seconds are
+        closed, zero for never. Closed libraries are re-loaded when next used.
+        :param write_chunk_size: If non-zero, long running writes to the
+        loaded libraries let other requests use the library after every
+        write_chunk_size books, see Cache.set_write_chunk_size()
+        '''
         self.lock = Lock()
+        self.max_loaded, self.idle_timeout = max_loaded, idle_timeout
+        self.write_chunk_size = write_chunk_size
+        self.last_used = {}
+        self.last_eviction_check = monotonic()
+        self.load_stats = {'loads': 0, 'load_time': 0., 'max_load_time': 0., 'idle_evictions': 0, 'capacity_evictions': 0}
+        self.load_times = {}
+        # Libraries that have been unloaded but may still be in use, as
+        # (db, number of references to db when it was not in use)
+        self.unloaded = []
+        self.unused_refcounts = {}
+        self.last_unloaded_collection = monotonic()
         self.lmap = OrderedDict()
         self.library_name_map = {}
         self.original_path_map = {}
@@ -118,25 +151,125 @@ def __init__(self, libraries):
             self.library_name_map[library_id] = basename(corrected_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
-        self.category_caches, self.search_caches, self.tag_browser_caches = (
+        self.category_caches, self.search_caches, self.tag_browser_caches, self.interface_data_caches = (
             defaultdict(OrderedDict), defaultdict(OrderedDict),
-            defaultdict(OrderedDict))
+            defaultdict(OrderedDict), defaultdict(OrderedDict))
 
     def get(self, library_id=None):
+        try:
+            return self._get(library_id)
+        finally:
+            if self.unloaded:
+                self.close_unloaded()
+
+    def _get(self, library_id):
         with self:
             library_id = library_id or self.default_library
+            now = monotonic()
             if library_id in self.loaded_dbs:
+                self.last_used[library_id] = now
+                if (self.max_loaded or self.idle_timeout) and now - self.last_eviction_check > self.EVICTION_CHECK_INTERVAL:
+                    self._evict_libraries(now)
                 return self.loaded_dbs[library_id]
             path = self.lmap.get(library_id)
             if path is None:
                 return
+            if self.max_loaded or self.idle_timeout:
+                self._evict_libraries(now, room_for=1)
             try:
-                self.loaded_dbs[library_id] = ans = self.init_library(
-                    path, library_id == self.default_library)
+                self.loaded_dbs[library_id] = self.init_library(path, library_id == self.default_library)
+                self.unused_refcounts[library_id] = refcount_of_item(self.loaded_dbs, library_id)
+                ans = self.loaded_dbs[library_id]
                 ans.new_api.server_library_id = library_id
+                if self.write_chunk_size:
+                    ans.new_api.set_write_chunk_size(self.write_chunk_size)
             except Exception:
                 self.loaded_dbs[library_id] = None
                 raise
+            finally:
+                self.last_used[library_id] = end = monotonic()
+            ls = self.load_stats
+            ls['loads'] += 1
+            self.load_times[library_id] = t = end - now
+            ls['load_time'] += t
+            ls['max_load_time'] = max(ls['max_load_time'], t)
+            return ans
+
+    def _evict_libraries(self, now, room_for=0):
+        # Must be called with lock held
+        self.last_eviction_check = now
+        if self.idle_timeout:
+            idle_timeout = max(self.idle_timeout, self.MIN_IDLE_FOR_EVICTION)
+            for library_id in tuple(self.loaded_dbs):
+                if now - self.last_used.get(library_id, now) > idle_timeout:
+                    self._unload(library_id)
+                    self.load_stats['idle_evictions'] += 1
+        if self.max_loaded:
+            excess = len(self.loaded_dbs) + room_for - self.max_loaded
+            if excess > 0:
+                candidates = sorted((
+                    (self.last_used.get(library_id, now), library_id) for library_id in self.loaded_dbs
+                    if now - self.last_used.get(library_id, now) > self.MIN_IDLE_FOR_EVICTION), key=lambda x: x[0])
+                for last_used, library_id in candidates[:excess]:
+                    self._unload(library_id)
+                    self.load_stats['capacity_evictions'] += 1
+
+    def _unload(self, library_id):
+        # Must be called with lock held. The library is closed later, by
+        # close_unloaded(), as closing is slow and it may still be in use.
+        db = self.loaded_dbs.pop(library_id, None)
+        unused_refcount = self.unused_refcounts.pop(library_id, None)
+        self.last_used.pop(library_id, None)
+        for c in (self.category_caches, self.search_caches, self.tag_browser_caches, self.interface_data_caches):
+            c.pop(library_id, None)
+        if db is not None:
+            self.unloaded.append((db, unused_refcount))
+
+    def close_unloaded(self):
+        '''
+        Close the unloaded libraries that are no longer in use, for example,
+        by requests, streamed responses or jobs that got them before they were
+        unloaded. Must be called without the lock held.
+        '''
+        with self:
+            unused = self._pop_unused_unloaded()
+            now = monotonic()
+            collect = bool(self.unloaded) and now - self.last_unloaded_collection > self.EVICTION_CHECK_INTERVAL
+            if collect:
+                self.last_unloaded_collection = now
+        if collect:
+            # Snapshots are only freed by the garbage collector, as they
+            # refer to themselves, and they keep their library alive
+            gc.collect()
+            with self:
+                unused.extend(self._pop_unused_unloaded())
+        for db, unused_refcount in unused:
+            db.close()
+
+    def _pop_unused_unloaded(self):
+        # Must be called with lock held
+        unused, in_use = [], []
+        for entry in self.unloaded:
+            # The current snapshot refers to the library, but is not a use of
+            # it. Requests that are using the snapshot hold a reference to
+            # it, and so, through it, to the library.
+            if getattr(entry[0], 'current_snapshot', None) is not None:
+                entry[0].current_snapshot = None
+            # Anything using the library holds a reference to it
+            (unused if entry[1] is None or refcount_of_item(entry, 0) <= entry[1] else in_use).append(entry)
+        self.unloaded = in_use
+        return unused
+
+    def stats(self):
+        ' Statistics about loaded libraries, load times and evictions '
+        with self:
+            now = monotonic()
+            ans = self.load_stats.copy()
+            ans['loaded'] = {
+                library_id: {'idle_for': now - self.last_used.get(library_id, now), 'load_time': self.load_times.get(library_id)}
+                for library_id, db in self.loaded_dbs.items() if db is not None}
+            ans['unloaded_in_use'] = len(self.unloaded)
+            ans['max_loaded'], ans['idle_timeout'] = self.max_loaded, self.idle_timeout
             return ans
 
     def init_library(self, library_path, is_default_library):
@@ -147,7 +280,9 @@ def close(self):
         with self:
             for db in itervalues(self.loaded_dbs):
                 getattr(db, 'close', lambda: None)()
-            self.lmap, self.loaded_dbs = OrderedDict(), {}
+            for db, unused_refcount in self.unloaded:
+                db.close()
+            self.lmap, self.loaded_dbs, self.unloaded = OrderedDict(), {}, []
 
     @property
     def default_library(self):
@@ -7,6 +7,7 @@
 import ipaddress
 import os
 import select
+import selectors
 import socket
 import ssl
 import traceback
@@ -186,7 +187,10 @@ def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log,
             self.is_trusted_ip = is_ip_trusted(self.parsed_remote_addr, parsed_trusted_ips(self.opts.trusted_ips))
         self.orig_send_bufsize = self.send_bufsize = 4096
         self.tdir = tdir
-        self.wait_for = READ
+        # Called whenever wait_for changes, used by the selectors based event
+        # loop to update the readiness interest registered for this connection
+        self.wait_for_changed = None
+        self._wait_for = READ
         self.response_started = False
         self.read_buffer = ReadBuffer()
         self.handle_event = None
@@ -203,6 +207,17 @@ def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log,
         self.last_activity = monotonic()
         self.ready = True
 
+    @property
+    def wait_for(self):
+        return self._wait_for
+
+    @wait_for.setter
+    def wait_for(self, val):
+        if val is not self._wait_for:
+            self._wait_for = val
+            if self.wait_for_changed is not None:
+                self.wait_for_changed()
+
     def optimize_for_sending_packet(self):
         start_cork(self.socket)
         self.orig_send_bufsize = self.send_bufsize = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
@@ -342,7 +357,7 @@ def drain_ssl_buffer(self):
 
     def close(self):
         self.ready = False
-        self.handle_event = None  # prevent reference cycles
+        self.handle_event = self.wait_for_changed = None  # prevent reference cycles
         try:
             self.socket.shutdown(socket.SHUT_WR)
         except OSError:
@@ -390,6 +405,97 @@ def parsed_trusted_ips(raw):
     return tuple(parse_trusted_ips(raw)) if raw else ()
 
 
+class ConnectionPoller:  # {{{
+
+    ''' Keeps the readiness interest of every connection registered with the
+    most efficient selector available on this platform (epoll/kqueue), updating
+    it only when a connection changes what it is waiting for. This avoids
+    re-building the fd lists for select() on every tick and the FD_SETSIZE
+    limit on the number of connections. '''
+
+    def __init__(self, listener, control):
+        self.selector = selectors.DefaultSelector()
+        self.listener, self.control = listener, control
+        self.selector.register(listener, selectors.EVENT_READ)
+        self.selector.register(control, selectors.EVENT_READ)
+        self.registered = {}
+        # File descriptors whose interest has to be re-evaluated, written to
+        # from other threads as well, so only use atomic set operations on it
+        self.dirty = set()
+
+    def add(self, s, conn):
+        conn.wait_for_changed = partial(self.dirty.add, s)
+        self.dirty.add(s)
+
+    def discard(self, s):
+        self.dirty.discard(s)
+        if self.registered.pop(s, None) is not None:
+            with suppress(KeyError, ValueError, OSError):
+                self.selector.unregister(s)
+
+    def update(self, connection_map, has_ssl, close_needed):
+        ' Sync interest for changed connections, returning those that already have buffered data to read '
+        readable = []
+        dirty = self.dirty
+        while dirty:
+            try:
+                s = dirty.pop()
+            except KeyError:
+                break
+            conn = connection_map.get(s)
+            if conn is None:
+                continue
+            wf = conn.wait_for
+            mask = 0
+            if wf is READ or wf is RDWR:
+                if wf is RDWR:
+                    mask |= selectors.EVENT_WRITE
+                if not conn.read_buffer.has_data and has_ssl:
+                    conn.drain_ssl_buffer()
+                    if not conn.ready:
+                        close_needed.append((s, conn))
+                        continue
+                if conn.read_buffer.has_data:
+                    readable.append(s)
+                else:
+                    mask |= selectors.EVENT_READ
+            elif wf is WRITE:
+                mask = selectors.EVENT_WRITE
+            self.set_interest(s, mask)
+        return readable
+
+    def set_interest(self, s, mask):
+        current = self.registered.get(s, 0)
+        if mask == current:
+            return
+        if not mask:
+            self.selector.unregister(s)
+            del self.registered[s]
+        elif current:
+            self.selector.modify(s, mask)
+            self.registered[s] = mask
+        else:
+            self.selector.register(s, mask)
+            self.registered[s] = mask
+
+    def poll(self, timeout):
+        readable, writable = [], []
+        for key, events in self.selector.select(timeout):
+            s = key.fd
+            if events & selectors.EVENT_READ:
+                readable.append(s)
+            if events & selectors.EVENT_WRITE:
+                writable.append(s)
+        return readable, writable
+
+    def close(self):
+        with suppress(Exception):
+            self.selector.close()
+        self.registered.clear()
+        self.dirty.clear()
+# }}}
+
+
 class ServerLoop:
 
     LISTENING_MSG = 'calibre server listening on'
@@ -420,6 +526,7 @@ def __init__(
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        self.poller = None
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -534,6 +641,9 @@ def serve(self):
         if isinstance(ba, tuple):
             addr = format_addr_for_url(str(ba[0]))
             ba_str = f'{addr}:{ba[1]}'
+        if self.opts.event_loop == 'selectors':
+            self.poller = ConnectionPoller(self.socket.fileno(), self.control_out.fileno())
+            self.last_timeout_check = monotonic()
         self.pool.start()
         with TemporaryDirectory(prefix='srv-') as tdir:
             self.tdir = tdir
@@ -561,6 +671,10 @@ def serve_forever(self):
 
     def setup_socket(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if getattr(self.opts, 'reuse_port', False):
+            # Allow several server processes to listen on the same port, with
+            # the kernel distributing incoming connections between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # If listening on the IPV6 any address ('::' = IN6ADDR_ANY),
@@ -583,6 +697,8 @@ def bind(self, family, atype, proto=0):
         self.socket.bind(self.bind_address)
 
     def tick(self):
+        if self.poller is not None:
+            return self.tick_selectors()
         now = monotonic()
         read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
         has_ssl = self.ssl_context is not None
@@ -615,7 +731,7 @@ def tick(self):
             self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
             self.close(s, conn)
 
-        for x, conn in close_needed:
+        for s, conn in close_needed:
             self.close(s, conn)
 
         if readable:
@@ -642,11 +758,63 @@ def tick(self):
 
         if not self.ready:
             return
+        self.process_actions(readable, writable)
+
+    def tick_selectors(self):
+        # Idle connections are only checked for timeouts periodically, rather
+        # than on every tick, so that the cost of a tick does not depend on
+        # the number of open connections
+        now = monotonic()
+        check_interval = min(1.0, self.opts.timeout)
+        if now - self.last_timeout_check >= check_interval:
+            self.last_timeout_check = now
+            for s, conn in tuple(iteritems(self.connection_map)):
+                if now - conn.last_activity > self.opts.timeout:
+                    if conn.handle_timeout():
+                        conn.last_activity = now
+                    else:
+                        self.log(f'Closing connection because of extended inactivity: {conn.state_description}')
+                        self.close(s, conn)
+
+        close_needed = []
+        try:
+            readable = self.poller.update(self.connection_map, self.ssl_context is not None, close_needed)
+        except (ValueError, OSError):
+            # A bad file descriptor, find and discard the connection(s) using it
+            for s, conn in tuple(iteritems(self.connection_map)):
+                try:
+                    os.fstat(s)
+                except OSError:
+                    self.close(s, conn)
+                else:
+                    self.poller.dirty.add(s)
+            return
+        for s, conn in close_needed:
+            self.close(s, conn)
+
+        if readable:
+            writable = []
+        else:
+            try:
+                readable, writable = self.poller.poll(check_interval)
+            except OSError as e:
+                if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
+                    return
+                raise
+        if not self.ready:
+            return
+        self.process_actions(readable, writable)
 
+    def process_actions(self, readable, writable):
         ignore = set()
+        poller = self.poller
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
                 continue
+            if poller is not None:
+                # Re-check buffered data and interest for every connection that
+                # handled an event
+                poller.dirty.add(s)
             try:
                 conn.handle_event(event)
                 if not conn.ready:
@@ -706,6 +874,8 @@ def dispatch_job_results(self):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        if self.poller is not None:
+            self.poller.discard(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -719,6 +889,8 @@ def get_actions(self, readable, writable):
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        if self.poller is not None:
+                            self.poller.add(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -769,6 +941,9 @@ def shutdown(self):
                 self.socket = None
         for s, conn in tuple(iteritems(self.connection_map)):
             self.close(s, conn)
+        if self.poller is not None:
+            self.poller.close()
+            self.poller = None
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -45,9 +45,13 @@ def encode_datetime(dateval):
 
 
 def add_field(field, db, book_id, ans, field_metadata):
+    if field_metadata.get('datatype') is not None:
+        add_field_value(field, db._field_for(field, book_id), ans, field_metadata)
+
+
+def add_field_value(field, val, ans, field_metadata):
     datatype = field_metadata.get('datatype')
     if datatype is not None:
-        val = db._field_for(field, book_id)
         if val is not None and val not in empty_val:
             if datatype == 'datetime':
                 val = encode_datetime(val)
@@ -72,38 +76,52 @@ def encode_stat_result(s: os.stat_result) -> dict[str, int]:
 
 
 def book_as_json(db, book_id):
+    return books_as_json(db, (book_id,)).get(book_id)
+
+
+def books_as_json(db, book_ids):
+    '''
+    Same as :func:`book_as_json` for many books at once, reading all fields
+    for all books under a single lock acquisition. Returns a mapping of book id
+    to data, books that do not exist are omitted.
+    '''
     db = db.new_api
+    ans = {}
     with db.safe_read_lock:
-        fmts = db._formats(book_id, verify_formats=False)
-        ans = []
-        fm = {}
-        for fmt in fmts:
-            m = db.format_metadata(book_id, fmt)
-            if m and m.get('size', 0) > 0:
-                ans.append(fmt)
-                fm[fmt] = m['size']
-        ans = {'formats': ans, 'format_sizes': fm}
-        if not ans['formats'] and not db.has_id(book_id):
-            return None
         fm = db.field_metadata
-        for field in fm.all_field_keys():
-            if field not in IGNORED_FIELDS:
-                add_field(field, db, book_id, ans, fm[field])
-        ids = ans.get('identifiers')
-        if ids:
-            ans['urls_from_identifiers'] = urls_from_identifiers(ids)
-        langs = ans.get('languages')
-        if langs:
-            ans['lang_names'] = {l:calibre_langcode_to_name(l) for l in langs}
-        link_maps = db.get_all_link_maps_for_book(book_id)
-        if link_maps:
-            ans['link_maps'] = link_maps
-        x = db.items_with_notes_in_book(book_id)
-        if x:
-            ans['items_with_notes'] = {field: {v: k for k, v in items.items()} for field, items in x.items()}
-        data_files = db.list_extra_files(book_id, use_cache=True, pattern=DATA_FILE_PATTERN)
-        if data_files:
-            ans['data_files'] = {e.relpath: encode_stat_result(e.stat_result) for e in data_files}
+        fields = tuple(field for field in fm.all_field_keys() if field not in IGNORED_FIELDS and fm[field].get('datatype') is not None)
+        book_ids = tuple(book_ids)
+        columns = db._fields_for_books(fields, book_ids)
+        columns = tuple((field, fm[field], columns[field]) for field in fields)
+        for i, book_id in enumerate(book_ids):
+            fmts = db._formats(book_id, verify_formats=False)
+            formats = []
+            sizes = {}
+            for fmt in fmts:
+                m = db.format_metadata(book_id, fmt)
+                if m and m.get('size', 0) > 0:
+                    formats.append(fmt)
+                    sizes[fmt] = m['size']
+            if not formats and not db._has_id(book_id):
+                continue
+            data = ans[book_id] = {'formats': formats, 'format_sizes': sizes}
+            for field, field_metadata, values in columns:
+                add_field_value(field, values[i], data, field_metadata)
+            ids = data.get('identifiers')
+            if ids:
+                data['urls_from_identifiers'] = urls_from_identifiers(ids)
+            langs = data.get('languages')
+            if langs:
+                data['lang_names'] = {l:calibre_langcode_to_name(l) for l in langs}
+            link_maps = db.get_all_link_maps_for_book(book_id)
+            if link_maps:
+                data['link_maps'] = link_maps
+            x = db.items_with_notes_in_book(book_id)
+            if x:
+                data['items_with_notes'] = {field: {v: k for k, v in items.items()} for field, items in x.items()}
+            data_files = db.list_extra_files(book_id, use_cache=True, pattern=DATA_FILE_PATTERN)
+            if data_files:
+                data['data_files'] = {e.relpath: encode_stat_result(e.stat_result) for e in data_files}
     return ans
 
 
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import sys
+import traceback
+from bisect import bisect_left
+from itertools import accumulate
+from threading import Event, Lock, Thread, get_ident
+
+from calibre.srv.routes import endpoint
+from calibre.utils.monotonic import monotonic
+from polyglot.builtins import iteritems
+
+# Upper bounds, in seconds, of the buckets of the request latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PROMETHEUS_MIME = 'text/plain; version=0.0.4; charset=UTF-8'
+
+
+class Histogram:
+
+    __slots__ = ('count', 'counts', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.
+        self.count = 0
+
+    def add(self, val):
+        self.counts[bisect_left(LATENCY_BUCKETS, val)] += 1
+        self.total += val
+        self.count += 1
+
+    def cumulative(self):
+        ' Yield (upper bound, number of values <= upper bound) for every bucket, as Prometheus expects '
+        total = 0
+        for bound, c in zip(LATENCY_BUCKETS + ('+Inf',), self.counts):
+            total += c
+            yield bound, total
+
+
+class InFlightRequest:
+
+    __slots__ = ('data', 'route', 'stack', 'start', 'thread_id')
+
+    def __init__(self, route, data):
+        self.route, self.data = route, data
+        self.thread_id = get_ident()
+        self.stack = None
+        self.start = monotonic()
+
+    def __str__(self):
+        # The username is only known once the request has been authenticated
+        return '{} /{} by {}'.format(self.data.method, '/'.join(self.data.path), self.data.username or '-')
+
+
+class Metrics:
+
+    '''
+    Counts of requests and histograms of the time taken to handle them, for
+    every route. The time is that spent in the endpoint, it does not include
+    sending the response, or generating it, for responses that are generated
+    as they are sent.
+
+    If slow_request_threshold is greater than zero, requests that take longer
+    than that many seconds are logged, together with the stack of the thread
+    handling them, sampled once the threshold is exceeded.
+    '''
+
+    def __init__(self, slow_request_threshold=0, log=None):
+        self.lock = Lock()
+        self.slow_request_threshold = slow_request_threshold
+        self.log = log
+        self.latency = {}
+        self.responses = {}
+        self.in_flight = set()
+        self.slow_requests = 0
+        self.shutting_down = Event()
+        self.watcher = None
+
+    def request_started(self, route, data):
+        req = InFlightRequest(route, data)
+        with self.lock:
+            self.in_flight.add(req)
+            if self.slow_request_threshold > 0 and self.watcher is None:
+                self.watcher = t = Thread(name='SlowRequestWatcher', target=self.watch_for_slow_requests)
+                t.daemon = True
+                t.start()
+        return req
+
+    def request_finished(self, req, status_code):
+        duration = monotonic() - req.start
+        key = req.route, status_code
+        with self.lock:
+            self.in_flight.discard(req)
+            h = self.latency.get(req.route)
+            if h is None:
+                h = self.latency[req.route] = Histogram()
+            h.add(duration)
+            self.responses[key] = self.responses.get(key, 0) + 1
+            is_slow = 0 < self.slow_request_threshold <= duration
+            if is_slow:
+                self.slow_requests += 1
+        if is_slow and self.log is not None:
+            self.log.warn(f'Slow request: {req} took {duration:.2f} seconds with status: {status_code}')
+
+    def watch_for_slow_requests(self):
+        interval = max(0.05, self.slow_request_threshold / 2)
+        while not self.shutting_down.wait(interval):
+            now = monotonic()
+            with self.lock:
+                slow = [r for r in self.in_flight if r.stack is None and now - r.start >= self.slow_request_threshold]
+            if not slow:
+                continue
+            frames = sys._current_frames()
+            for req in slow:
+                f = frames.get(req.thread_id)
+                req.stack = '' if f is None else ''.join(traceback.format_stack(f))
+                with self.lock:
+                    still_running = req in self.in_flight
+                if still_running and self.log is not None:
+                    self.log.warn(f'Slow request: {req} has been running for {now - req.start:.2f} seconds, stack:\n{req.stack}')
+            del frames, f
+
+    def shutdown(self):
+        self.shutting_down.set()
+
+    def snapshot(self):
+        with self.lock:
+            latency = {route: (tuple(h.cumulative()), h.total, h.count) for route, h in iteritems(self.latency)}
+            return latency, dict(self.responses), len(self.in_flight), self.slow_requests
+
+
+def escape_label(val):
+    return str(val).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class PrometheusOutput:
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, mtype, help_text, samples):
+        '''
+        Add a metric with the specified samples, which is an iterable of
+        (labels dict, value), or a single value for unlabelled metrics.
+        '''
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} {mtype}')
+        if not isinstance(samples, (list, tuple)) and not hasattr(samples, '__next__'):
+            samples = (({}, samples),)
+        for labels, val in samples:
+            self.sample(name, labels, val)
+
+    def sample(self, name, labels, val):
+        if labels:
+            labels = ','.join(f'{k}="{escape_label(v)}"' for k, v in iteritems(labels))
+            name = f'{name}{{{labels}}}'
+        if isinstance(val, bool):
+            val = int(val)
+        self.lines.append(f'{name} {val}')
+
+    def histogram(self, name, help_text, histograms):
+        self.lines.append(f'# HELP {name} {help_text}')
+        self.lines.append(f'# TYPE {name} histogram')
+        for labels, (buckets, total, count) in histograms:
+            for bound, num in buckets:
+                self.sample(name + '_bucket', dict(labels, le=bound), num)
+            self.sample(name + '_sum', labels, total)
+            self.sample(name + '_count', labels, count)
+
+    def __bytes__(self):
+        return ('\n'.join(self.lines) + '\n').encode('utf-8')
+
+
+def cache_metrics(ctx):
+    ' Yield (cache name, library id, hits, misses) for the various caches used by the server '
+    from calibre.srv.books import cache_lock, rendered_books
+    from calibre.srv.opds import entry_caches, entry_caches_lock
+    s = ctx.interface_data_cache_stats()
+    yield 'interface_data', '', s['hits'] + s['not_modified'], s['misses']
+    with cache_lock:
+        s = rendered_books.stats()
+    yield 'rendered_books', '', s['hits'], s['misses']
+    with entry_caches_lock:
+        opds_caches = tuple(entry_caches.items())
+    for db, cache in opds_caches:
+        yield 'opds_entries', db.server_library_id, cache.hits, cache.misses
+    for library_id, db in loaded_libraries(ctx):
+        s = db.search_cache_stats()
+        yield 'search', library_id, s['hits'], s['misses']
+
+
+def loaded_libraries(ctx):
+    lb = ctx.library_broker
+    with lb:
+        return tuple((library_id, db.new_api) for library_id, db in iteritems(lb.loaded_dbs) if db is not None)
+
+
+def prometheus_metrics(ctx):
+    m = ctx.metrics
+    ans = PrometheusOutput()
+    latency, responses, in_flight, slow_requests = m.snapshot()
+    ans.metric('calibre_http_responses_total', 'counter', 'Number of requests handled, by route and status code', [
+        ({'route': route, 'code': code}, num) for (route, code), num in sorted(iteritems(responses))])
+    ans.histogram('calibre_http_request_duration_seconds', 'Time taken by the endpoint to handle requests, by route', [
+        ({'route': route}, h) for route, h in sorted(iteritems(latency))])
+    ans.metric('calibre_http_requests_in_flight', 'gauge', 'Number of requests currently being handled', in_flight)
+    ans.metric('calibre_http_slow_requests_total', 'counter', 'Number of requests slower than the slow request threshold', slow_requests)
+
+    pool = ctx.thread_pool
+    if pool is not None:
+        ans.metric('calibre_worker_threads_busy', 'gauge', 'Number of worker threads handling requests', pool.busy)
+        ans.metric('calibre_worker_threads_idle', 'gauge', 'Number of idle worker threads', pool.idle)
+        ans.metric('calibre_worker_queue_depth', 'gauge', 'Number of requests waiting for a worker thread', pool.queue_depth)
+    if ctx.jobs_manager is not None:
+        s = ctx.jobs_manager.stats()
+        ans.metric('calibre_jobs_running', 'gauge', 'Number of running worker process jobs', s['running'])
+        ans.metric('calibre_jobs_waiting', 'gauge', 'Number of worker process jobs waiting to be started', s['waiting'])
+
+    caches = tuple(cache_metrics(ctx))
+    ans.metric('calibre_cache_hits_total', 'counter', 'Number of cache hits, by cache and library', [
+        ({'cache': name, 'library': library_id}, hits) for name, library_id, hits, misses in caches])
+    ans.metric('calibre_cache_misses_total', 'counter', 'Number of cache misses, by cache and library', [
+        ({'cache': name, 'library': library_id}, misses) for name, library_id, hits, misses in caches])
+
+    s = ctx.library_broker.stats()
+    ans.metric('calibre_libraries_loaded', 'gauge', 'Number of libraries currently loaded', len(s['loaded']))
+    ans.metric('calibre_library_loads_total', 'counter', 'Number of times a library has been loaded', s['loads'])
+    ans.metric('calibre_library_load_seconds_total', 'counter', 'Total time spent loading libraries', s['load_time'])
+    ans.metric('calibre_library_evictions_total', 'counter', 'Number of times a library has been closed to free memory', [
+        ({'reason': 'idle'}, s['idle_evictions']), ({'reason': 'capacity'}, s['capacity_evictions'])])
+
+    locks = tuple((library_id, db.lock_wait_stats()) for library_id, db in loaded_libraries(ctx))
+    ans.metric('calibre_db_lock_waits_total', 'counter', 'Number of times a thread had to wait for a database lock', [
+        ({'library': library_id, 'mode': mode}, s[mode]['waits']) for library_id, s in locks for mode in ('shared', 'exclusive')])
+    ans.metric('calibre_db_lock_wait_seconds_total', 'counter', 'Total time spent waiting for database locks', [
+        ({'library': library_id, 'mode': mode}, s[mode]['wait_time']) for library_id, s in locks for mode in ('shared', 'exclusive')])
+    ans.metric('calibre_db_lock_queued', 'gauge', 'Number of threads currently waiting for a database lock', [
+        ({'library': library_id, 'mode': mode}, s['queued'][mode]) for library_id, s in locks for mode in ('shared', 'exclusive')])
+    profiles = tuple((library_id, p) for library_id, p in ((library_id, db.lock_profile_stats()) for library_id, db in loaded_libraries(ctx)) if p)
+    if profiles:
+        from calibre.db.locking import LockProfile
+        bounds = LockProfile.BUCKETS + ('+Inf',)
+
+        def hist(x, which):
+            return tuple(zip(bounds, accumulate(x[which + '_histogram']))), x[which + '_time'], x['calls']
+
+        for which in ('wait', 'hold'):
+            ans.histogram(f'calibre_db_api_lock_{which}_seconds', f'Time database API calls spent {which}ing the database lock,'
+                          ' available when lock profiling is enabled', [
+                ({'library': library_id, 'api': name}, hist(x, which)) for library_id, p in profiles for name, x in sorted(iteritems(p))])
+    return bytes(ans)
+
+
+@endpoint('/metrics')
+def metrics(ctx, rd):
+    '''
+    Server metrics in the Prometheus text exposition format: request counts
+    and latency by route, worker and job queues, cache hit counts and
+    database lock contention
+    '''
+    ctx.check_for_write_access(rd)
+    rd.outheaders.set('Content-Type', PROMETHEUS_MIME, replace_all=True)
+    return prometheus_metrics(ctx)
@@ -6,8 +6,11 @@
 __docformat__ = 'restructuredtext en'
 
 import hashlib
+import weakref
 from collections import OrderedDict, namedtuple
+from copy import deepcopy
 from functools import partial
+from threading import Lock
 
 from html5_parser import parse
 from lxml import etree
@@ -16,6 +19,7 @@
 from calibre import force_unicode, guess_type
 from calibre import prepare_string_for_xml as xml
 from calibre.constants import __appname__
+from calibre.db.listeners import EventType
 from calibre.db.view import sanitize_sort_field_name
 from calibre.ebooks.metadata import authors_to_string, fmt_sidx, rating_to_stars
 from calibre.library.comments import comments_to_html
@@ -242,6 +246,94 @@ def ACQUISITION_ENTRY(book_id, updated, request_context):
 # }}}
 
 
+# Cache of serialized acquisition entries {{{
+
+def serialize_entry(entry):
+    # Serialize the entry as a child of a feed element, so that it has
+    # exactly the indentation and namespace declarations it would have if it
+    # was serialized as part of a complete feed
+    raw = etree.tostring(FEED(entry), encoding='utf-8', pretty_print=True)
+    return raw[raw.index(b'>') + 2:raw.rindex(b'</feed>')]
+
+
+class EntryCache:
+
+    '''
+    The serialized acquisition entries for the books in a single library.
+    Entries are keyed by the last modified time of the book and are removed
+    when the book is changed, via the database change listeners. The whole
+    cache is cleared if the set of displayed fields changes.
+    '''
+
+    MAX_SIZE = 5000
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.config = None
+        self.hits = self.misses = 0
+
+    def __call__(self, event_type, library_id, event_data):
+        # Called by the database when books are changed
+        if event_type in (EventType.metadata_changed, EventType.items_renamed, EventType.items_removed):
+            book_ids = event_data[1]
+        elif event_type in (EventType.format_added, EventType.book_edited):
+            book_ids = (event_data[0],)
+        elif event_type in (EventType.formats_removed, EventType.books_removed):
+            book_ids = event_data[0]
+        else:
+            return
+        with self.lock:
+            for book_id in book_ids:
+                self.entries.pop(book_id, None)
+
+    def check_config(self, config):
+        with self.lock:
+            if config != self.config:
+                self.entries.clear()
+                self.config = deepcopy(config)
+
+    def entries_for(self, book_ids, request_context):
+        db = request_context.db
+        ans = []
+        for book_id in book_ids:
+            lm = db.field_for('last_modified', book_id)
+            with self.lock:
+                x = self.entries.get(book_id)
+                if x is not None and x[0] == lm:
+                    self.entries.move_to_end(book_id)
+                    self.hits += 1
+                    ans.append(x[1])
+                    continue
+                self.misses += 1
+            raw = serialize_entry(ACQUISITION_ENTRY(book_id, None, request_context))
+            with self.lock:
+                self.entries[book_id] = lm, raw
+                if len(self.entries) > self.MAX_SIZE:
+                    self.entries.popitem(last=False)
+            ans.append(raw)
+        return ans
+
+
+entry_caches = weakref.WeakKeyDictionary()
+entry_caches_lock = Lock()
+
+
+def entry_cache_for(request_context):
+    db = request_context.db
+    with entry_caches_lock:
+        ans = entry_caches.get(db)
+        if ans is None:
+            ans = entry_caches[db] = EntryCache()
+            db.add_listener(ans)
+    fm = db.field_metadata
+    keys = tuple(filter(request_context.ctx.is_field_displayable, fm.ignorable_field_keys()))
+    ans.check_config((request_context.library_id, tuple((k, fm[k]['name'], fm[k]['is_multiple'], fm[k]['display']) for k in keys)))
+    return ans
+
+# }}}
+
+
 default_feed_title = __appname__ + ' ' + _('Library')
 
 
@@ -329,8 +421,13 @@ class AcquisitionFeed(NavFeed):
 
     def __init__(self, id_, updated, request_context, items, offsets, page_url, up_url, title=None):
         NavFeed.__init__(self, id_, updated, request_context, offsets, page_url, up_url, title=title)
-        for book_id in items:
-            self.root.append(ACQUISITION_ENTRY(book_id, updated, request_context))
+        self.entries = entry_cache_for(request_context).entries_for(items, request_context)
+
+    def serialize(self):
+        ' The serialized feed, with the pre-serialized entries spliced in '
+        raw = etree.tostring(self.root, encoding='utf-8', xml_declaration=True, pretty_print=True)
+        idx = raw.rindex(b'</feed>')
+        return raw[:idx] + b''.join(self.entries) + raw[idx:]
 
 
 class CategoryFeed(NavFeed):
@@ -400,7 +497,7 @@ def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
         items = items[offsets.offset:offsets.offset+max_items]
         lm = rc.last_modified()
         rc.outheaders['Last-Modified'] = http_date(timestampfromdt(lm))
-        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).root
+        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).serialize()
 
 
 def get_all_books(rc, which, page_url, up_url, offset=0):
@@ -638,3 +735,47 @@ def opds_search(ctx, rd, query):
         raise HTTPNotFound(f'Search: {query!r} not understood')
     page_url = rc.url_for('/opds/search', query=query)
     return get_acquisition_feed(rc, ids, offset, page_url, rc.url_for('/opds'), 'calibre-search:'+query)
+
+
+def benchmark(library_path, num_entries=500, repeat=5):
+    '''
+    Measure the time taken to generate an acquisition feed of num_entries
+    books, with the entry cache cold and warm.
+    Run with: calibre-debug -c "from calibre.srv.opds import benchmark; benchmark('/path/to/library')"
+    '''
+    import time
+
+    from calibre.srv.library_broker import init_library
+
+    class Ctx:
+
+        def url_for(self, path, **kwargs):
+            return path + '?' + urlencode(kwargs)
+
+        def is_field_displayable(self, field):
+            return True
+
+    class RC(RequestContext):
+
+        def __init__(self, db):
+            self.db, self.library_id, self.ctx = db, 'benchmark', Ctx()
+
+    db = init_library(library_path, False)
+    rc = RC(db)
+    items = sorted(db.all_book_ids())[:num_entries]
+    offsets = Offsets(0, len(items), len(items))
+
+    def feed():
+        with db.safe_read_lock:
+            return AcquisitionFeed('x', db.last_modified(), rc, items, offsets, '/opds', '/opds').serialize()
+
+    for label, clear in (('Uncached', True), ('Cached', False)):
+        times = []
+        for i in range(repeat):
+            if clear:
+                entry_cache_for(rc).entries.clear()
+            st = time.monotonic()
+            feed()
+            times.append(time.monotonic() - st)
+        print(f'{label}: {1000 * min(times):.1f} ms per feed of {len(items)} entries')
+    db.close()
@@ -70,6 +70,14 @@ def __new__(cls, *args):
     'worker_count', 10,
     None,
 
+    _('Network event loop implementation'),
+    'event_loop', Choices('select', 'selectors'),
+    _('The mechanism used to wait for activity on network connections. "select" is'
+      ' the classic implementation, limited to about a thousand simultaneous connections.'
+      ' "selectors" uses the most efficient mechanism provided by the operating system'
+      ' (epoll on Linux, kqueue on BSD/macOS) and scales to many thousands of'
+      ' idle keep-alive connections.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -82,6 +90,19 @@ def __new__(cls, *args):
     _('Maximum amount of time worker processes are allowed to run (in minutes). Set'
       ' to zero for no limit.'),
 
+    _('Number of books to prepare for reading in advance'),
+    'prerender_books', 0,
+    _('Books have to be prepared before they can be read in the browser, which can take'
+      ' a while for large books. When this is set, the server prepares up to this many of'
+      ' each of the most recently read, most downloaded and most recently added books in'
+      ' the background, using low priority worker processes. Set to zero to disable.'),
+
+    _('Max. size of the cache of books prepared for reading (in MB)'),
+    'max_book_render_cache_size', 2048,
+    _('Books prepared for reading in the browser are cached on disk. When this cache'
+      ' becomes larger than this size, the least recently read books are removed from it.'
+      ' Set to zero for no limit.'),
+
     _('The port on which to listen for connections'),
     'port', 8080,
     None,
@@ -127,17 +148,56 @@ def __new__(cls, *args):
     ' increasing performance. However, it can cause corrupted file transfers on some'
     ' broken filesystems. If you experience corrupted file transfers, turn it off.'),
 
+    _('Max. number of libraries to keep loaded'),
+    'max_loaded_libraries', 0,
+    _('Every library the server uses is kept loaded in memory. When serving a large number of'
+    ' libraries, set this to limit how many are loaded at a time. The least recently used'
+    ' libraries are closed to make room and re-loaded automatically when next needed.'
+    ' Set to zero for no limit.'),
+
+    _('Close libraries that are not used for (in minutes)'),
+    'library_idle_timeout', 0,
+    _('Libraries that have not been used for this many minutes are closed to free memory.'
+    ' They are re-loaded automatically when next needed. Set to zero to never close'
+    ' idle libraries.'),
+
+    _('Number of books to change at a time'),
+    'db_write_chunk_size', 0,
+    _('Changes that affect many books, such as removing books or setting a field for many'
+    ' books, normally block all other access to the library until they are complete.'
+    ' If this is set, such changes are made this many books at a time and other'
+    ' requests can use the library in between. Set to zero to make every change in one go.'),
+
+    _('Use snapshots of libraries for reading'),
+    'use_library_snapshots', False,
+    _('Requests that only read from a library, such as searching, sorting and getting the'
+    ' metadata of books, use a snapshot of the library, so that they do not hold up changes'
+    ' to the library while they work. The first such request after a change still waits for'
+    ' the change to complete, to take a new snapshot, which copies only the changed data when'
+    ' possible. Snapshots can use as much memory as the library itself, so this is off by default.'),
+
     _('Max. log file size (in MB)'),
     'max_log_size', 20,
     _('The maximum size of log files, generated by the server. When the log becomes larger'
     ' than this size, it is automatically rotated. Set to zero to disable log rotation.'),
 
+    _('Max. size of the cache of book files (in MB)'),
+    'max_file_cache_size', 1024,
+    _('Before sending them, the server copies book files and covers out of the library'
+    ' into a temporary cache. When this cache becomes larger than this size, the least'
+    ' recently used files are removed from it. Set to zero for no limit.'),
+
     _('Log HTTP 404 (Not Found) requests'),
     'log_not_found', True,
     _('Normally, the server logs all HTTP requests for resources that are not found.'
     ' This can generate a lot of log spam, if your server is targeted by bots.'
     ' Use this option to turn it off.'),
 
+    _('Log requests slower than (in seconds)'),
+    'slow_request_threshold', 0.0,
+    _('Log requests that take longer than this many seconds to handle, along with'
+    ' what the server was doing while handling them. Set to zero to not log slow requests.'),
+
     _('Password based authentication to access the server'),
     'auth', False,
     _('Normally, the server is unrestricted, allowing anyone to access it. You can'
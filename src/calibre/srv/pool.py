@@ -83,6 +83,11 @@ def busy(self):
     def idle(self):
         return sum(int(not w.working) for w in self.workers)
 
+    @property
+    def queue_depth(self):
+        ' The number of requests waiting for a free worker '
+        return self.request_queue.qsize()
+
 
 class PluginPool:
 
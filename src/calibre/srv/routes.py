@@ -14,7 +14,7 @@
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPNotFound, HTTPSimpleResponse, RouteError
-from calibre.srv.utils import http_date
+from calibre.srv.utils import JSONStream, PrecompressedOutput, http_date
 from calibre.utils.serialize import MSGPACK_MIME, json_dumps, msgpack_dumps
 from polyglot import http_client
 from polyglot.builtins import iteritems, itervalues
@@ -25,8 +25,10 @@
 
 def json(ctx, rd, endpoint, output):
     rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
-    if isinstance(output, bytes) or hasattr(output, 'fileno'):
+    if isinstance(output, (bytes, PrecompressedOutput)) or hasattr(output, 'fileno'):
         ans = output  # Assume output is already UTF-8 encoded json
+    elif isinstance(output, JSONStream):
+        ans = output.in_worker_threads()  # Sent using chunked transfer encoding
     else:
         ans = json_dumps(output)
     return ans
@@ -118,7 +120,7 @@ def __init__(self, endpoint_):
         del endpoint_
         if not self.endpoint.route.startswith('/'):
             raise RouteError(f'A route must start with /, {self.endpoint.route} does not')
-        parts = list(filter(None, self.endpoint.route.split('/')))
+        parts = self.parts = list(filter(None, self.endpoint.route.split('/')))
         matchers = self.matchers = []
         self.defaults = {}
         found_optional_part = False
@@ -222,6 +224,65 @@ def __str__(self):
     __unicode__ = __repr__ = __str__
 
 
+class RouteNode:
+
+    '''
+    A node in the trie of path components used to find routes. Static
+    components are looked up in a dict, all variable components share a single
+    child node.
+    '''
+
+    __slots__ = ('routes', 'soak_routes', 'static', 'variable')
+
+    def __init__(self):
+        self.static = {}
+        self.variable = None
+        # Routes that match paths ending at this node
+        self.routes = []
+        # Routes whose soak up component ends at this node and so match paths
+        # with any number of extra components
+        self.soak_routes = []
+
+    def add(self, route):
+        node = self
+        if route.min_size == 0:
+            node.routes.append(route)
+        for i, (name, matcher) in enumerate(route.matchers):
+            if name is None:
+                child = node.static.get(route.parts[i])
+                if child is None:
+                    child = node.static[route.parts[i]] = RouteNode()
+            else:
+                child = node.variable
+                if child is None:
+                    child = node.variable = RouteNode()
+            node = child
+            if i + 1 >= route.min_size:
+                node.routes.append(route)
+        if route.soak_up_extra:
+            node.soak_routes.append(route)
+
+    def sort(self):
+        self.routes.sort(key=attrgetter('max_size'), reverse=True)
+        self.soak_routes.sort(key=attrgetter('min_size'), reverse=True)
+        for child in self.static.values():
+            child.sort()
+        if self.variable is not None:
+            self.variable.sort()
+
+    def candidates(self, path, pos=0):
+        ' Yield the routes that can match path, static components first, then variable components and finally soak up components '
+        if pos == len(path):
+            yield from self.routes
+            return
+        child = self.static.get(path[pos])
+        if child is not None:
+            yield from child.candidates(path, pos + 1)
+        if self.variable is not None:
+            yield from self.variable.candidates(path, pos + 1)
+        yield from self.soak_routes
+
+
 class Router:
 
     def __init__(self, endpoints=None, ctx=None, url_prefix=None, auth_controller=None):
@@ -259,29 +320,18 @@ def __iter__(self):
         return itervalues(self.routes)
 
     def finalize(self):
-        try:
-            lsz = max(len(r.matchers) for r in self)
-        except ValueError:
-            lsz = 0
-        self.min_size_map = {sz:frozenset(r for r in self if r.min_size <= sz) for sz in range(lsz + 1)}
-        self.max_size_map = {sz:frozenset(r for r in self if r.max_size >= sz) for sz in range(lsz + 1)}
-        self.soak_routes = sorted(frozenset(r for r in self if r.soak_up_extra), key=attrgetter('min_size'), reverse=True)
+        self.route_trie = RouteNode()
+        for route in self:
+            self.route_trie.add(route)
+        self.route_trie.sort()
 
     def find_route(self, path):
         if self.strip_path is not None and path[:len(self.strip_path)] == self.strip_path:
             path = path[len(self.strip_path):]
-        size = len(path)
-        # routes for which min_size <= size <= max_size
-        routes = self.max_size_map.get(size, set()) & self.min_size_map.get(size, set())
-        for route in sorted(routes, key=attrgetter('max_size'), reverse=True):
+        for route in self.route_trie.candidates(path):
             args = route.matches(path)
             if args is not False:
                 return route.endpoint, args
-        for route in self.soak_routes:
-            if route.min_size <= size:
-                args = route.matches(path)
-                if args is not False:
-                    return route.endpoint, args
         raise HTTPNotFound()
 
     def read_cookies(self, data):
@@ -301,6 +351,22 @@ def read_cookies(self, data):
 
     def dispatch(self, data):
         endpoint_, args = self.find_route(data.path)
+        metrics = getattr(self.ctx, 'metrics', None)
+        if metrics is None:
+            return self.dispatch_to_endpoint(endpoint_, args, data)
+        req = metrics.request_started(endpoint_.route, data)
+        status_code = http_client.INTERNAL_SERVER_ERROR
+        try:
+            ans = self.dispatch_to_endpoint(endpoint_, args, data)
+            status_code = data.status_code
+            return ans
+        except HTTPSimpleResponse as e:
+            status_code = e.http_code
+            raise
+        finally:
+            metrics.request_finished(req, status_code)
+
+    def dispatch_to_endpoint(self, endpoint_, args, data):
         if data.method not in endpoint_.methods:
             raise HTTPSimpleResponse(http_client.METHOD_NOT_ALLOWED)
 
@@ -315,7 +381,11 @@ def dispatch(self, data):
         self.init_session(endpoint_, data)
         if endpoint_.needs_db_write:
             self.ctx.check_for_write_access(data)
-        ans = endpoint_(self.ctx, data, *args)
+        write_coordinator = getattr(self.ctx, 'write_coordinator', None)
+        if write_coordinator is None:
+            ans = endpoint_(self.ctx, data, *args)
+        else:
+            ans = write_coordinator.call(endpoint_, self.ctx, data, args)
         self.finalize_session(endpoint_, data, ans)
         outheaders = data.outheaders
 
@@ -349,3 +419,40 @@ def url_for(self, route, **kwargs):
             return self.url_prefix or '/'
         route = getattr(route, 'route_key', route)
         return self.url_prefix + self.routes[route].url_for(**kwargs)
+
+
+def benchmark(num_lookups=100000, extra_routes=(0, 100, 1000)):
+    '''
+    Measure the throughput of route finding for paths that match every
+    endpoint of the server, with extra routes added to simulate routes
+    added by plugins.
+    Run with: calibre-debug -c "from calibre.srv.routes import benchmark; benchmark()"
+    '''
+    from importlib import import_module
+
+    from calibre.srv.handler import SRV_MODULES
+    endpoints = []
+    for module in SRV_MODULES:
+        module = import_module('calibre.srv.' + module)
+        endpoints.extend(x for x in itervalues(vars(module)) if getattr(x, 'is_endpoint', False) is True)
+
+    def sample_path(route):
+        # '1' is valid for both string and integer path components
+        return [part if name is None else '1' for part, (name, matcher) in zip(route.parts, route.matchers)]
+
+    def extra_endpoint(i):
+        def plugin_endpoint(ctx, rd, a, b):
+            pass
+        return endpoint(f'/plugin-{i}/{{a}}/{{b=None}}')(plugin_endpoint)
+
+    for num_extra in extra_routes:
+        router = Router(endpoints + [extra_endpoint(i) for i in range(num_extra)])
+        paths = [sample_path(router.routes[ep.route_key]) for ep in endpoints]
+        st = time.monotonic()
+        for i in range(num_lookups):
+            try:
+                router.find_route(paths[i % len(paths)])
+            except HTTPNotFound:
+                pass
+        elapsed = time.monotonic() - st
+        print(f'{len(router.routes)} routes: {num_lookups / elapsed:.0f} lookups/second')
@@ -10,6 +10,7 @@
 from calibre import as_unicode
 from calibre.constants import is_running_from_develop, ismacos, iswindows
 from calibre.db.legacy import LibraryDatabase
+from calibre.srv.auth import create_nonce_secret
 from calibre.srv.bonjour import BonJour
 from calibre.srv.handler import Handler
 from calibre.srv.http_response import create_http_handler
@@ -19,6 +20,7 @@
 from calibre.srv.opts import opts_to_parser
 from calibre.srv.users import connect
 from calibre.srv.utils import HandleInterrupt, RotatingLog
+from calibre.srv.worker_processes import WriteCoordinator, has_reuse_port, supervise_worker_processes
 from calibre.utils.config import prefs
 from calibre.utils.localization import _, localize_user_manual_link
 from calibre.utils.lock import singleinstance
@@ -56,14 +58,15 @@ def daemonize():  # {{{
 
 class Server:
 
-    def __init__(self, libraries, opts):
+    def __init__(self, libraries, opts, write_coordinator=None, nonce_secret=None):
         log = access_log = None
         log_size = opts.max_log_size * 1024 * 1024
         if opts.log:
             log = RotatingLog(opts.log, max_size=log_size)
         if opts.access_log:
             access_log = RotatingLog(opts.access_log, max_size=log_size)
-        self.handler = Handler(libraries, opts)
+        self.handler = Handler(libraries, opts, nonce_secret=nonce_secret)
+        self.handler.router.ctx.write_coordinator = write_coordinator
         if opts.custom_list_template:
             with open(os.path.expanduser(opts.custom_list_template), 'rb') as f:
                 self.handler.router.ctx.custom_list_template = json.load(f)
@@ -81,6 +84,7 @@ def __init__(self, libraries, opts):
             plugins=plugins)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
+        self.handler.set_thread_pool(self.loop.pool)
         self.serve_forever = self.loop.serve_forever
         self.stop = self.loop.stop
         if is_running_from_develop:
@@ -137,6 +141,19 @@ def create_option_parser():
             help=_('Run process in background as a daemon (Linux only).'))
     parser.add_option(
         '--pidfile', default=None, help=_('Write process PID to the specified file'))
+    if has_reuse_port:
+        parser.add_option(
+            '--worker-processes',
+            default=1,
+            type='int',
+            help=_(
+                'Number of server processes to run. The processes share the listening port,'
+                ' with the operating system distributing connections between them, so that'
+                ' reading book lists and feeds can use multiple CPU cores. Changes to'
+                ' libraries are serialized across all the processes, and after a change'
+                ' the other processes reload the library before serving further requests.'
+                ' Converting books is not available with more than one process.'
+                ' Not available on Windows.'))
     parser.add_option(
         '--auto-reload',
         default=False,
@@ -220,19 +237,36 @@ def main(args=sys.argv):
         raise SystemExit('The --log option must point to a file, not a directory')
     if opts.access_log and os.path.isdir(opts.access_log):
         raise SystemExit('The --access-log option must point to a file, not a directory')
+    num_processes = getattr(opts, 'worker_processes', 1)
+    if num_processes < 1:
+        raise SystemExit('The --worker-processes option must be at least one')
+    if num_processes > 1:
+        return run_worker_processes(libraries, opts, num_processes)
     try:
         server = Server(libraries, opts)
     except BadIPSpec as e:
         raise SystemExit(f'{e}')
     if getattr(opts, 'daemonize', False):
-        if not opts.log and not iswindows:
-            raise SystemExit(
-                'In order to daemonize you must specify a log file, you can use /dev/stdout to log to screen even as a daemon'
-            )
+        check_can_daemonize(opts)
         daemonize()
     if opts.pidfile:
-        with open(opts.pidfile, 'wb') as f:
-            f.write(str(os.getpid()).encode('ascii'))
+        write_pidfile(opts.pidfile)
+    run_server(server, opts)
+
+
+def check_can_daemonize(opts):
+    if not opts.log and not iswindows:
+        raise SystemExit(
+            'In order to daemonize you must specify a log file, you can use /dev/stdout to log to screen even as a daemon'
+        )
+
+
+def write_pidfile(path):
+    with open(path, 'wb') as f:
+        f.write(str(os.getpid()).encode('ascii'))
+
+
+def run_server(server, opts):
     signal.signal(signal.SIGTERM, lambda s, f: server.stop())
     if not getattr(opts, 'daemonize', False) and not iswindows:
         signal.signal(signal.SIGHUP, lambda s, f: server.stop())
@@ -241,3 +275,41 @@ def main(args=sys.argv):
     ensure_app(), load_builtin_fonts()
     with HandleInterrupt(server.stop):
         server.serve_forever()
+
+
+def run_worker_processes(libraries, opts, num_processes):
+    # The processes must be forked before any database connections, threads
+    # or Qt objects are created, so daemonize first and create the servers in
+    # each process after forking. The original process only supervises the
+    # server processes, restarting any that die.
+    if opts.auto_reload_port:
+        raise SystemExit('Cannot use --worker-processes with --auto-reload')
+    if getattr(opts, 'daemonize', False):
+        check_can_daemonize(opts)
+        daemonize()
+    if opts.pidfile:
+        write_pidfile(opts.pidfile)
+    opts.reuse_port = True
+    write_coordinator = WriteCoordinator()
+    # State that must be the same in all the server processes is created
+    # before forking
+    from calibre.srv.books import clean_render_staging
+    nonce_secret = create_nonce_secret()
+    clean_render_staging()
+
+    def run_worker(index):
+        if index:
+            # Only one process should advertise the server
+            opts.use_bonjour = False
+        try:
+            server = Server(libraries, opts, write_coordinator=write_coordinator, nonce_secret=nonce_secret)
+        except BadIPSpec as e:
+            raise SystemExit(f'{e}')
+        if index:
+            server.loop.LISTENING_MSG = f'calibre server process {index} listening on'
+        run_server(server, opts)
+
+    try:
+        supervise_worker_processes(num_processes, run_worker, write_coordinator)
+    finally:
+        write_coordinator.close()
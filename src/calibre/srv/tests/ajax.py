@@ -14,7 +14,7 @@
 from calibre.srv.tests.base import LibraryBaseTest
 from calibre.utils.localization import _
 from polyglot.binary import as_base64_bytes
-from polyglot.http_client import FORBIDDEN, NOT_FOUND, OK
+from polyglot.http_client import FORBIDDEN, NOT_FOUND, NOT_MODIFIED, OK
 from polyglot.urllib import quote, urlencode
 
 
@@ -85,6 +85,67 @@ def test_ajax_categories(self):  # {{{
             self.ae(set(data['book_ids']), {2})
     # }}}
 
+    def test_interface_data_cache(self):  # {{{
+        'Test caching of /interface-data/init and /interface-data/books-init'
+        with self.create_server() as server:
+            ctx = server.handler.router.ctx
+            db = ctx.library_broker.get(None)
+            conn = server.connect()
+            request = partial(make_request, conn, prefix='/interface-data')
+
+            for endpoint in ('/books-init', '/init'):
+                r, data = request(endpoint)
+                self.ae(r.status, OK)
+                self.ae(set(data['search_result']['book_ids']), set(db.all_book_ids()))
+                etag = r.getheader('ETag')
+                r, xdata = request(endpoint)
+                self.ae(xdata, data), self.ae(r.getheader('ETag'), etag)
+                r, zdata = request(endpoint, headers={'Accept-Encoding':'gzip'})
+                self.ae(r.getheader('Content-Encoding'), 'gzip')
+                self.ae(json.loads(zlib.decompress(zdata, 16+zlib.MAX_WBITS)), data)
+                r, xdata = request(endpoint, headers={'If-None-Match':etag})
+                self.ae(r.status, NOT_MODIFIED)
+                r, xdata = request(endpoint + '?sort=title.asc')
+                self.assertNotEqual(r.getheader('ETag'), etag)
+            stats = ctx.interface_data_cache_stats()
+            self.ae((stats['misses'], stats['hits'], stats['not_modified']), (4, 4, 2))
+            self.ae(stats['libraries'][db.server_library_id]['entries'], 4)
+
+            # Changes to the library must not be hidden by the cache
+            r, data = request('/books-init')
+            etag = r.getheader('ETag')
+            db.set_field('title', {1: 'Changed title'})
+            r, data = request('/books-init', headers={'If-None-Match':etag})
+            self.ae(r.status, OK)
+            self.assertNotEqual(r.getheader('ETag'), etag)
+            self.ae(data['metadata']['1']['title'], 'Changed title')
+    # }}}
+
+    def test_metrics(self):  # {{{
+        'Test /metrics'
+        with self.create_server() as server:
+            conn = server.connect()
+            r, data = make_request(conn, '/metrics', prefix='')
+            self.ae(r.status, FORBIDDEN)
+        with self.create_server(local_write=True) as server:
+            conn = server.connect()
+            for i in range(3):
+                make_request(conn, '/ajax/book/1')
+            make_request(conn, '/ajax/book/1000')
+            r, data = make_request(conn, '/metrics', prefix='')
+            self.ae(r.status, OK)
+            self.assertTrue(r.getheader('Content-Type').startswith('text/plain'))
+            lines = data.decode('utf-8').splitlines()
+            self.assertIn('calibre_http_responses_total{route="/ajax/book/{book_id}/{library_id=None}",code="200"} 3', lines)
+            self.assertIn('calibre_http_responses_total{route="/ajax/book/{book_id}/{library_id=None}",code="404"} 1', lines)
+            self.assertIn('calibre_http_request_duration_seconds_count{route="/ajax/book/{book_id}/{library_id=None}"} 4', lines)
+            self.assertIn('calibre_http_request_duration_seconds_bucket{route="/ajax/book/{book_id}/{library_id=None}",le="+Inf"} 4', lines)
+            for name in ('calibre_worker_threads_busy', 'calibre_jobs_waiting', 'calibre_libraries_loaded'):
+                self.assertTrue(any(x.startswith(name + ' ') for x in lines), name)
+            self.assertTrue(any(x.startswith('calibre_db_lock_waits_total{') for x in lines))
+            self.assertTrue(any(x.startswith('calibre_cache_hits_total{cache="search"') for x in lines))
+    # }}}
+
     def test_srv_restrictions(self):  # {{{
         ' Test that virtual lib. + search restriction works on all end points'
         with self.create_server(auth=True, auth_mode='basic') as server:
@@ -136,6 +197,8 @@ def r(path, status=OK, method='GET'):
             data = ok(url_for('/book-get-last-read-position', library_id=db.server_library_id, which='1-TXT_3-TXT'))
             ae(set(data), {'1:TXT'})
             nf(url_for('/book-set-last-read-position', book_id=3, library_id=db.server_library_id, fmt='TXT'), method='POST')
+            data = ok(url_for('/book-render-cache-stats'))
+            ae(data['max_size'], server.handler.ctx.opts.max_book_render_cache_size * 1024 * 1024)
 
             # cdb.py
             r(url_for('/cdb/cmd', which='list'), status=FORBIDDEN)
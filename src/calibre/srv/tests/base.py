@@ -180,6 +180,7 @@ def __init__(self, library_path, libraries=(), plugins=(), **kwargs):
         )
         self.log = self.loop.log
         self.handler.set_log(self.log)
+        self.handler.set_thread_pool(self.loop.pool)
 
     def __exit__(self, *args):
         try:
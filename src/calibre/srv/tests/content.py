@@ -282,3 +282,32 @@ def test_last_read_cache(self):  # {{{
             lrc.add_last_read_position('lib', book_id, 'FMT', 'user', 'epubcfi(/)', 0.1, 'tt')
         self.ae(len(lrc.get_recently_read('user')), lrc.limit)
     # }}}
+
+    def test_file_cache(self):  # {{{
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.content import FileCache
+        fc = FileCache()
+        with TemporaryDirectory() as tdir:
+            names = [os.path.join(tdir, str(i)) for i in range(4)]
+            for name in names[:3]:
+                with fc.locked(name):
+                    with open(name, 'wb') as f:
+                        f.write(b'x' * 10)
+                    fc.used(name, 10, 25)
+            self.ae(fc.total_size, 20)
+            self.assertFalse(os.path.exists(names[0]))
+            self.ae(list(fc.files), names[1:3])
+            self.assertFalse(fc.file_locks)
+            # Recently used files are kept, files being copied are not removed
+            fc.used(names[1], 10, 25)
+            with fc.locked(names[2]):
+                with open(names[3], 'wb') as f:
+                    f.write(b'x' * 10)
+                fc.used(names[3], 10, 25)
+            self.ae(list(fc.files), names[2:])
+            self.assertTrue(os.path.exists(names[2]))
+            with fc.locked(names[2]):
+                fc.remove(names[2])
+            self.ae(fc.total_size, 10)
+            self.assertFalse(os.path.exists(names[2]))
+    # }}}
@@ -5,6 +5,7 @@
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import hashlib
+import json
 import os
 import string
 import time
@@ -14,7 +15,7 @@
 
 from calibre import guess_type
 from calibre.srv.tests.base import BaseTest, TestServer
-from calibre.srv.utils import eintr_retry_call
+from calibre.srv.utils import JSONStream, LazyJSONArray, PrecompressedOutput, eintr_retry_call
 from calibre.utils.monotonic import monotonic
 from calibre.utils.resources import get_path as P
 from polyglot import http_client
@@ -338,6 +339,37 @@ def handler(conn):
             self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
             self.ae(r.status, http_client.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
 
+            # Test streamed JSON, which is generated in worker threads as it
+            # is sent in chunks
+            server.change_handler(lambda conn: JSONStream({'x': LazyJSONArray(range(5000))}, chunk_size=1024).in_worker_threads())
+            for headers in ({'Accept-Encoding':'gzip'}, {}):
+                conn = server.connect()
+                conn.request('GET', '/an_etagged_path', headers=headers)
+                r = conn.getresponse()
+                self.ae(r.getheader('Transfer-Encoding'), 'chunked')
+                data = r.read()
+                if headers:
+                    data = zlib.decompress(data, 16+zlib.MAX_WBITS)
+                self.ae(json.loads(data), {'x': list(range(5000))})
+
+            def failing_items(num):
+                yield from range(num)
+                raise ValueError('failed')
+            # Errors before the first chunk result in an error response
+            server.change_handler(lambda conn: JSONStream({'x': LazyJSONArray(failing_items(10))}, chunk_size=1024).in_worker_threads())
+            conn = server.connect()
+            conn.request('GET', '/an_etagged_path')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.INTERNAL_SERVER_ERROR)
+            r.read()
+            # Later errors abort the response
+            server.change_handler(lambda conn: JSONStream({'x': LazyJSONArray(failing_items(5000))}, chunk_size=1024).in_worker_threads())
+            conn = server.connect()
+            conn.request('GET', '/an_etagged_path')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK)
+            self.assertRaises(http_client.IncompleteRead, r.read)
+
             # Test dynamic etagged content
             num_calls = [0]
 
@@ -358,6 +390,30 @@ def edfunc():
             self.ae(r.read(), b'')
             self.ae(num_calls[0], 1)
 
+            # Test precompressed content
+            pc = PrecompressedOutput(raw, 'pc')
+            server.change_handler(lambda conn: pc)
+            for headers in ({'Accept-Encoding':'gzip'}, {}):
+                conn = server.connect()
+                conn.request('GET', '/an_etagged_path', headers=headers)
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK)
+                self.assertIsNone(r.getheader('Transfer-Encoding'))
+                self.ae(r.getheader('ETag'), '"pc"')
+                data = r.read()
+                if headers:
+                    self.ae(r.getheader('Content-Encoding'), 'gzip')
+                    self.ae(r.getheader('Content-Length'), str(len(pc.compressed)))
+                    self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
+                    data = zlib.decompress(data, 16+zlib.MAX_WBITS)
+                else:
+                    self.ae(r.getheader('Content-Length'), str(len(raw)))
+                self.ae(data, raw)
+            conn.request('GET', '/an_etagged_path', headers={'If-None-Match':'"pc"'})
+            r = conn.getresponse()
+            self.ae(r.status, http_client.NOT_MODIFIED)
+            self.ae(r.read(), b'')
+
             # Test getting a filesystem file
             for use_sendfile in (True, False):
                 server.change_handler(lambda conn: f)
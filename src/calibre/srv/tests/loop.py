@@ -232,6 +232,26 @@ def test_socket_activation(self):
             self.ae(r.read(), b'testbody')
             self.ae(server.loop.bound_address[1], port)
 
+    def test_selectors_event_loop(self):
+        'Test the selectors based event loop'
+        with TestServer(lambda data:(data.path[0] + data.read().decode('utf-8')), event_loop='selectors', timeout=0.2) as server:
+            self.assertIsNotNone(server.loop.poller)
+            conns = [server.connect() for i in range(5)]
+            for i in range(3):
+                for c, conn in enumerate(conns):
+                    conn.request('GET', f'/test{c}', f'body{i}')
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), f'test{c}body{i}'.encode())
+            self.ae(server.loop.num_active_connections, len(conns))
+            st = monotonic()
+            while server.loop.num_active_connections and monotonic() - st < 5:
+                time.sleep(0.05)
+            self.ae(server.loop.num_active_connections, 0, 'Idle connections were not timed out')
+            self.assertFalse(server.loop.poller.registered)
+            for conn in conns:
+                conn.close()
+
     def test_monotonic(self):
         'Test the monotonic() clock'
         a = monotonic()
@@ -299,10 +319,61 @@ def job_status(jid):
         self.assertFalse(was_aborted)
         self.assertTrue(tb)
         self.assertIn('a testing error', tb)
+
+        # Low priority jobs run only when no other jobs are waiting
+        busy = jm.start_job('busy', 'calibre.srv.jobs', 'sleep_test', args=(0.5,))
+        low = jm.start_job('low', 'calibre.srv.jobs', 'sleep_test', args=(0.1,), priority='low')
+        normal = jm.start_job('normal', 'calibre.srv.jobs', 'sleep_test', args=(0.1,))
+        while job_status(busy) in s:
+            time.sleep(0.01)
+        while job_status(normal) in s:
+            self.assertEqual(job_status(low), 'waiting')
+            time.sleep(0.01)
+        while job_status(low) in s:
+            time.sleep(0.01)
+        self.assertEqual(jm.job_status(low)[1], 0.1)
         jm.start_job('simple test', 'calibre.srv.jobs', 'sleep_test', args=(1.0,))
         jm.shutdown(), jm.wait_for_shutdown(monotonic() + 1)
 
 
+def benchmark_idle_connections(counts=(100, 1000, 5000), num_requests=500):
+    ''' Compare the latency of requests and the CPU used by the server for the
+    select and selectors event loops with many idle keep-alive connections open.
+    Run with: calibre-debug -c "from calibre.srv.tests.loop import *; benchmark_idle_connections()" '''
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = 2 * max(counts) + 256
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+    for event_loop in ('select', 'selectors'):
+        for count in counts:
+            with TestServer(lambda data: b'ok', event_loop=event_loop, timeout=600, worker_count=4) as server:
+                try:
+                    idle = [socket.create_connection(server.address) for i in range(count)]
+                except OSError as e:
+                    print(f'{event_loop:9} {count:5} idle connections: failed to open connections: {e}')
+                    continue
+                try:
+                    while server.loop.num_active_connections < count:
+                        time.sleep(0.01)
+                    conn = server.connect()
+                    cpu, st = time.process_time(), monotonic()
+                    try:
+                        for i in range(num_requests):
+                            conn.request('GET', '/')
+                            conn.getresponse().read()
+                    except Exception as e:
+                        print(f'{event_loop:9} {count:5} idle connections: failed with error: {e}')
+                        continue
+                    elapsed, cpu = monotonic() - st, time.process_time() - cpu
+                    conn.close()
+                    print(f'{event_loop:9} {count:5} idle connections: {1000 * elapsed / num_requests:.3f} ms per request,'
+                          f' {1000 * cpu / num_requests:.3f} ms CPU per request')
+                finally:
+                    for s in idle:
+                        s.close()
+
+
 def find_tests():
     import unittest
     return unittest.defaultTestLoader.loadTestsFromTestCase(LoopTest)
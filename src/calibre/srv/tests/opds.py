@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import time
+from io import BytesIO
+
+from calibre.srv.tests.base import LibraryBaseTest
+from polyglot.urllib import urlencode
+
+
+class OPDSTest(LibraryBaseTest):
+
+    def test_opds_entry_cache(self):
+        'Test the cache of serialized OPDS acquisition entries'
+        from lxml import etree
+
+        from calibre.srv.library_broker import init_library
+        from calibre.srv.opds import ACQUISITION_ENTRY, AcquisitionFeed, NavFeed, RequestContext, entry_cache_for
+        from calibre.srv.utils import Offsets
+
+        class Ctx:
+
+            def url_for(self, path, **kwargs):
+                return path + '?' + urlencode(kwargs)
+
+            def is_field_displayable(self, field):
+                return True
+
+        class RC(RequestContext):
+
+            def __init__(self, db):
+                self.db, self.library_id, self.ctx = db, 'test', Ctx()
+
+        db = init_library(self.library_path, False)
+        try:
+            rc = RC(db)
+            items = sorted(db.all_book_ids())
+            offsets = Offsets(0, len(items), len(items))
+
+            def feeds():
+                with db.safe_read_lock:
+                    lm = db.last_modified()
+                    cached = AcquisitionFeed('x', lm, rc, items, offsets, '/opds', '/opds').serialize()
+                    feed = NavFeed('x', lm, rc, offsets, '/opds', '/opds')
+                    for book_id in items:
+                        feed.root.append(ACQUISITION_ENTRY(book_id, None, rc))
+                    uncached = etree.tostring(feed.root, encoding='utf-8', xml_declaration=True, pretty_print=True)
+                return cached, uncached
+
+            cache = entry_cache_for(rc)
+            cached, uncached = feeds()
+            self.ae(cached, uncached)
+            self.ae((cache.hits, cache.misses), (0, len(items)))
+            cached, uncached = feeds()
+            self.ae(cached, uncached)
+            self.ae((cache.hits, cache.misses), (len(items), len(items)))
+
+            def changed(book_ids, expected):
+                # The database notifies the cache of changes from another thread
+                end = time.monotonic() + 10
+                while time.monotonic() < end and any(book_id in cache.entries for book_id in book_ids):
+                    time.sleep(0.01)
+                self.assertFalse(any(book_id in cache.entries for book_id in book_ids))
+                misses = cache.misses
+                cached, uncached = feeds()
+                self.ae(cached, uncached)
+                self.ae(cache.misses - misses, len(book_ids))
+                self.assertIn(expected, cached)
+
+            db.set_field('title', {1: 'Changed Title'})
+            changed({1}, b'Changed Title')
+            news = {book_id for book_id in items if 'News' in db.field_for('tags', book_id)}
+            self.assertTrue(news)
+            db.rename_items('tags', {db.get_item_id('tags', 'News'): 'Renamed Tag'})
+            changed(news, b'Renamed Tag')
+            db.add_format(2, 'EPUB', BytesIO(b'book2epub'), run_hooks=False)
+            changed({2}, b'book_id=2&amp;library_id=test&amp;what=epub')
+        finally:
+            db.close()
+
+
+def find_tests():
+    import unittest
+    return unittest.defaultTestLoader.loadTestsFromTestCase(OPDSTest)
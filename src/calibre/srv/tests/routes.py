@@ -6,6 +6,7 @@
 
 import os
 from tempfile import TemporaryDirectory
+from types import SimpleNamespace
 
 from calibre.srv.tests.base import BaseTest
 from polyglot.builtins import itervalues
@@ -39,6 +40,103 @@ def __init__(self, base):
             self.assertTrue(db_matches(db, db.server_library_id, None))
             self.assertTrue(db_matches(db, db.server_library_id.upper(), tdir))
 
+    def test_library_eviction(self):
+        from calibre.srv.library_broker import LibraryBroker
+        closed = []
+
+        class MockDB:
+
+            def __init__(self, path):
+                self.new_api = self
+                self.path, self.closed = path, False
+                self.current_snapshot = None
+
+            def snapshot(self):
+                # Like real snapshots, refers to itself
+                self.current_snapshot = s = SimpleNamespace(snapshot_of=self)
+                s.self = s
+                return s
+
+            def close(self):
+                self.closed = True
+                closed.append(os.path.basename(self.path))
+
+        class Broker(LibraryBroker):
+
+            def init_library(self, library_path, is_default_library):
+                return MockDB(library_path)
+
+        with TemporaryDirectory() as tdir:
+            paths = []
+            for x in 'abcd':
+                paths.append(os.path.join(tdir, x))
+                os.mkdir(paths[-1])
+                open(os.path.join(paths[-1], 'metadata.db'), 'wb').close()
+            b = Broker(paths, max_loaded=2)
+            a = b.get('a')
+            b.search_caches['a']['x'] = 1
+            self.assertIs(b.get('b'), b.get('b'))
+            # recently used libraries are not evicted
+            b.get('c')
+            self.ae(set(b.loaded_dbs), set('abc'))
+            b.last_used['a'] -= 2 * b.MIN_IDLE_FOR_EVICTION
+            b.last_used['b'] -= b.MIN_IDLE_FOR_EVICTION + 1
+            d = b.get('d')
+            self.ae(set(b.loaded_dbs), set('cd'))
+            # unloaded libraries are closed only once they are no longer in use
+            self.ae(closed, ['b'])
+            self.assertNotIn('a', b.search_caches)
+            self.assertIsNot(b.get('a'), a)
+            self.ae(b.stats()['unloaded_in_use'], 1)
+            del a
+            b.get('d')
+            self.ae(closed, ['b', 'a'])
+            self.assertFalse(d.closed)
+            s = b.stats()
+            self.ae(s['loads'], 5)
+            self.ae(s['capacity_evictions'], 2)
+            self.ae(s['unloaded_in_use'], 0)
+            self.ae(set(s['loaded']), set('acd'))
+
+            del closed[:]
+            b = Broker(paths, idle_timeout=30)
+            a, c = b.get('a'), b.get('c')
+            b.last_used['a'] -= 31
+            b.last_eviction_check -= b.EVICTION_CHECK_INTERVAL + 1
+            b.get('c')
+            # recently used libraries are not evicted even if idle_timeout is shorter
+            self.ae(set(b.loaded_dbs), set('ac'))
+            b.last_used['a'] -= b.MIN_IDLE_FOR_EVICTION
+            b.last_eviction_check -= b.EVICTION_CHECK_INTERVAL + 1
+            b.get('c')
+            self.ae(set(b.loaded_dbs), {'c'})
+            self.assertFalse(a.closed)
+            del a
+            b.get('c')
+            self.ae(closed, ['a'])
+            self.assertFalse(c.closed)
+            self.ae(b.stats()['idle_evictions'], 1)
+
+            # snapshots keep the library they were taken from open, but
+            # the library's current snapshot does not
+            del closed[:]
+            b = Broker(paths, max_loaded=1)
+            s = b.get('a').snapshot()
+            b.get('b').snapshot()
+            b.last_used['a'] -= b.MIN_IDLE_FOR_EVICTION + 1
+            b.last_used['b'] -= b.MIN_IDLE_FOR_EVICTION + 1
+            b.get('c')
+            self.ae(b.stats()['unloaded_in_use'], 2)
+            # unused snapshots are freed by the garbage collector
+            b.last_unloaded_collection -= b.EVICTION_CHECK_INTERVAL + 1
+            b.get('c')
+            self.ae(closed, ['b'])
+            self.ae(b.stats()['unloaded_in_use'], 1)
+            del s
+            b.last_unloaded_collection -= b.EVICTION_CHECK_INTERVAL + 1
+            b.get('c')
+            self.ae(closed, ['b', 'a'])
+
     def test_route_construction(self):
         ' Test route construction '
         from calibre.srv.routes import Route, RouteError, endpoint
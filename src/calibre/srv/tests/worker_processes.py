@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import select
+import signal
+import time
+from threading import Lock
+from types import SimpleNamespace
+from unittest import skipIf
+
+from calibre.constants import iswindows
+from calibre.ptempfile import TemporaryDirectory
+from calibre.srv.tests.base import BaseTest
+
+
+class Broker:
+
+    def __init__(self, dbpath):
+        self.lock = Lock()
+        self.reloads = []
+        backend = SimpleNamespace(dbpath=dbpath)
+        new_api = SimpleNamespace(backend=backend, reload_from_db=lambda: self.reloads.append(dbpath))
+        self.loaded_dbs = {'lib': SimpleNamespace(new_api=new_api)}
+        self.category_caches, self.search_caches, self.tag_browser_caches, self.interface_data_caches = {}, {}, {}, {}
+
+    def __enter__(self):
+        self.lock.acquire()
+
+    def __exit__(self, *a):
+        self.lock.release()
+
+
+def in_child_process(func, *args):
+    ' Run func in a forked process, returning its exit code '
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            func(*args)
+            code = 0
+        except SystemExit as e:
+            code = 2 if isinstance(e.code, str) else (e.code or 0)
+        finally:
+            os._exit(code)
+    return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+
+@skipIf(iswindows, 'Worker processes are not supported on Windows')
+class WorkerProcessesTest(BaseTest):
+
+    def test_write_coordination(self):
+        'Test that changes made by one process are seen by the others'
+        from calibre.srv.worker_processes import WriteCoordinator
+        with TemporaryDirectory() as tdir:
+            dbpath = os.path.join(tdir, 'metadata.db')
+            with open(dbpath, 'wb') as f:
+                f.write(b'x' * 100)
+            wc = WriteCoordinator()
+            try:
+                broker = Broker(dbpath)
+
+                def write(change):
+                    with wc.write(Broker(dbpath)):
+                        if change:
+                            with open(dbpath, 'ab') as f:
+                                f.write(b'changed')
+
+                # A write that does not change the library does not cause reloads
+                self.ae(in_child_process(write, False), 0)
+                self.ae(wc.generation, 0)
+                wc.sync(broker)
+                self.ae(broker.reloads, [])
+                # A write that changes the library is seen by other processes
+                broker.search_caches['x'] = 1
+                self.ae(in_child_process(write, True), 0)
+                self.ae(wc.generation, 1)
+                wc.sync(broker)
+                self.ae(broker.reloads, [dbpath])
+                self.ae(broker.search_caches, {})
+                wc.sync(broker)
+                self.ae(broker.reloads, [dbpath])
+                # But not by the process that made it
+                write(True)
+                self.ae(wc.generation, 2)
+                self.ae(wc.seen_generation, 2)
+                wc.sync(broker)
+                self.ae(broker.reloads, [dbpath])
+                # Invalidating reloads the libraries in all processes
+                wc.invalidate()
+                wc.sync(broker)
+                self.ae(broker.reloads, [dbpath, dbpath])
+            finally:
+                wc.close()
+
+    def test_supervisor(self):
+        'Test that dead server processes are restarted'
+        from calibre.srv.worker_processes import supervise_worker_processes
+        r, w = os.pipe()
+
+        def run_worker(index):
+            os.close(r)
+            os.write(w, f'{index} {os.getpid()}\n'.encode())
+            time.sleep(60)
+
+        def read_started(num):
+            ans, buf = {}, b''
+            end = time.monotonic() + 30
+            while len(ans) < num and time.monotonic() < end:
+                if select.select([r], [], [], 0.1)[0]:
+                    buf += os.read(r, 4096)
+                    *lines, buf = buf.split(b'\n')
+                    for line in lines:
+                        index, pid = map(int, line.split())
+                        ans[index] = pid
+            self.ae(len(ans), num)
+            return ans
+
+        supervisor = os.fork()
+        if supervisor == 0:
+            try:
+                supervise_worker_processes(2, run_worker, min_uptime=0)
+            finally:
+                os._exit(0)
+        try:
+            started = read_started(2)
+            self.ae(set(started), {0, 1})
+            os.kill(started[1], signal.SIGKILL)
+            restarted = read_started(1)
+            self.ae(set(restarted), {1})
+            self.assertNotEqual(restarted[1], started[1])
+            # Stopping the supervisor stops all the server processes
+            os.kill(supervisor, signal.SIGTERM)
+            self.ae(os.waitstatus_to_exitcode(os.waitpid(supervisor, 0)[1]), 0)
+            for pid in (started[0], restarted[1]):
+                self.assertRaises(ProcessLookupError, os.kill, pid, 0)
+        finally:
+            os.close(r), os.close(w)
+
+        # Processes that fail immediately are not restarted
+        def failing_worker(index):
+            if index:
+                raise SystemExit('failed')
+            time.sleep(60)
+        self.ae(in_child_process(supervise_worker_processes, 2, failing_worker), 2)
+
+    def test_claim_file(self):
+        'Test that a file can be claimed by only one process at a time'
+        from calibre.srv.worker_processes import claim_file, release_file_claim
+
+        def claim(path, code_if_claimed):
+            if claim_file(path) is not None:
+                raise SystemExit(code_if_claimed)
+
+        with TemporaryDirectory() as tdir:
+            path = os.path.join(tdir, 'claim')
+            f = claim_file(path)
+            self.assertIsNotNone(f)
+            self.ae(in_child_process(claim, path, 3), 0)
+            release_file_claim(f)
+            self.assertFalse(os.path.exists(path))
+            # Claims are released when the process that holds them dies
+            self.ae(in_child_process(claim, path, 3), 3)
+            self.assertTrue(os.path.exists(path))
+            f = claim_file(path)
+            self.assertIsNotNone(f)
+            release_file_claim(f)
+
+    def test_shared_nonce_secret(self):
+        'Test that nonces from one server process are valid in the others'
+        from calibre.srv.auth import AuthController, create_nonce_secret, synthesize_nonce, validate_nonce
+        secret = create_nonce_secret()
+        a, b = (AuthController(user_credentials={}, nonce_secret=secret) for i in range(2))
+        nonce = synthesize_nonce(a.key_order, a.realm, a.secret)
+        self.assertTrue(validate_nonce(b.key_order, nonce, b.realm, b.secret))
+        c = AuthController(user_credentials={})
+        self.assertFalse(validate_nonce(c.key_order, nonce, c.realm, c.secret))
+
+
+def find_tests():
+    import unittest
+    return unittest.defaultTestLoader.loadTestsFromTestCase(WorkerProcessesTest)
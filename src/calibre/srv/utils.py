@@ -8,6 +8,7 @@
 import os
 import socket
 from email.utils import formatdate
+from itertools import chain
 from operator import itemgetter
 
 from calibre import prints
@@ -418,21 +419,161 @@ def getvalue(self):
 # }}}
 
 
-def get_db(ctx, rd, library_id):
+# Streaming JSON {{{
+
+class LazyJSONArray:
+
+    ' A JSON array whose items are generated as it is serialized '
+
+    def __init__(self, items):
+        self.items = items
+
+
+class LazyJSONObject:
+
+    ' A JSON object whose (key, value) pairs are generated as it is serialized '
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+
+class JSONStream:
+
+    '''
+    A JSON document serialized incrementally, in chunks of about chunk_size
+    bytes, so that large responses can be sent without first building them in
+    memory. Instances of LazyJSONArray and LazyJSONObject in obj, which must be
+    nested only inside dicts or each other, are serialized as they are
+    iterated over. Everything else is serialized with json_dumps(). Iterating
+    over the stream generates the chunks in the calling thread, use
+    in_worker_threads() to generate them in the server's worker threads as
+    the response is sent.
+    '''
+
+    def __init__(self, obj, chunk_size=64 * 1024):
+        self.obj, self.chunk_size = obj, chunk_size
+
+    def __iter__(self):
+        buf = Accumulator()
+        for b in self.serialize(self.obj):
+            buf.append(b)
+            if buf.total_length >= self.chunk_size:
+                yield buf.getvalue()
+        yield buf.getvalue()
+
+    def in_worker_threads(self):
+        '''
+        Return the document as a WorkerGeneratedOutput, so that it is
+        generated in the server's worker threads, a chunk at a time as the
+        previous chunk is sent, rather than in its event loop thread, where it
+        would block other connections. The first chunk is generated
+        immediately, so that errors before it result in an error response.
+        Later errors abort the response, leaving the document truncated.
+        '''
+        chunks = iter(self)
+        first = next(chunks)
+        return WorkerGeneratedOutput(chain((first,), chunks))
+
+    def serialize(self, obj):
+        from calibre.utils.serialize import json_dumps
+        if isinstance(obj, LazyJSONArray):
+            yield from self.serialize_array(obj.items)
+        elif isinstance(obj, LazyJSONObject):
+            yield from self.serialize_object(obj.pairs)
+        elif isinstance(obj, dict):
+            yield from self.serialize_object(iteritems(obj))
+        else:
+            yield json_dumps(obj)
+
+    def serialize_array(self, items):
+        sep = b'['
+        for item in items:
+            yield sep
+            sep = b','
+            yield from self.serialize(item)
+        yield b'[]' if sep == b'[' else b']'
+
+    def serialize_object(self, pairs):
+        from calibre.utils.serialize import json_dumps
+        sep = b'{'
+        for key, val in pairs:
+            yield sep
+            sep = b','
+            # JSON only allows string keys, json.dumps() converts numbers
+            yield json_dumps(key if isinstance(key, str) else str(key))
+            yield b':'
+            yield from self.serialize(val)
+        yield b'{}' if sep == b'{' else b'}'
+
+
+class WorkerGeneratedOutput:
+
+    '''
+    A response body that is sent in chunks, as they are generated by iterating
+    over chunks. The chunks are generated one at a time, in the server's
+    worker threads, so that chunks that are slow to generate do not block its
+    event loop thread and only one chunk is held in memory at a time.
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+
+class PrecompressedOutput:
+
+    '''
+    A fully serialized response body, together with its gzip compressed form,
+    so that it can be sent repeatedly without being re-generated or
+    re-compressed. The compressed form is used when the client accepts gzip
+    encoding.
+    '''
+
+    def __init__(self, data, etag, compress_level=6):
+        import gzip
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.data = data
+        self.compressed = gzip.compress(data, compress_level, mtime=0)
+        self.etag = etag if etag.endswith('"') else f'"{etag}"'
+
+    @property
+    def size(self):
+        return len(self.data) + len(self.compressed)
+
+
+def batched(iterable, n):
+    ' Yield lists of up to n items from iterable '
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+# }}}
+
+
+def get_db(ctx, rd, library_id, snapshot=False):
+    ''' If snapshot is True, return a read only snapshot of the library, if
+    the server is configured to use them, for requests that only read from the
+    library, so that they do not hold up changes being made to it. '''
     db = ctx.get_library(rd, library_id)
     if db is None:
         raise HTTPNotFound(f'Library {library_id!r} not found')
+    if snapshot and ctx.opts.use_library_snapshots:
+        db = db.snapshot()
     return db
 
 
-def get_library_data(ctx, rd, strict_library_id=False):
+def get_library_data(ctx, rd, strict_library_id=False, snapshot=False):
     library_id = rd.query.get('library_id')
     library_map, default_library = ctx.library_info(rd)
     if library_id not in library_map:
         if strict_library_id and library_id:
             raise HTTPNotFound(f'No library with id: {library_id}')
         library_id = default_library
-    db = get_db(ctx, rd, library_id)
+    db = get_db(ctx, rd, library_id, snapshot=snapshot)
     return db, library_id, library_map, default_library
 
 
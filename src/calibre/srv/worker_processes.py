@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# Support for running the Content server as several processes that share the
+# listening port via SO_REUSEPORT. Every process has its own in-memory view of
+# the libraries. Requests that can change a library are serialized across
+# all processes, and after every such request the other processes reload their
+# in-memory copy of the libraries before serving their next request. The
+# original process does not serve requests, it only restarts server processes
+# that die.
+
+import mmap
+import os
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import traceback
+from contextlib import contextmanager, suppress
+from threading import Lock
+from time import monotonic
+
+from calibre import prints
+from calibre.constants import ismacos, iswindows
+from calibre.db.tables_cache import database_key
+
+if not iswindows:
+    import fcntl
+
+READ_ONLY_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS'))
+# On macOS SO_REUSEPORT does not distribute connections and forking breaks Qt
+has_reuse_port = not iswindows and not ismacos and hasattr(socket, 'SO_REUSEPORT')
+STOP_SIGNALS = frozenset() if iswindows else frozenset((signal.SIGTERM, signal.SIGHUP, signal.SIGINT))
+# Server processes that fail sooner than this many seconds after starting are
+# not restarted
+MIN_UPTIME = 10
+
+
+class WriteCoordinator:
+
+    def __init__(self):
+        # A counter in memory shared by all the forked processes that is
+        # incremented on every write
+        self.shared = mmap.mmap(-1, 8)
+        # fcntl locks are owned by processes, not file descriptors, so the
+        # inherited descriptor serializes writes between processes and the
+        # thread lock serializes them between threads in a single process
+        self.lock_file = tempfile.TemporaryFile()
+        self.seen_generation = 0
+        self.thread_lock = Lock()
+        self.sync_lock = Lock()
+
+    @property
+    def generation(self):
+        return struct.unpack_from('=Q', self.shared)[0]
+
+    def sync(self, library_broker):
+        ' Reload the loaded libraries if some other process has written to them '
+        gen = self.generation
+        if gen == self.seen_generation:
+            return
+        with self.sync_lock:
+            if gen == self.seen_generation:
+                return
+            with library_broker:
+                dbs = tuple(db for db in library_broker.loaded_dbs.values() if db is not None)
+            for db in dbs:
+                db.new_api.reload_from_db()
+            library_broker.category_caches.clear()
+            library_broker.search_caches.clear()
+            library_broker.tag_browser_caches.clear()
+            library_broker.interface_data_caches.clear()
+            self.seen_generation = gen
+
+    def db_keys(self, library_broker):
+        ans = {}
+        with library_broker:
+            dbs = tuple(db for db in library_broker.loaded_dbs.values() if db is not None)
+        for db in dbs:
+            path = db.new_api.backend.dbpath
+            try:
+                # Includes the WAL file, as in WAL mode commits do not change the database file
+                ans[path] = database_key(path)
+            except OSError:
+                pass
+        return ans
+
+    @contextmanager
+    def write(self, library_broker):
+        with self.thread_lock:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+            try:
+                self.sync(library_broker)
+                before = self.db_keys(library_broker)
+                try:
+                    yield
+                finally:
+                    after = self.db_keys(library_broker)
+                    # Only force the other processes to reload if a library
+                    # was actually changed
+                    if any(before.get(path, key) != key for path, key in after.items()):
+                        gen = self.generation + 1
+                        struct.pack_into('=Q', self.shared, 0, gen)
+                        self.seen_generation = gen
+            finally:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+
+    def invalidate(self):
+        ' Make all processes reload their libraries before serving their next request '
+        with self.thread_lock:
+            fcntl.lockf(self.lock_file, fcntl.LOCK_EX)
+            try:
+                struct.pack_into('=Q', self.shared, 0, self.generation + 1)
+            finally:
+                fcntl.lockf(self.lock_file, fcntl.LOCK_UN)
+
+    def call(self, endpoint, ctx, data, args):
+        if endpoint.needs_db_write or data.method not in READ_ONLY_METHODS:
+            with self.write(ctx.library_broker):
+                return endpoint(ctx, data, *args)
+        self.sync(ctx.library_broker)
+        return endpoint(ctx, data, *args)
+
+    def close(self):
+        self.lock_file.close()
+        self.shared.close()
+
+
+def claim_file(path):
+    ''' Claim path for this process, with a lock that is released when the
+    process dies. Returns an open file that must be passed to
+    release_file_claim(), or None if another process has claimed path. '''
+    while True:
+        f = open(path, 'ab')
+        try:
+            fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return None
+        # The previous owner may have removed the file after this process
+        # opened it, in which case the lock is on a file no one else can see
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+def release_file_claim(f):
+    with suppress(FileNotFoundError):
+        os.remove(f.name)
+    f.close()
+
+
+def supervise_worker_processes(num, run_worker, write_coordinator=None, min_uptime=MIN_UPTIME):
+    ''' Fork num server processes, each of which calls run_worker(index), and
+    restart any that die, until this process is stopped with SIGTERM, SIGHUP
+    or SIGINT. A restarted process gets the index of the one it replaces. A
+    process that fails within min_uptime seconds of starting is not restarted,
+    as it would most likely fail again, instead all processes are stopped and
+    SystemExit is raised. This process only supervises, so that it remains
+    safe for it to fork, it must be called before any threads or database
+    connections are created. '''
+    children = {}
+    stopping = []
+
+    def stop(*a):
+        if not stopping:
+            stopping.append(True)
+            stop_worker_processes(children)
+
+    def start(index):
+        # Block the stop signals until the child is recorded, so that it is
+        # always stopped, and so that the child never runs the stop handler
+        signal.pthread_sigmask(signal.SIG_BLOCK, STOP_SIGNALS)
+        try:
+            pid = os.fork()
+            if pid == 0:
+                for sig in STOP_SIGNALS:
+                    signal.signal(sig, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+                run_worker_process(run_worker, index)
+            children[pid] = index, monotonic()
+        finally:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, STOP_SIGNALS)
+        if stopping:
+            stop_worker_processes((pid,))
+
+    for sig in STOP_SIGNALS:
+        signal.signal(sig, stop)
+    for index in range(num):
+        start(index)
+    failure = None
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index, started_at = children.pop(pid, (None, 0))
+        code = os.waitstatus_to_exitcode(status)
+        if index is None or stopping or code == 0:
+            continue
+        if write_coordinator is not None:
+            # The process may have died in the middle of changing a library
+            write_coordinator.invalidate()
+        if monotonic() - started_at < min_uptime:
+            failure = f'Server process {index} failed with exit code {code} after starting'
+            stop()
+        else:
+            prints(f'Server process {index} died with exit code {code}, restarting it', file=sys.stderr)
+            start(index)
+    if failure is not None:
+        raise SystemExit(failure)
+
+
+def run_worker_process(run_worker, index):
+    code = 1
+    try:
+        run_worker(index)
+        code = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            prints(e.code, file=sys.stderr)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        with suppress(Exception):
+            sys.stdout.flush()
+            sys.stderr.flush()
+        # Do not run the cleanup code of the parent process
+        os._exit(code)
+
+
+def stop_worker_processes(child_pids):
+    for pid in child_pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
@@ -132,6 +132,10 @@ def pid(self):
             return None
         return getattr(self.child, 'pid', None)
 
+    def wait(self):
+        if hasattr(self, 'child'):
+            return self.child.wait()
+
     def close_log_file(self):
         try:
             self._file.close()
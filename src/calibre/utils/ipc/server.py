@@ -23,6 +23,7 @@
 from calibre.utils.ipc import eintr_retry_call
 from calibre.utils.ipc.launch import Worker
 from calibre.utils.ipc.worker import PARALLEL_FUNCS
+from calibre.utils.ipc.zygote import ZygoteClient, zygote_enabled
 from calibre.utils.serialize import pickle_loads
 from polyglot.binary import as_hex_unicode
 from polyglot.builtins import environ_item, string_or_bytes
@@ -30,14 +31,16 @@
 
 server_counter = count()
 _name_counter = count()
+wakeup = object()
 
 
 class ConnectedWorker(Thread):
 
-    def __init__(self, worker, conn, rfile):
+    def __init__(self, worker, conn, rfile, events=None):
         Thread.__init__(self)
         self.daemon = True
         self.conn = conn
+        self.events = events
         self.worker = worker
         self.notifications = Queue()
         self._returncode = 'dummy'
@@ -49,7 +52,10 @@ def __init__(self, worker, conn, rfile):
     def start_job(self, job):
         notification = PARALLEL_FUNCS[job.name][-1] is not None
         eintr_retry_call(self.conn.send, (job.name, job.args, job.kwargs, job.description))
-        if notification:
+        if notification or self.events is not None:
+            # When we have an events queue, the thread is needed to tell the
+            # server that the worker has exited, even if the job sends no
+            # notifications
             self.start()
         else:
             self.conn.close()
@@ -60,12 +66,22 @@ def run(self):
             try:
                 x = eintr_retry_call(self.conn.recv)
                 self.notifications.put(x)
+                if self.events is not None:
+                    self.events.put(wakeup)
             except BaseException:
                 break
         try:
             self.conn.close()
         except BaseException:
             pass
+        if self.events is not None:
+            # The worker has closed its end of the connection, which means it
+            # is exiting
+            try:
+                self.worker.wait()
+            except BaseException:
+                pass
+            self.events.put(wakeup)
 
     def kill(self):
         self.killed = True
@@ -98,7 +114,7 @@ class CriticalError(Exception):
 class Server(Thread):
 
     def __init__(self, notify_on_job_done=lambda x: x, pool_size=None,
-            limit=sys.maxsize, enforce_cpu_limit=True):
+            limit=sys.maxsize, enforce_cpu_limit=True, use_zygote=None):
         Thread.__init__(self)
         self.daemon = True
         self.id = next(server_counter) + 1
@@ -113,9 +129,11 @@ def __init__(self, notify_on_job_done=lambda x: x, pool_size=None,
         self.workers = deque()
         self.launched_worker_counter = count()
         next(self.launched_worker_counter)
+        self.use_zygote = zygote_enabled() if use_zygote is None else use_zygote
+        self.zygote = None
         self.start()
 
-    def launch_worker(self, gui=False, redirect_output=None, job_name=None):
+    def launch_worker(self, gui=False, redirect_output=None, job_name=None, events=None):
         start = time.monotonic()
         id = next(self.launched_worker_counter)
         fd, rfile = tempfile.mkstemp(prefix=f'ipc_result_{self.id}_{id}_',
@@ -124,14 +142,39 @@ def launch_worker(self, gui=False, redirect_output=None, job_name=None):
         if redirect_output is None:
             redirect_output = not gui
 
-        cw = self.do_launch(gui, redirect_output, rfile, job_name=job_name)
+        if self.use_zygote and not gui:
+            cw = self.do_zygote_launch(redirect_output, rfile, events)
+        else:
+            cw = self.do_launch(gui, redirect_output, rfile, job_name=job_name, events=events)
         if isinstance(cw, string_or_bytes):
             raise CriticalError('Failed to launch worker process:\n'+force_unicode(cw))
         if DEBUG:
             print(f'Worker Launch took: {time.monotonic() - start:.2f} seconds')
         return cw
 
-    def do_launch(self, gui, redirect_output, rfile, job_name=None):
+    def do_zygote_launch(self, redirect_output, rfile, events=None):
+        if self.zygote is None or not self.zygote.is_alive:
+            if self.zygote is not None:
+                self.zygote.close()
+            try:
+                self.zygote = ZygoteClient()
+            except BaseException:
+                import traceback
+                return traceback.format_exc()
+        log_path = None
+        if redirect_output:
+            from calibre.ptempfile import PersistentTemporaryFile
+            with PersistentTemporaryFile('_worker_redirect.log') as f:
+                log_path = f.name
+        a, b = Pipe()
+        with a:
+            w = self.zygote.launch(a.fileno(), rfile, log_path)
+        if isinstance(w, string_or_bytes):
+            b.close()
+            return w
+        return ConnectedWorker(w, b, rfile, events)
+
+    def do_launch(self, gui, redirect_output, rfile, job_name=None, events=None):
         a, b = Pipe()
         with a:
             env = {
@@ -150,7 +193,7 @@ def do_launch(self, gui, redirect_output, rfile, job_name=None):
                 b.close()
                 import traceback
                 return traceback.format_exc()
-        return ConnectedWorker(w, b, rfile)
+        return ConnectedWorker(w, b, rfile, events)
 
     def add_job(self, job):
         job.done2 = self.notify_on_job_done
@@ -161,14 +204,15 @@ def run_job(self, job, gui=True, redirect_output=False):
         w.start_job(job)
 
     def run(self):
+        # Both new jobs and wakeups from the workers, sent when they have
+        # notifications or exit, arrive on add_jobs_queue, so there is no need
+        # to poll
         while True:
-            try:
-                job = self.add_jobs_queue.get(True, 0.2)
-                if job is None:
-                    break
+            job = self.add_jobs_queue.get()
+            if job is None:
+                break
+            if job is not wakeup:
                 self.waiting_jobs.insert(0, job)
-            except Empty:
-                pass
 
             # Get notifications from worker process
             for worker in self.workers:
@@ -202,8 +246,10 @@ def run(self):
                 self.changed_jobs_queue.put(job)
 
             # Start waiting jobs
-            sj = self.suitable_waiting_job()
-            if sj is not None:
+            while True:
+                sj = self.suitable_waiting_job()
+                if sj is None:
+                    break
                 job = self.waiting_jobs.pop(sj)
                 job.start_time = time.time()
                 if job.kill_on_start:
@@ -212,7 +258,7 @@ def run(self):
                     job.killed = job.failed = True
                     job.result = None
                 else:
-                    worker = self.launch_worker()
+                    worker = self.launch_worker(events=self.add_jobs_queue)
                     worker.start_job(job)
                     self.workers.append(worker)
                     job.log_path = worker.log_path
@@ -224,6 +270,8 @@ def run(self):
                     self._kill_job(j)
                 except Empty:
                     break
+        if self.zygote is not None:
+            self.zygote.close()
 
     def suitable_waiting_job(self):
         available_workers = self.pool_size - len(self.workers)
@@ -245,10 +293,12 @@ def suitable_waiting_job(self):
 
     def kill_job(self, job):
         self.kill_queue.put(job)
+        self.add_jobs_queue.put(wakeup)
 
     def killall(self):
         for worker in self.workers:
             self.kill_queue.put(worker.job)
+        self.add_jobs_queue.put(wakeup)
 
     def _kill_job(self, job):
         if job.start_time is None:
@@ -299,3 +349,30 @@ def __enter__(self):
 
     def __exit__(self, *args):
         self.close()
+
+
+def benchmark(num_jobs=200, pool_size=4):
+    '''
+    Measure the throughput of the job server in jobs per second for trivial
+    jobs, when launching a new worker process per job and when forking workers
+    from a zygote.
+    Run with: calibre-debug -c "from calibre.utils.ipc.server import benchmark; benchmark()"
+    '''
+    from calibre.utils.ipc.job import ParallelJob
+    for label, use_zygote in (('New process per job', False), ('Forked from zygote', True)):
+        if use_zygote and not zygote_enabled():
+            print(f'{label}: not available on this platform')
+            continue
+        with Server(pool_size=pool_size, enforce_cpu_limit=False, use_zygote=use_zygote) as server:
+            st = time.monotonic()
+            for i in range(num_jobs):
+                server.add_job(ParallelJob('arbitrary', f'Trivial job {i}', lambda j: j, args=['os', 'getpid', ()]))
+            finished, failures = set(), 0
+            while len(finished) < num_jobs:
+                job = server.changed_jobs_queue.get()
+                job.update()
+                if job.is_finished and job.id not in finished:
+                    finished.add(job.id)
+                    failures += bool(job.failed)
+            elapsed = time.monotonic() - st
+        print(f'{label}: {num_jobs / elapsed:.1f} jobs/second with {pool_size} worker(s), {failures} failures')
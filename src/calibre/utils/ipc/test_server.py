@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+import os
+import time
+import unittest
+
+from calibre.utils.ipc.job import ParallelJob
+from calibre.utils.ipc.server import Server
+from calibre.utils.ipc.zygote import zygote_available
+from polyglot.queue import Empty
+
+
+def trivial_job():
+    return ParallelJob('arbitrary', 'Trivial job', lambda j: j, args=['os', 'getpid', ()])
+
+
+def sleeping_job():
+    return ParallelJob('arbitrary', 'Sleeping job', lambda j: j, args=['time', 'sleep', (60,)])
+
+
+class TestServer(unittest.TestCase):
+
+    def wait_for(self, server, job, running=False, timeout=60):
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            try:
+                server.changed_jobs_queue.get(timeout=0.1).update()
+            except Empty:
+                pass
+            if job.is_running if running else job.is_finished:
+                return
+        self.fail(f'Timed out waiting for job to {"start" if running else "finish"}')
+
+    def run_jobs(self, use_zygote):
+        with Server(pool_size=2, enforce_cpu_limit=False, use_zygote=use_zygote) as server:
+            jobs = [trivial_job() for i in range(3)]
+            for job in jobs:
+                server.add_job(job)
+            for job in jobs:
+                self.wait_for(server, job)
+                self.assertFalse(job.failed)
+                self.assertIsInstance(job.result, int)
+                self.assertNotEqual(job.result, os.getpid())
+            self.assertEqual(len({job.result for job in jobs}), len(jobs))
+            self.assertEqual(server.zygote is not None, use_zygote)
+
+            # Killing a running job
+            job = sleeping_job()
+            server.add_job(job)
+            self.wait_for(server, job, running=True)
+            st = time.monotonic()
+            server.kill_job(job)
+            self.wait_for(server, job)
+            self.assertLess(time.monotonic() - st, 30)
+            self.assertTrue(job.killed)
+            self.assertTrue(job.failed)
+
+            # The server still runs jobs after one is killed
+            job = trivial_job()
+            server.add_job(job)
+            self.wait_for(server, job)
+            self.assertFalse(job.failed)
+
+    def test_jobs_without_zygote(self):
+        self.run_jobs(False)
+
+    @unittest.skipUnless(zygote_available, 'The worker zygote is not available on this platform')
+    def test_jobs_with_zygote(self):
+        self.run_jobs(True)
+
+    @unittest.skipUnless(zygote_available, 'The worker zygote is not available on this platform')
+    def test_zygote_death(self):
+        with Server(pool_size=1, enforce_cpu_limit=False, use_zygote=True) as server:
+            job = sleeping_job()
+            server.add_job(job)
+            self.wait_for(server, job, running=True)
+            zygote = server.zygote
+            st = time.monotonic()
+            zygote.process.kill()
+            # The jobs running in children of the zygote fail
+            self.wait_for(server, job)
+            self.assertLess(time.monotonic() - st, 30)
+            self.assertTrue(job.failed)
+            self.assertFalse(job.killed)
+            # And a new zygote is started for the next job
+            job = trivial_job()
+            server.add_job(job)
+            self.wait_for(server, job)
+            self.assertFalse(job.failed)
+            self.assertIsNot(server.zygote, zygote)
+            self.assertTrue(server.zygote.is_alive)
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestServer)
+
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(find_tests())
@@ -200,24 +200,35 @@ def main():
     fd = int(os.environ['CALIBRE_WORKER_FD'])
     resultf = from_hex_unicode(os.environ['CALIBRE_WORKER_RESULT'])
     with Connection(fd) as conn:
-        name, args, kwargs, desc = eintr_retry_call(conn.recv)
-        if desc:
-            prints(desc)
-            sys.stdout.flush()
-        func, notification = get_func(name)
-        notifier = Progress(conn)
-        if notification:
-            kwargs[notification] = notifier
-            notifier.start()
+        run_job(conn, resultf)
+    flush_output()
+    return 0
 
-        result = func(*args, **kwargs)
-        if result is not None:
-            os.makedirs(os.path.dirname(resultf), exist_ok=True)
-            with open(resultf, 'wb') as f:
-                f.write(pickle_dumps(result))
 
-        notifier.queue.put(None)
+def run_job(conn, resultf):
+    ' Run the job sent over conn, writing its result, if any, to resultf. Used by both worker processes and zygote children. '
+    name, args, kwargs, desc = eintr_retry_call(conn.recv)
+    if desc:
+        prints(desc)
+        sys.stdout.flush()
+    func, notification = get_func(name)
+    notifier = Progress(conn)
+    if notification:
+        kwargs[notification] = notifier
+        notifier.start()
+
+    result = func(*args, **kwargs)
+    if result is not None:
+        os.makedirs(os.path.dirname(resultf), exist_ok=True)
+        with open(resultf, 'wb') as f:
+            f.write(pickle_dumps(result))
 
+    notifier.queue.put(None)
+    if notifier.is_alive():
+        notifier.join()
+
+
+def flush_output():
     try:
         sys.stdout.flush()
     except OSError:
@@ -226,7 +237,6 @@ def main():
         sys.stderr.flush()
     except OSError:
         pass  # Happens sometimes on OS X for GUI processes (EPIPE)
-    return 0
 
 
 if __name__ == '__main__':
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# License: GPLv3 Copyright: 2026, Kovid Goyal <kovid at kovidgoyal.net>
+
+# A zygote is a long lived worker process that has already imported the
+# expensive modules needed by jobs. Instead of launching a fresh interpreter
+# for every job, the job server sends the zygote the socket for a job and the
+# zygote forks a child to run it. The zygote reports the pid of every child
+# it forks and the exit code of every child that finishes.
+
+import importlib
+import os
+import selectors
+import signal
+import sys
+import traceback
+from multiprocessing import Pipe
+from multiprocessing.reduction import recv_handle, send_handle
+from threading import Event, Lock, Thread
+
+from calibre.constants import ismacos, iswindows
+from calibre.utils.ipc import eintr_retry_call
+from calibre.utils.ipc.launch import Worker
+
+# Forking processes that use the Cocoa frameworks is unsafe on macOS
+zygote_available = not iswindows and not ismacos
+
+# Only modules that do not depend on user configuration that may change while
+# the zygote is running. In particular, nothing that imports
+# calibre.customize.ui, as that would freeze the set of enabled plugins.
+PRELOAD_MODULES = (
+    'lxml.etree', 'lxml.html', 'css_parser', 'html5_parser',
+    'calibre.ebooks.chardet', 'calibre.ebooks.conversion.preprocess',
+    'calibre.ebooks.oeb.base', 'calibre.ebooks.metadata.opf2', 'calibre.ebooks.metadata.opf3',
+)
+
+
+def zygote_enabled():
+    return zygote_available and 'CALIBRE_NO_WORKER_ZYGOTE' not in os.environ
+
+
+# Parent side {{{
+
+class ZygoteWorker:
+    '''
+    A job process forked by the zygote. Has the same interface as
+    :class:`calibre.utils.ipc.launch.Worker` as far as the job server is
+    concerned.
+    '''
+
+    def __init__(self, pid, log_path):
+        self.pid, self.log_path = pid, log_path
+        self._returncode = None
+        self.exited = Event()
+
+    def set_returncode(self, rc):
+        self._returncode = rc
+        self.exited.set()
+
+    @property
+    def returncode(self):
+        return self._returncode
+
+    @property
+    def is_alive(self):
+        return not self.exited.is_set()
+
+    def wait(self):
+        self.exited.wait()
+        return self._returncode
+
+    def close_log_file(self):
+        pass
+
+    def kill(self):
+        if not self.is_alive:
+            return
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            if not self.exited.wait(2):
+                os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+class ZygoteClient(Thread):
+    '''
+    Launches and talks to a zygote process. The thread reads the messages the
+    zygote sends about the processes it forks.
+    '''
+
+    def __init__(self):
+        Thread.__init__(self, name='ZygoteClient')
+        self.daemon = True
+        self.send_lock, self.state_lock = Lock(), Lock()
+        self.pending = {}
+        self.children = {}
+        self.job_counter = 0
+        a, self.conn = Pipe()
+        with a:
+            self.process = Worker({
+                'CALIBRE_SIMPLE_WORKER': 'calibre.utils.ipc.zygote:main',
+                'CALIBRE_ZYGOTE_FD': str(a.fileno()),
+            })
+            self.process(pass_fds=(a.fileno(),), redirect_output=True)
+        self.start()
+
+    @property
+    def is_alive(self):
+        return Thread.is_alive(self) and self.process.is_alive
+
+    def run(self):
+        while True:
+            try:
+                msg = eintr_retry_call(self.conn.recv)
+            except (EOFError, OSError):
+                break
+            action = msg[0]
+            with self.state_lock:
+                if action == 'launched':
+                    job_id, pid = msg[1:]
+                    p = self.pending.pop(job_id)
+                    p['worker'] = self.children[pid] = ZygoteWorker(pid, p['log_path'])
+                    p['event'].set()
+                elif action == 'failed':
+                    job_id, tb = msg[1:]
+                    p = self.pending.pop(job_id)
+                    p['error'] = tb
+                    p['event'].set()
+                elif action == 'exited':
+                    pid, rc = msg[1:]
+                    w = self.children.pop(pid, None)
+                    if w is not None:
+                        w.set_returncode(rc)
+        # The zygote has gone away, we can no longer track its children
+        with self.state_lock:
+            for p in self.pending.values():
+                p['error'] = 'The worker zygote process died'
+                p['event'].set()
+            self.pending.clear()
+            children, self.children = tuple(self.children.values()), {}
+        for w in children:
+            try:
+                os.kill(w.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            w.set_returncode(1)
+
+    def launch(self, fd, rfile, log_path=None):
+        '''
+        Fork a child of the zygote that will run the job sent over the socket
+        fd. Returns a :class:`ZygoteWorker` or an error message.
+        '''
+        event = Event()
+        with self.state_lock:
+            self.job_counter += 1
+            job_id = self.job_counter
+            self.pending[job_id] = p = {'event': event, 'log_path': log_path}
+        try:
+            with self.send_lock:
+                eintr_retry_call(self.conn.send, (job_id, rfile, log_path))
+                send_handle(self.conn, fd, self.process.pid)
+        except Exception:
+            with self.state_lock:
+                self.pending.pop(job_id, None)
+            return traceback.format_exc()
+        event.wait()
+        return p.get('error') or p['worker']
+
+    def close(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.process.kill()
+# }}}
+
+
+# Zygote side {{{
+
+def preload():
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            traceback.print_exc()
+
+
+def run_child(fd, rfile, log_path):
+    from multiprocessing.connection import Connection
+
+    from calibre.utils.ipc.worker import flush_output, run_job
+    rc = 0
+    try:
+        if log_path:
+            with open(log_path, 'ab') as f:
+                os.dup2(f.fileno(), sys.stdout.fileno())
+                os.dup2(f.fileno(), sys.stderr.fileno())
+        with Connection(fd) as conn:
+            run_job(conn, rfile)
+    except BaseException:
+        traceback.print_exc()
+        rc = 1
+    flush_output()
+    os._exit(rc)
+
+
+def reap(conn):
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid == 0:
+            break
+        conn.send(('exited', pid, os.waitstatus_to_exitcode(status)))
+
+
+def main():
+    from multiprocessing.connection import Connection
+    conn = Connection(int(os.environ.pop('CALIBRE_ZYGOTE_FD')))
+    preload()
+    sys.stdout.flush(), sys.stderr.flush()
+    # Use the self pipe trick to get notified of child exits in the select
+    # loop, without needing any threads, which do not survive fork()
+    r, w = os.pipe()
+    os.set_blocking(w, False), os.set_blocking(r, False)
+    signal.set_wakeup_fd(w)
+    signal.signal(signal.SIGCHLD, lambda *a: None)
+    sel = selectors.DefaultSelector()
+    sel.register(conn.fileno(), selectors.EVENT_READ, 'conn')
+    sel.register(r, selectors.EVENT_READ, 'child')
+    keep_going = True
+    while keep_going:
+        for key, mask in sel.select():
+            if key.data == 'child':
+                try:
+                    while os.read(r, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                reap(conn)
+                continue
+            try:
+                job_id, rfile, log_path = conn.recv()
+                fd = recv_handle(conn)
+            except (EOFError, OSError):
+                keep_going = False
+                break
+            try:
+                pid = os.fork()
+            except OSError:
+                os.close(fd)
+                conn.send(('failed', job_id, traceback.format_exc()))
+                continue
+            if pid == 0:
+                sel.close()
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                os.close(r), os.close(w)
+                conn.close()
+                run_child(fd, rfile, log_path)
+            os.close(fd)
+            conn.send(('launched', job_id, pid))
+    # Our parent has gone away, the children will exit on their own once
+    # their jobs are done
+    sel.close()
+    conn.close()
+# }}}
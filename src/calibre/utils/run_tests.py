@@ -289,10 +289,16 @@ def ok(x):
         a(find_tests())
         from calibre.ebooks.metadata.author_mapper import find_tests
         a(find_tests())
+        from calibre.ebooks.metadata.sources.mock import find_tests
+        a(find_tests())
+        from calibre.ebooks.metadata.sources.results_cache import find_tests
+        a(find_tests())
         from calibre.utils.shared_file import find_tests
         a(find_tests())
         from calibre.utils.test_lock import find_tests
         a(find_tests())
+        from calibre.utils.ipc.test_server import find_tests
+        a(find_tests())
         from calibre.utils.search_query_parser_test import find_tests
         a(find_tests())
         from calibre.utils.html2text import find_tests